@@ -0,0 +1,68 @@
+"""
+Logins per second through POST /login with a fixed number of KDF workers.
+
+    pipenv run python benchmarks/login.py --workers 4 --clients 16 --seconds 10
+
+Runs against a throwaway SQLite database with one user, every client thread logs in
+with the right password in a loop. Raise --clients past workers + PASSWORD_HASH_QUEUE
+to see the 503s of a saturated pool; LOGIN_RATE_LIMIT is lifted for the run.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--method", default=None, help="PASSWORD_HASH_METHOD, e.g. pbkdf2:sha256:600000")
+    args = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(), "login.db")
+    os.environ["DATABASE_URL"] = "sqlite:///" + database
+    os.environ["PASSWORD_HASH_WORKERS"] = str(args.workers)
+    os.environ["LOGIN_RATE_LIMIT"] = str(10 ** 9)
+    if args.method:
+        os.environ["PASSWORD_HASH_METHOD"] = args.method
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+    from app import create_app
+    app = create_app()
+    from models import db, User
+    import passwords
+
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(name="bench", email="bench@example.com", password="secret", is_active=True))
+        db.session.commit()
+
+    statuses = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.seconds
+
+    def client():
+        test_client = app.test_client()
+        seen = {}
+        while time.perf_counter() < deadline:
+            status = test_client.post("/login", json={"email": "bench@example.com", "password": "secret"}).status_code
+            seen[status] = seen.get(status, 0) + 1
+        with lock:
+            for status, count in seen.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"method {passwords.pool.method}, {passwords.pool.workers} workers, {args.clients} clients, {elapsed:.1f}s")
+    print(f"{statuses.get(200, 0) / elapsed:.1f} logins/s, responses {dict(sorted(statuses.items()))}")
+
+if __name__ == "__main__":
+    main()
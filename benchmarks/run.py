@@ -0,0 +1,277 @@
+"""
+Benchmark harness: every route of src/app.py against a seeded database.
+
+    pipenv run python benchmarks/run.py --out benchmarks/baseline.json
+    pipenv run python benchmarks/run.py --compare benchmarks/baseline.json
+    DATABASE_URL=postgresql://localhost/swapi_bench pipenv run python benchmarks/run.py --reset \\
+        --planets 10000 --characters 100000 --users 10000 --favorites 1000000
+
+Seeds the database with seed.py (a temporary SQLite file without DATABASE_URL), then
+sends each scenario's requests one after the other, through the Flask test client
+and through gunicorn (one sync worker) on a local port. Reads, searches, pages,
+streams, logins and the authenticated favorite writes are all covered; writes are
+paired (add then remove) so every run sees the same data.
+
+Per scenario and mode it reports p50/p95/p99 latency, requests/s and queries per
+request (read off the Server-Timing header, which a streamed response sends before
+its queries run, so streams show 0), and per mode the peak RSS of the
+process that served the requests. --out writes that as JSON; --compare prints the
+changes against such a file and exits with 1 when a p50 or p95 got worse by more
+than --threshold percent. The response cache is off unless --cache is given, so
+the numbers are those of the database paths.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from seed import SRC, PASSWORD
+from serving import Server, HASH_METHOD
+
+QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def call(self, method, path, body=None, headers=None):
+        response = self.client.open(path, method=method, json=body, headers=headers or {})
+        #get_data() drains streamed responses too
+        return response.status_code, response.headers.get("Server-Timing", ""), response.get_data()
+
+class HTTPClient:
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+
+    def call(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+        self.connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+        response = self.connection.getresponse()
+        return response.status, response.getheader("Server-Timing", ""), response.read()
+
+#(name, method, path for the i-th request, body for the i-th request, authenticated, number of requests)
+def scenarios(volumes, requests, list_requests, free_planets, free_characters):
+    from pagination import encode_cursor
+    rng = random.Random(7)
+    planets, characters, users = volumes["planets"], volumes["characters"], volumes["users"]
+    pick = lambda count: [rng.randint(1, count) for _ in range(requests)]
+    planet_ids, character_ids, user_ids = pick(planets), pick(characters), pick(users)
+    batch = [{"op": "add", "type": "planet", "id": id} for id in free_planets[:10]]
+    unbatch = [dict(operation, op="remove") for operation in batch]
+    return [
+        ("sitemap", "GET", lambda i: "/", None, False, requests),
+        ("people", "GET", lambda i: "/people", None, False, list_requests),
+        ("planets", "GET", lambda i: "/planets", None, False, list_requests),
+        ("users", "GET", lambda i: "/users", None, False, list_requests),
+        ("person", "GET", lambda i: f"/people/{character_ids[i]}", None, False, requests),
+        ("planet", "GET", lambda i: f"/planets/{planet_ids[i]}", None, False, requests),
+        ("user", "GET", lambda i: f"/users/{user_ids[i]}", None, False, requests),
+        ("user favorites", "GET", lambda i: f"/users/{user_ids[i]}/favorites", None, False, requests),
+        ("people page", "GET", lambda i: f"/people?limit=20&after={encode_cursor(i * 20)}", None, False, requests),
+        ("planets page", "GET", lambda i: f"/planets?limit=20&after={encode_cursor(i * 20)}", None, False, requests),
+        ("users page", "GET", lambda i: f"/users?limit=20&after={encode_cursor(i * 20)}", None, False, requests),
+        ("people page sorted", "GET", lambda i: "/people?limit=20&sort=-favorite_count", None, False, requests),
+        ("people filtered", "GET", lambda i: "/people?limit=20&faction=rebel&race=human", None, False, requests),
+        ("planets search", "GET", lambda i: "/planets?limit=20&q=oin", None, False, requests),
+        ("people prefix", "GET", lambda i: "/people?limit=20&name=ta", None, False, requests),
+        ("people stream", "GET", lambda i: "/people?stream=1", None, False, list_requests),
+        ("people multi-get", "GET", lambda i: "/people?ids=" + ",".join(map(str, character_ids[i:i + 10])), None, False, requests),
+        ("planets multi-get", "GET", lambda i: "/planets?ids=" + ",".join(map(str, planet_ids[i:i + 10])), None, False, requests),
+        ("detail batch", "POST", lambda i: "/batch", lambda i: {"requests": [f"/people/{character_ids[i]}", f"/planets/{planet_ids[i]}", f"/users/{user_ids[i]}"]}, False, requests),
+        ("leaderboard", "GET", lambda i: "/leaderboard/people?limit=10", None, False, requests),
+        ("health", "GET", lambda i: "/health/db", None, False, requests),
+        ("metrics", "GET", lambda i: "/metrics", None, False, requests),
+        ("login", "POST", lambda i: "/login", lambda i: {"email": "user1@example.com", "password": PASSWORD}, False, requests),
+        ("current user favorites", "GET", lambda i: "/users/favorites", None, True, requests),
+        ("favorite planet", "POST", lambda i: f"/favorite/planet/{free_planets[i]}", None, True, requests),
+        ("unfavorite planet", "DELETE", lambda i: f"/favorite/planet/{free_planets[i]}", None, True, requests),
+        ("favorite person", "POST", lambda i: f"/favorite/people/{free_characters[i]}", None, True, requests),
+        ("unfavorite person", "DELETE", lambda i: f"/favorite/people/{free_characters[i]}", None, True, requests),
+        ("batch favorites", "PATCH", lambda i: "/users/favorites", lambda i: {"operations": batch if i % 2 == 0 else unbatch}, True, requests - requests % 2),
+    ]
+
+#planets and characters user 1 has not favorited, for the paired writes
+def free_targets(app, count):
+    from models import db, Favorite, Planet, Character
+    with app.app_context():
+        taken = db.select(Favorite.planet_id).where(Favorite.user_id == 1, Favorite.planet_id.is_not(None))
+        planets = db.session.execute(db.select(Planet.id).where(Planet.id.not_in(taken)).order_by(Planet.id).limit(count)).scalars().all()
+        taken = db.select(Favorite.character_id).where(Favorite.user_id == 1, Favorite.character_id.is_not(None))
+        characters = db.session.execute(db.select(Character.id).where(Character.id.not_in(taken)).order_by(Character.id).limit(count)).scalars().all()
+    return planets, characters
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def measure(client, scenario, token):
+    name, method, path, body, authenticated, count = scenario
+    headers = {"Authorization": "Bearer " + token} if authenticated else {}
+    if method == "GET":
+        client.call(method, path(0), None, headers) #warm up
+    latencies, queries, statuses, size = [], [], {}, 0
+    started = time.perf_counter()
+    for i in range(count):
+        start = time.perf_counter()
+        status, timing, data = client.call(method, path(i), body(i) if body else None, headers)
+        latencies.append(time.perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+        size = len(data)
+        match = QUERIES.search(timing)
+        if match:
+            queries.append(int(match.group(1)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": count,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "requests_per_second": round(count / elapsed, 1),
+        "queries": round(sum(queries) / len(queries), 2) if queries else None,
+        "response_bytes": size,
+        "statuses": {str(status): number for status, number in sorted(statuses.items())},
+    }
+
+def peak_rss_mb(pid="self"):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if pid == "self":
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return None
+
+def worker_pids(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            return [int(child) for child in children.read().split()]
+    except OSError:
+        return []
+
+def run(client, all_scenarios, token, log):
+    routes = {}
+    for scenario in all_scenarios:
+        routes[scenario[0]] = result = measure(client, scenario, token)
+        log(f"  {scenario[0]:<24} p50 {result['p50_ms']:>9.2f} ms  p95 {result['p95_ms']:>9.2f} ms  "
+            f"{result['requests_per_second']:>8.1f} req/s  {result['queries']} queries  {result['statuses']}")
+    return routes
+
+def login(client):
+    status, timing, data = client.call("POST", "/login", {"email": "user1@example.com", "password": PASSWORD})
+    return json.loads(data)["token"]
+
+def compare(results, baseline, threshold):
+    regressions = 0
+    for mode, current in results["results"].items():
+        previous = baseline["results"].get(mode)
+        if previous is None:
+            continue
+        print(f"{mode}: peak RSS {previous['peak_rss_mb']} -> {current['peak_rss_mb']} MB")
+        for route, now in current["routes"].items():
+            before = previous["routes"].get(route)
+            if before is None:
+                continue
+            changes = []
+            for key in ("p50_ms", "p95_ms"):
+                change = (now[key] - before[key]) / before[key] * 100 if before[key] else 0
+                flag = " REGRESSION" if change > threshold else ""
+                regressions += bool(flag)
+                changes.append(f"{key} {before[key]:.2f} -> {now[key]:.2f} ({change:+.0f}%){flag}")
+            if now["queries"] != before["queries"]:
+                changes.append(f"queries {before['queries']} -> {now['queries']}")
+            print(f"  {route:<24} " + "  ".join(changes))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--planets", type=int, default=1000)
+    parser.add_argument("--characters", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--favorites", type=int, default=50000)
+    parser.add_argument("--reset", action="store_true", help="let seed.py empty DATABASE_URL first")
+    parser.add_argument("--skip-seed", action="store_true", help="DATABASE_URL is already seeded with these volumes")
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario")
+    parser.add_argument("--list-requests", type=int, default=3, help="requests per full collection scenario")
+    parser.add_argument("--modes", default="testclient,wsgi")
+    parser.add_argument("--port", type=int, default=5650)
+    parser.add_argument("--cache", action="store_true", help="keep the response cache on")
+    parser.add_argument("--out")
+    parser.add_argument("--compare")
+    parser.add_argument("--threshold", type=float, default=20)
+    args = parser.parse_args()
+
+    volumes = {"planets": args.planets, "characters": args.characters, "users": args.users, "favorites": args.favorites}
+    directory = tempfile.mkdtemp()
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{directory}/bench.db")
+    os.environ.update(PASSWORD_HASH_METHOD=HASH_METHOD, LOGIN_RATE_LIMIT=str(10 ** 9), SERVER_TIMING="1", SLOW_QUERY_MS="0")
+    if not args.cache:
+        os.environ["CACHE_MAXSIZE"] = "0"
+    if not args.skip_seed:
+        #in its own process, so the peak RSS below is the serving's only
+        command = [sys.executable, os.path.join(HERE, "seed.py")] + [f"--{key}={value}" for key, value in volumes.items()]
+        subprocess.run(command + (["--reset"] if args.reset else []), check=True)
+
+    sys.path.insert(0, SRC)
+    from app import create_app
+    app = create_app()
+    free_planets, free_characters = free_targets(app, args.requests)
+    if len(free_planets) < args.requests or len(free_characters) < args.requests:
+        raise SystemExit("Not enough planets/characters left to favorite, seed more or send fewer --requests")
+    all_scenarios = scenarios(volumes, args.requests, args.list_requests, free_planets, free_characters)
+
+    results = {
+        "meta": {
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=HERE).stdout.strip(),
+            "python": platform.python_version(),
+            "database": app.config["SQLALCHEMY_DATABASE_URI"].split(":", 1)[0],
+            "volumes": volumes,
+            "requests": args.requests,
+            "cache": args.cache,
+        },
+        "results": {},
+    }
+    modes = args.modes.split(",")
+    if "testclient" in modes:
+        print("testclient")
+        client = TestClient(app)
+        routes = run(client, all_scenarios, login(client), print)
+        results["results"]["testclient"] = {"routes": routes, "peak_rss_mb": peak_rss_mb()}
+    if "wsgi" in modes:
+        print("wsgi (gunicorn, 1 sync worker)")
+        server = Server("sync", os.environ["DATABASE_URL"], args.port, 1)
+        try:
+            client = HTTPClient(args.port)
+            routes = run(client, all_scenarios, login(client), print)
+            rss = [peak_rss_mb(pid) for pid in worker_pids(server.process.pid)]
+        finally:
+            server.stop()
+        results["results"]["wsgi"] = {"routes": routes, "peak_rss_mb": max(filter(None, rss), default=None)}
+
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+            out.write("\n")
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline), args.threshold)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
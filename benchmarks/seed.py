@@ -0,0 +1,146 @@
+"""
+Seeds a database with generated planets, characters, users and favorites for the benchmarks.
+
+    pipenv run python benchmarks/seed.py --planets 10000 --characters 100000 --users 10000 --favorites 1000000
+    DATABASE_URL=postgresql://localhost/swapi_bench pipenv run python benchmarks/seed.py --reset
+
+The schema comes from the migrations (flask db upgrade), so the search and filter
+indexes are the ones production has. Rows are written with bulk INSERTs in batches,
+favorite_count is filled in from the generated favorites, and the same --random-seed
+always gives the same data. Every user's password is "password".
+
+A database that already has rows is left alone unless --reset is given, which
+downgrades to an empty schema first: only point it at a throwaway database.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "migrations")
+PASSWORD = "password"
+BATCH = 10000
+
+TERRAINS = ("desert", "forest", "ice", "ocean", "swamp", "gas giant", "urban", "grasslands", "mountains", "jungle")
+FACTIONS = ("rebel", "empire", "jedi", "sith", "hutt", "neutral")
+RACES = ("human", "wookiee", "droid", "twi'lek", "rodian", "zabrak", "mon calamari", "ewok")
+GENDERS = ("female", "male", "none")
+SYLLABLES = ("ta", "to", "oo", "ine", "na", "boo", "ho", "th", "dan", "to", "oine", "kash", "yyy", "end", "or", "cor", "us", "cant")
+
+def name(rng, index):
+    #unique (the index is part of it) but searchable like real names
+    return "".join(rng.choice(SYLLABLES) for _ in range(3)).capitalize() + f" {index}"
+
+def batches(rows):
+    for start in range(0, len(rows), BATCH):
+        yield rows[start:start + BATCH]
+
+def seed(app, planets, characters, users, favorites, random_seed=1, reset=False, log=print):
+    from flask_migrate import Migrate, upgrade, downgrade
+    from models import db, User, Planet, Character, Favorite, utcnow
+    import passwords
+    rng = random.Random(random_seed)
+    #create_app() only sets up Flask-Migrate under the flask CLI
+    if "migrate" not in app.extensions:
+        Migrate(app, db)
+
+    with app.app_context():
+        if reset:
+            downgrade(MIGRATIONS, revision="base")
+        upgrade(MIGRATIONS)
+        if db.session.execute(db.select(db.func.count(Planet.id))).scalar():
+            raise SystemExit("The database already has rows, use --reset to empty it first")
+        now = utcnow()
+        started = time.perf_counter()
+
+        planet_rows = [{
+            "id": id, "name": name(rng, id), "terrain": rng.choice(TERRAINS), "description": "generated planet",
+            "location": f"sector {rng.randint(1, 500)}", "key_event": "none", "favorite_count": 0,
+            "revision": 1, "updated_at": now,
+        } for id in range(1, planets + 1)]
+        for rows in batches(planet_rows):
+            db.session.execute(db.insert(Planet.__table__), rows)
+        log(f"{planets} planets")
+
+        character_rows = [{
+            "id": id, "name": name(rng, id), "gender": rng.choice(GENDERS), "faction": rng.choice(FACTIONS),
+            "race": rng.choice(RACES), "homeworld_id": rng.randint(1, planets) if planets and rng.random() < 0.9 else None,
+            "favorite_count": 0, "revision": 1, "updated_at": now,
+        } for id in range(1, characters + 1)]
+        for rows in batches(character_rows):
+            db.session.execute(db.insert(Character.__table__), rows)
+        log(f"{characters} characters")
+
+        #one hash for everybody, hashing each password would take longer than the whole seed
+        password = passwords.hash_password(PASSWORD)
+        user_rows = [{
+            "id": id, "name": f"user {id}", "email": f"user{id}@example.com", "password": password,
+            "is_active": True, "revision": 1, "updated_at": now,
+        } for id in range(1, users + 1)]
+        for rows in batches(user_rows):
+            db.session.execute(db.insert(User.__table__), rows)
+        log(f"{users} users")
+
+        capacity = users * (planets + characters)
+        if favorites > capacity:
+            raise SystemExit(f"At most {capacity} distinct favorites fit these volumes")
+        pairs = set()
+        planet_counts, character_counts = Counter(), Counter()
+        rows = []
+        while len(pairs) < favorites:
+            user_id = rng.randint(1, users)
+            #planets and characters in proportion to their numbers
+            if rng.randrange(planets + characters) < planets:
+                pair = (user_id, "planet", rng.randint(1, planets))
+            else:
+                pair = (user_id, "character", rng.randint(1, characters))
+            if pair in pairs:
+                continue
+            pairs.add(pair)
+            user_id, kind, target_id = pair
+            (planet_counts if kind == "planet" else character_counts)[target_id] += 1
+            rows.append({
+                "user_id": user_id, "planet_id": target_id if kind == "planet" else None,
+                "character_id": target_id if kind == "character" else None, "revision": 1, "updated_at": now,
+            })
+            if len(rows) == BATCH:
+                db.session.execute(db.insert(Favorite.__table__), rows)
+                rows = []
+        if rows:
+            db.session.execute(db.insert(Favorite.__table__), rows)
+        log(f"{favorites} favorites")
+
+        for model, counts in ((Planet, planet_counts), (Character, character_counts)):
+            update = db.update(model.__table__).where(model.__table__.c.id == db.bindparam("target")).values(favorite_count=db.bindparam("count"))
+            items = [{"target": id, "count": count} for id, count in counts.items()]
+            for rows in batches(items):
+                db.session.execute(update, rows)
+        db.session.commit()
+
+        if db.engine.dialect.name == "postgresql":
+            #fresh statistics, so the planner sees the volumes
+            with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                connection.execute(db.text("ANALYZE"))
+        log(f"seeded in {time.perf_counter() - started:.1f}s")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--planets", type=int, default=1000)
+    parser.add_argument("--characters", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--favorites", type=int, default=50000)
+    parser.add_argument("--random-seed", type=int, default=1)
+    parser.add_argument("--reset", action="store_true", help="empty the database first (downgrade to base)")
+    args = parser.parse_args()
+
+    sys.path.insert(0, SRC)
+    from app import create_app
+    app = create_app()
+    print("seeding", app.config["SQLALCHEMY_DATABASE_URI"])
+    seed(app, args.planets, args.characters, args.users, args.favorites, args.random_seed, args.reset)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Rows/s of the list payloads: models' serialize() against the column tuple
+serializers of src/serializers.py, and the stdlib JSON provider against orjson.
+
+    pipenv run python benchmarks/serializers.py --characters 20000 --favorites 100000
+
+Seeds a temporary SQLite database with seed.py, then for /people, /planets and
+/users times each step, best of --repeat runs: building the payload (queries
+included), encoding it, both. That the four combinations (ORM or column tuples,
+stdlib or orjson) give byte-identical bodies is checked by tests/test_serializers.py.
+
+The cyclic garbage collector is off while a run is timed and collects between runs:
+the ORM runs leave large reference cycles behind, and a collection that happens to
+fall in the middle of a later run is not that run's cost.
+"""
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from seed import SRC, seed
+
+def best(repeat, function):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return min(times), result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--planets", type=int, default=1000)
+    parser.add_argument("--characters", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--favorites", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{directory}/serializers.db"
+    os.environ["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:1000"
+    sys.path.insert(0, SRC)
+    from flask.json.provider import DefaultJSONProvider
+    from app import create_app
+    app = create_app()
+    from models import db, User, Character, Planet
+    import queries
+    import serializers
+    seed(app, args.planets, args.characters, args.users, args.favorites, log=lambda message: None)
+
+    providers = {"stdlib": DefaultJSONProvider(app)}
+    if serializers.orjson is not None:
+        providers["orjson"] = serializers.OrjsonProvider(app)
+    else:
+        print("orjson is not installed, only the stdlib provider is measured")
+
+    def orm(model, graph):
+        def build():
+            db.session.remove()
+            return [obj.serialize() for obj in db.session.execute(db.select(model).options(*graph).order_by(model.id)).scalars().all()]
+        return build
+
+    def tuples(function):
+        def build():
+            db.session.remove()
+            return function(db.session)
+        return build
+
+    collections = {
+        "people": (orm(Character, queries.character_graph()), tuples(serializers.characters), args.characters),
+        "planets": (orm(Planet, queries.planet_graph()), tuples(serializers.planets), args.planets),
+        "users": (orm(User, queries.user_graph()), tuples(serializers.users), args.users),
+    }
+    with app.app_context():
+        for name, (legacy, columns, rows) in collections.items():
+            size = len(providers["stdlib"].dumps(columns(), **serializers.COMPACT))
+            print(f"{name}: {rows} rows, {size} bytes")
+            for builder, build in (("serialize()", legacy), ("column tuples", columns)):
+                built, payload = best(args.repeat, build)
+                print(f"  build   {builder:<14} {built * 1000:>9.1f} ms {rows / built:>11.0f} rows/s")
+            for provider, encoder in providers.items():
+                encoded, _ = best(args.repeat, lambda: encoder.dumps(payload, **serializers.COMPACT))
+                print(f"  encode  {provider:<14} {encoded * 1000:>9.1f} ms {rows / encoded:>11.0f} rows/s")
+            for (builder, build), (provider, encoder) in ((("serialize()", legacy), ("stdlib", providers["stdlib"])),
+                                                          (("column tuples", columns), list(providers.items())[-1])):
+                total, _ = best(args.repeat, lambda: encoder.dumps(build(), **serializers.COMPACT))
+                print(f"  total   {builder} + {provider}: {total * 1000:.1f} ms, {rows / total:.0f} rows/s")
+
+if __name__ == "__main__":
+    main()
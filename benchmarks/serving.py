@@ -0,0 +1,170 @@
+"""
+Sync (wsgi.py on gunicorn) vs async (asgi.py on uvicorn workers) serving modes.
+
+    pipenv run python benchmarks/serving.py --workers 2 --clients 32 --seconds 10
+    DATABASE_URL=postgresql://... pipenv run python benchmarks/serving.py
+
+Seeds a database, starts gunicorn once per SERVER_MODE on that same data and
+measures requests/s and latency percentiles with --clients concurrent keep-alive
+connections. That both modes answer with the same status codes and bodies is checked
+by tests/test_serving.py, without gunicorn or uvicorn.
+
+Without DATABASE_URL each mode gets its own copy of a seeded SQLite file. With a
+Postgres DATABASE_URL the tables are recreated and seeded there, so use a
+throwaway database; the async mode only pays off when the database has latency to
+wait on, which a local SQLite file does not.
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SRC = os.path.join(ROOT, "src")
+#cheap hashes, so seeding and logins measure the serving and not the KDF
+HASH_METHOD = "pbkdf2:sha256:1000"
+
+def seed(database_url, size):
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["PASSWORD_HASH_METHOD"] = HASH_METHOD
+    sys.path.insert(0, SRC)
+    from app import create_app
+    app = create_app()
+    from models import db, User, Planet, Character, Favorite
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        users = [User(f"user {i}", f"user{i}@example.com", f"password {i}", True) for i in range(size)]
+        planets = [Planet(f"planet {i}", "desert", "arid", "low", "1") for i in range(size)]
+        characters = []
+        for i in range(size * 2):
+            character = Character(f"character {i}", "female", "rebel", "human")
+            character.homeworld = planets[i % size]
+            characters.append(character)
+        db.session.add_all(users + planets + characters)
+        for i, user in enumerate(users):
+            db.session.add(Favorite(user, planet=planets[i]))
+            db.session.add(Favorite(user, character=characters[(i * 7) % len(characters)]))
+        db.session.commit()
+
+class Server:
+    def __init__(self, mode, database_url, port, workers):
+        env = dict(os.environ, SERVER_MODE=mode, DATABASE_URL=database_url, WEB_CONCURRENCY=str(workers),
+                   PASSWORD_HASH_METHOD=HASH_METHOD, LOGIN_RATE_LIMIT=str(10 ** 9))
+        self.port = port
+        self.process = subprocess.Popen(
+            ["gunicorn", "--chdir", SRC, "--bind", f"127.0.0.1:{port}", "--log-level", "warning"],
+            env=env,
+            cwd=ROOT, #for gunicorn.conf.py
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+                connection.request("GET", "/people/1")
+                connection.getresponse().read()
+                return
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f"gunicorn ({mode}) did not start")
+
+    def stop(self):
+        self.process.send_signal(signal.SIGTERM)
+        self.process.wait(timeout=30)
+
+def call(connection, method, path, body=None, token=None):
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    if token:
+        headers["Authorization"] = "Bearer " + token
+    connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+    response = connection.getresponse()
+    return response.status, response.read()
+
+def login(port):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    return json.loads(call(connection, "POST", "/login", {"email": "user1@example.com", "password": "password 1"})[1])["token"]
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def load(port, token, paths, clients, seconds):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client(offset):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        mine = []
+        index = offset
+        while time.perf_counter() < deadline:
+            path = paths[index % len(paths)]
+            index += 1
+            start = time.perf_counter()
+            status, body = call(connection, "GET", path, token=token)
+            mine.append(time.perf_counter() - start)
+            if status != 200:
+                with lock:
+                    errors[0] += 1
+        with lock:
+            latencies.extend(mine)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(offset,)) for offset in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "errors": errors[0],
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100, help="users and planets to seed, characters are twice as many")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--port", type=int, default=5600)
+    parser.add_argument("--paths", default="/users/{n}/favorites,/users/{n},/people/{n},/users/favorites",
+                        help="comma separated, {n} cycles through the seeded ids")
+    args = parser.parse_args()
+
+    shared = os.getenv("DATABASE_URL")
+    directory = tempfile.mkdtemp()
+    seed(shared or f"sqlite:///{directory}/seed.db", args.size)
+    paths = [path.format(n=n) for n in range(1, args.size + 1) for path in args.paths.split(",")]
+
+    results = {}
+    for offset, mode in enumerate(("sync", "async")):
+        if shared:
+            seed(shared, args.size)
+            database_url = shared
+        else:
+            shutil.copy(f"{directory}/seed.db", f"{directory}/{mode}.db")
+            database_url = f"sqlite:///{directory}/{mode}.db"
+        server = Server(mode, database_url, args.port + offset, args.workers)
+        try:
+            results[mode] = load(server.port, login(server.port), paths, args.clients, args.seconds)
+        finally:
+            server.stop()
+        print(mode, json.dumps(results[mode]))
+
+    shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Cold start: import time, create_app() and time to first response.
+
+    pipenv run python benchmarks/startup.py --repeat 10
+    pipenv run python benchmarks/startup.py --server --mode async --preload
+
+Seeds a small temporary SQLite database with seed.py, then starts a fresh Python
+process per run and configuration and reports, median and best of --repeat runs:
+- import: importing app.py
+- create: create_app()
+- first: the first GET --path, through the test client
+- process: the whole child process, interpreter start and exit included
+
+The configurations are the API-only default (ADMIN=0, SWAGGER=0) and the full one
+(ADMIN=1, SWAGGER=1), so the difference is what an API worker saves. With --server,
+gunicorn (SERVER_MODE=--mode, one worker) is started instead, and the time from
+spawning it to the first successful response is reported.
+"""
+import argparse
+import http.client
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from seed import SRC, seed
+
+ROOT = os.path.join(HERE, "..")
+CONFIGURATIONS = {"api": {"ADMIN": "0", "SWAGGER": "0"}, "full": {"ADMIN": "1", "SWAGGER": "1"}}
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {src!r})
+import app as module
+imported = time.perf_counter()
+app = module.create_app()
+created = time.perf_counter()
+response = app.test_client().get({path!r})
+done = time.perf_counter()
+print(json.dumps({{"import": imported - start, "create": created - imported, "first": done - created, "status": response.status_code}}))
+"""
+
+def in_process(env, path):
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", CHILD.format(src=SRC, path=path)], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    timings = json.loads(output.splitlines()[-1])
+    timings["process"] = time.perf_counter() - start
+    if timings.pop("status") != 200:
+        raise SystemExit(f"GET {path} did not answer 200")
+    return timings
+
+def first_response(port, path, deadline):
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", path)
+            if connection.getresponse().status == 200:
+                return True
+        except OSError:
+            time.sleep(0.01)
+    return False
+
+def served(env, path, mode, preload, port):
+    command = ["gunicorn", "--chdir", SRC, "--bind", f"127.0.0.1:{port}", "--workers", "1", "--log-level", "warning"]
+    if preload:
+        command.append("--preload")
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=dict(env, SERVER_MODE=mode), cwd=ROOT) #cwd for gunicorn.conf.py
+    try:
+        if not first_response(port, path, time.monotonic() + 60):
+            raise SystemExit(f"gunicorn ({mode}) did not answer GET {path}")
+        return {"first": time.perf_counter() - start}
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=30)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--path", default="/people/1")
+    parser.add_argument("--server", action="store_true", help="time gunicorn from spawn to first response")
+    parser.add_argument("--mode", choices=("sync", "async"), default="sync")
+    parser.add_argument("--preload", action="store_true")
+    parser.add_argument("--port", type=int, default=3097)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    database_url = f"sqlite:///{directory}/startup.db"
+    os.environ["DATABASE_URL"] = database_url
+    sys.path.insert(0, SRC)
+    from app import create_app
+    seed(create_app(), 100, 1000, 100, 2000, log=lambda message: None)
+
+    for name, settings in CONFIGURATIONS.items():
+        env = dict(os.environ, DATABASE_URL=database_url, **settings)
+        env.pop("FLASK_RUN_FROM_CLI", None)
+        runs = [served(env, args.path, args.mode, args.preload, args.port) if args.server else in_process(env, args.path)
+                for _ in range(args.repeat)]
+        print(f"{name} ({', '.join(f'{key}={value}' for key, value in settings.items())})")
+        for step in runs[0]:
+            values = [run[step] * 1000 for run in runs]
+            print(f"  {step:<8} median {statistics.median(values):>8.1f} ms   best {min(values):>8.1f} ms")
+
+if __name__ == "__main__":
+    main()
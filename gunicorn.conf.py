@@ -0,0 +1,39 @@
+"""
+gunicorn settings, picked up from the directory gunicorn is started in (see the Procfile).
+
+SERVER_MODE selects how the API is served:
+    sync   (default) wsgi.py on sync workers, one request at a time per worker
+    async  asgi.py on uvicorn workers with an async database driver
+
+Workers, bind address etc. keep gunicorn's defaults and environment variables
+(WEB_CONCURRENCY, PORT, GUNICORN_CMD_ARGS). Each worker opens its own connection
+pool, sized by the DB_POOL_* variables of src/database.py.
+
+--preload (GUNICORN_CMD_ARGS="--preload") builds the app once in the master, so
+workers start without importing it again. create_app() opens no connections and
+post_fork below replaces the pools it created. Flask-Admin and Swagger stay off in
+the workers unless ADMIN=1 / SWAGGER=1.
+"""
+import os
+import sys
+
+mode = os.getenv("SERVER_MODE", "sync")
+if mode == "sync":
+    wsgi_app = "wsgi:application"
+elif mode == "async":
+    wsgi_app = "asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    raise RuntimeError(f"SERVER_MODE must be sync or async, not {mode!r}")
+
+def on_starting(server):
+    #events.py's in-process backend only reaches the subscribers of the worker that made the change
+    if server.cfg.workers > 1 and not os.getenv("EVENTS_URL"):
+        server.log.warning("EVENTS_URL is not set: with %d workers, the favorites event feed of a worker "
+                           "only sees the changes made in that worker", server.cfg.workers)
+
+def post_fork(server, worker):
+    #with --preload the app (and its engines) was imported by the master before forking
+    database = sys.modules.get("database")
+    if database is not None:
+        database.after_fork()
@@ -0,0 +1,33 @@
+"""room for password hashes in user.password
+
+Revision ID: 1e6b9d3c4f80
+Revises: f41c8e0b5a72
+Create Date: 2026-10-18 13:05:44.902117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1e6b9d3c4f80'
+down_revision = 'f41c8e0b5a72'
+branch_labels = None
+depends_on = None
+
+
+# existing plaintext passwords are left as they are, login() rehashes them on the next successful login
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.alter_column('password',
+               existing_type=sa.String(length=80),
+               type_=sa.String(length=256),
+               existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.alter_column('password',
+               existing_type=sa.String(length=256),
+               type_=sa.String(length=80),
+               existing_nullable=False)
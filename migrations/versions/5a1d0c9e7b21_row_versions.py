@@ -0,0 +1,32 @@
+"""add revision and updated_at to every table
+
+Revision ID: 5a1d0c9e7b21
+Revises: b4e7243007ce
+Create Date: 2026-10-18 10:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a1d0c9e7b21'
+down_revision = 'b4e7243007ce'
+branch_labels = None
+depends_on = None
+
+TABLES = ('user', 'planet', 'character', 'favorite')
+
+
+def upgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('revision', sa.Integer(), server_default='1', nullable=False))
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False))
+
+
+def downgrade():
+    for table in reversed(TABLES):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('updated_at')
+            batch_op.drop_column('revision')
@@ -0,0 +1,51 @@
+"""indexes for the admin list views
+
+Revision ID: 7b2e5f9a1c36
+Revises: 1e6b9d3c4f80
+Create Date: 2026-10-18 14:02:17.318904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b2e5f9a1c36'
+down_revision = '1e6b9d3c4f80'
+branch_labels = None
+depends_on = None
+
+# the admin sorts users by name and filters favorites by planet and character; the
+# planet/character ones also serve the favorite_count repair and the deletes' FK checks
+INDEXES = {
+    'user': ('name',),
+    'favorite': ('planet_id', 'character_id'),
+}
+
+# the admin searches users by name and email with ILIKE '%x%', see f41c8e0b5a72 for people and planets
+SEARCHABLE = {'user': ('name', 'email')}
+
+
+def upgrade():
+    for table, columns in INDEXES.items():
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for column in columns:
+                batch_op.create_index(f'ix_{table}_{column}', [column], unique=False)
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table, columns in SEARCHABLE.items():
+            for column in columns:
+                op.execute(f'CREATE INDEX ix_{table}_{column}_trgm ON "{table}" USING gin ({column} gin_trgm_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for table, columns in SEARCHABLE.items():
+            for column in columns:
+                op.execute(f'DROP INDEX IF EXISTS ix_{table}_{column}_trgm')
+
+    for table, columns in INDEXES.items():
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for column in reversed(columns):
+                batch_op.drop_index(f'ix_{table}_{column}')
@@ -0,0 +1,39 @@
+"""unique favorite per user and target, index on favorite.user_id
+
+Revision ID: 8c3e6f2a9d45
+Revises: 5a1d0c9e7b21
+Create Date: 2026-10-18 11:02:17.553961
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3e6f2a9d45'
+down_revision = '5a1d0c9e7b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # duplicates left by the old check-then-write handlers would make the unique indexes fail, keep the oldest one
+    for column in ('planet_id', 'character_id'):
+        op.execute(
+            f'DELETE FROM favorite WHERE {column} IS NOT NULL AND id NOT IN '
+            f'(SELECT min_id FROM (SELECT MIN(id) AS min_id FROM favorite WHERE {column} IS NOT NULL GROUP BY user_id, {column}) AS keep)'
+        )
+
+    with op.batch_alter_table('favorite', schema=None) as batch_op:
+        batch_op.create_index('ix_favorite_user_id', ['user_id'], unique=False)
+        batch_op.create_index('uq_favorite_user_planet', ['user_id', 'planet_id'], unique=True,
+                              postgresql_where=sa.text('planet_id IS NOT NULL'), sqlite_where=sa.text('planet_id IS NOT NULL'))
+        batch_op.create_index('uq_favorite_user_character', ['user_id', 'character_id'], unique=True,
+                              postgresql_where=sa.text('character_id IS NOT NULL'), sqlite_where=sa.text('character_id IS NOT NULL'))
+
+
+def downgrade():
+    with op.batch_alter_table('favorite', schema=None) as batch_op:
+        batch_op.drop_index('uq_favorite_user_character')
+        batch_op.drop_index('uq_favorite_user_planet')
+        batch_op.drop_index('ix_favorite_user_id')
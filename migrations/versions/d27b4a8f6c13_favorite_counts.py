@@ -0,0 +1,36 @@
+"""favorite_count on planet and character
+
+Revision ID: d27b4a8f6c13
+Revises: 8c3e6f2a9d45
+Create Date: 2026-10-18 11:40:52.306718
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd27b4a8f6c13'
+down_revision = '8c3e6f2a9d45'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table, column in (('planet', 'planet_id'), ('character', 'character_id')):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('favorite_count', sa.Integer(), server_default='0', nullable=False))
+            batch_op.create_index(f'ix_{table}_favorite_count', [sa.text('favorite_count DESC'), 'id'], unique=False)
+
+        # same as `flask repair-favorite-counts`
+        op.execute(
+            f'UPDATE "{table}" SET favorite_count = '
+            f'(SELECT COUNT(favorite.id) FROM favorite WHERE favorite.{column} = "{table}".id)'
+        )
+
+
+def downgrade():
+    for table in ('character', 'planet'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_index(f'ix_{table}_favorite_count')
+            batch_op.drop_column('favorite_count')
@@ -0,0 +1,70 @@
+"""filter and search indexes for people and planets
+
+Revision ID: f41c8e0b5a72
+Revises: d27b4a8f6c13
+Create Date: 2026-10-18 12:21:05.671430
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f41c8e0b5a72'
+down_revision = 'd27b4a8f6c13'
+branch_labels = None
+depends_on = None
+
+FILTER_INDEXES = {
+    'character': ('faction', 'race', 'gender', 'homeworld_id'),
+    'planet': ('terrain',),
+}
+
+# the search indexes below are not part of the models' metadata, env.py keeps autogenerate away from them
+SEARCHABLE = ('character', 'planet')
+
+
+def upgrade():
+    for table, columns in FILTER_INDEXES.items():
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for column in columns:
+                batch_op.create_index(f'ix_{table}_{column}', [column], unique=False)
+
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        # trigram index: serves ILIKE 'x%' and ILIKE '%x%' on name
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table in SEARCHABLE:
+            op.execute(f'CREATE INDEX ix_{table}_name_trgm ON "{table}" USING gin (name gin_trgm_ops)')
+    elif dialect == 'sqlite':
+        # external content FTS5 tables kept in sync by triggers, the trigram tokenizer allows substring MATCH
+        for table in SEARCHABLE:
+            op.execute(f"CREATE VIRTUAL TABLE {table}_fts USING fts5(name, content='{table}', content_rowid='id', tokenize='trigram')")
+            op.execute(f"INSERT INTO {table}_fts(rowid, name) SELECT id, name FROM {table}")
+            op.execute(f"""CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {table}_fts(rowid, name) VALUES (new.id, new.name);
+            END""")
+            op.execute(f"""CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {table}_fts({table}_fts, rowid, name) VALUES ('delete', old.id, old.name);
+            END""")
+            op.execute(f"""CREATE TRIGGER {table}_fts_update AFTER UPDATE OF name ON {table} BEGIN
+                INSERT INTO {table}_fts({table}_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                INSERT INTO {table}_fts(rowid, name) VALUES (new.id, new.name);
+            END""")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        for table in SEARCHABLE:
+            op.execute(f'DROP INDEX IF EXISTS ix_{table}_name_trgm')
+    elif dialect == 'sqlite':
+        for table in SEARCHABLE:
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f'DROP TRIGGER IF EXISTS {table}_fts_{trigger}')
+            op.execute(f'DROP TABLE IF EXISTS {table}_fts')
+
+    for table, columns in FILTER_INDEXES.items():
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for column in reversed(columns):
+                batch_op.drop_index(f'ix_{table}_{column}')
@@ -1,21 +1,159 @@
+"""
+Flask-Admin views.
+
+The list views only read the page they show:
+- server-side pagination, ADMIN_PAGE_SIZE rows a page (default 50). ?page_size= can
+  pick another size, up to ADMIN_MAX_PAGE_SIZE (default 500)
+- the relations a list shows (a favorite's user, planet and character, a
+  character's homeworld) are joined into the page query and shown by name
+- sorting, searching and filtering only use indexed columns (migration 7b2e5f9a1c36)
+- the edit forms look related rows up as you type instead of listing whole tables
+  in a select, and leave out the one-to-many collections (a planet's residents, a
+  user's favorites) and the columns the write paths maintain
+
+Counts: the total under the list is cached in the response cache (cache.py), tagged
+with the view's table, so it is counted again after a write to that table or once
+the entry expires. On Postgres, an unfiltered list of a table with more than
+ADMIN_ESTIMATED_COUNT_THRESHOLD rows (default 100000, 0 to always count) shows
+the planner's estimate (pg_class.reltuples) instead of a COUNT(*).
+
+Pool: with ADMIN_DB_POOL_SIZE set, the admin runs on an engine of its own, with at
+most that many connections and no overflow, so a busy admin waits for its own
+connections instead of taking the API's. Without it the admin shares db.session.
+"""
 import os
+from flask.globals import app_ctx
 from flask_admin import Admin
-from models import db, User, Planet, Character, Favorite
 from flask_admin.contrib.sqla import ModelView
+from sqlalchemy import create_engine, func, text
+from sqlalchemy.orm import Query, scoped_session, sessionmaker
+from models import db, User, Planet, Character, Favorite
+import cache
+import database
+import passwords
 
-def setup_admin(app):
-    app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
-    app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
-    admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+ESTIMATED_COUNT_THRESHOLD = 100000
+
+#the COUNT(*) under a list view; get_list() applies the search and filters to it, then calls scalar()
+class CountQuery(Query):
+    view = None
+
+    def scalar(self):
+        statement = self.statement
+        compiled = statement.compile(dialect=self.session.get_bind().dialect)
+        key = f"admin-count:{compiled}|{sorted(compiled.params.items())}"
+        tags = (self.view.model.__table__.name,)
+        count, stamp = cache.backend.get(key, tags)
+        if count is None:
+            count = self.view.estimated_count(self) if self.whereclause is None else None
+            if count is None:
+                count = super().scalar()
+            cache.backend.set(key, count, tags, stamp)
+        return count
+
+#a related row by name, rather than its __repr__
+def by_name(view, context, model, name):
+    related = getattr(model, name)
+    return related.name if related is not None else ""
 
-    
-    # Add your models here, for example this is how we add a the User model to the admin
-    admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView(Planet, db.session))
-    admin.add_view(ModelView(Character, db.session))
-    admin.add_view(ModelView(Favorite, db.session))
+class AdminView(ModelView):
+    page_size = PAGE_SIZE
+    can_set_page_size = True
+    column_default_sort = "id"
+    #maintained by the write paths (models.py), never typed in
+    form_excluded_columns = ("revision", "updated_at", "favorite_count")
 
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        #page_size comes from the query string, 0 would mean the whole table
+        page_size = min(page_size or self.page_size, MAX_PAGE_SIZE)
+        return super().get_list(page, sort_column, sort_desc, search, filters, execute=execute, page_size=page_size)
 
+    def get_count_query(self):
+        query = CountQuery(func.count("*"), self.session()).select_from(self.model)
+        query.view = self
+        return query
 
-    # You can duplicate that line to add mew models
-    # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
+    #None unless the table is big enough for the planner's estimate to be worth it
+    def estimated_count(self, query):
+        if not ESTIMATED_COUNT_THRESHOLD or query.session.get_bind().dialect.name != "postgresql":
+            return None
+        #-1 (never analyzed, Postgres 14+) or NULL falls through to COUNT(*)
+        estimate = query.session.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)"),
+            {"table": f'"{self.model.__table__.name}"'},
+        ).scalar()
+        if estimate is None or estimate < ESTIMATED_COUNT_THRESHOLD:
+            return None
+        return estimate
+
+class UserView(AdminView):
+    column_list = ("id", "name", "email", "is_active", "updated_at")
+    column_sortable_list = ("id", "name", "email")
+    column_searchable_list = ("name", "email")
+    column_filters = ("is_active",)
+    form_excluded_columns = AdminView.form_excluded_columns + ("favorites",)
+
+    #passwords typed in the admin are stored hashed, like the ones login() rehashes
+    def on_model_change(self, form, model, is_created):
+        if model.password and not passwords.is_hashed(model.password):
+            model.password = passwords.hash_password(model.password)
+
+class PlanetView(AdminView):
+    column_list = ("id", "name", "terrain", "location", "favorite_count", "updated_at")
+    column_sortable_list = ("id", "name", "terrain", "favorite_count")
+    column_searchable_list = ("name",)
+    column_filters = ("terrain",)
+    form_excluded_columns = AdminView.form_excluded_columns + ("residents", "favorites")
+
+class CharacterView(AdminView):
+    column_list = ("id", "name", "faction", "gender", "race", "homeworld", "favorite_count", "updated_at")
+    column_sortable_list = ("id", "name", "faction", "gender", "race", "favorite_count", ("homeworld", "homeworld.name"))
+    column_searchable_list = ("name",)
+    column_filters = ("faction", "gender", "race")
+    column_formatters = {"homeworld": by_name}
+    form_excluded_columns = AdminView.form_excluded_columns + ("favorites",)
+    form_ajax_refs = {"homeworld": {"fields": ("name",), "page_size": 10}}
+
+class FavoriteView(AdminView):
+    column_list = ("id", "user", "planet", "character", "updated_at")
+    column_sortable_list = ("id",)
+    column_filters = ("user_id", "planet_id", "character_id")
+    column_formatters = {"user": by_name, "planet": by_name, "character": by_name}
+    form_ajax_refs = {
+        "user": {"fields": ("name", "email"), "page_size": 10},
+        "planet": {"fields": ("name",), "page_size": 10},
+        "character": {"fields": ("name",), "page_size": 10},
+    }
+
+#the session of the admin views, on the admin's own pool (app.extensions["admin_engine"]) when ADMIN_DB_POOL_SIZE is set
+def admin_session(app):
+    size = int(app.config.get("ADMIN_DB_POOL_SIZE", os.getenv("ADMIN_DB_POOL_SIZE", 0)))
+    if not size:
+        return db.session
+    url = app.config["SQLALCHEMY_DATABASE_URI"]
+    options = database.engine_options(app, url)
+    if "poolclass" in options:
+        options.update(pool_size=size, max_overflow=0)
+    engine = app.extensions["admin_engine"] = create_engine(url, **options)
+    database.track(engine)
+    #one session per app context, like db.session
+    session = scoped_session(sessionmaker(bind=engine), scopefunc=lambda: id(app_ctx._get_current_object()))
+    app.teardown_appcontext(lambda error: session.remove())
+    return session
+
+def setup_admin(app):
+    global PAGE_SIZE, MAX_PAGE_SIZE, ESTIMATED_COUNT_THRESHOLD
+    app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
+    app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
+    PAGE_SIZE = int(app.config.get("ADMIN_PAGE_SIZE", os.getenv("ADMIN_PAGE_SIZE", 50)))
+    MAX_PAGE_SIZE = int(app.config.get("ADMIN_MAX_PAGE_SIZE", os.getenv("ADMIN_MAX_PAGE_SIZE", 500)))
+    ESTIMATED_COUNT_THRESHOLD = int(app.config.get("ADMIN_ESTIMATED_COUNT_THRESHOLD", os.getenv("ADMIN_ESTIMATED_COUNT_THRESHOLD", 100000)))
+    session = admin_session(app)
+    admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
+    AdminView.page_size = PAGE_SIZE
+    admin.add_view(UserView(User, session))
+    admin.add_view(PlanetView(Planet, session))
+    admin.add_view(CharacterView(Character, session))
+    admin.add_view(FavoriteView(Favorite, session))
@@ -1,204 +1,359 @@
 """
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
+
+create_app() builds the app. What an API worker doesn't need is left out unless
+configured, which keeps cold starts (scale-to-zero, worker restarts) short:
+- Flask-Admin: ADMIN=1. On by default under the flask CLI (flask run), off in the
+  workers gunicorn/uvicorn start
+- Swagger: SWAGGER=1 serves the spec built from the routes at /swagger.json
+- Flask-Migrate (flask db ...) and flask catalogue are only registered under the
+  flask CLI
+
+create_app() opens no database connection, so it is safe to run in the gunicorn
+master with --preload: the pools are created empty and gunicorn.conf.py's post_fork
+replaces them in each worker. benchmarks/startup.py measures import time and time
+to first response.
 """
 import os
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
+import re
+import click
+from flask import Blueprint, Flask, current_app, request, jsonify
 from flask_cors import CORS
 from utils import APIException, generate_sitemap
-from admin import setup_admin
-from models import db, User, Character, Planet, Favorite
+from models import db, User, Character, Planet
+import queries
+import pagination
+import streaming
+import cache
+from etags import conditional
 from flask_jwt_extended import JWTManager
 from flask_jwt_extended import create_access_token
-from flask_jwt_extended import get_jwt_identity
+from flask_jwt_extended import current_user
 from flask_jwt_extended import jwt_required
-
-#from models import Person
-
-app = Flask(__name__)
-# Setup the Flask-JWT-Extended extension
-app.config["JWT_SECRET_KEY"] = "super-secret"  # Change this!
-jwt = JWTManager(app)
-
-app.url_map.strict_slashes = False
-
-db_url = os.getenv("DATABASE_URL")
-if db_url is not None:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
+import auth
+import favorites
+import passwords
+import database
+import replicas
+import profiling
+import serializers
+import compression
+import batch
+import events
+
+#every table the catalogue payloads are built from, see serialize() in models.py
+CATALOGUE_TABLES = ("planet", "character", "favorite", "user")
+
+#cli_group=None: the commands below are top level (flask repair-favorite-counts), not under flask api
+api = Blueprint("api", __name__, cli_group=None)
+
+def enabled(app, name, default):
+    return str(app.config.get(name, os.getenv(name, default))).lower() in ("1", "true", "yes", "on")
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(config or {})
+    # Setup the Flask-JWT-Extended extension
+    app.config.setdefault("JWT_SECRET_KEY", "super-secret")  # Change this!
+    jwt = JWTManager(app)
+    auth.init_app(app, jwt)
+
+    app.url_map.strict_slashes = False
+
+    if "SQLALCHEMY_DATABASE_URI" not in app.config:
+        db_url = os.getenv("DATABASE_URL")
+        if db_url is not None:
+            app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
+        else:
+            app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    #set by the flask command before it loads the app
+    cli = os.environ.get("FLASK_RUN_FROM_CLI") == "true"
+
+    database.init_app(app)
+    db.init_app(app)
+    database.register(app)
+    CORS(app)
+    if enabled(app, "ADMIN", "1" if cli else "0"):
+        import admin #flask_admin and wtforms are a good part of the import time
+        admin.setup_admin(app)
+    cache.init_app(app)
+    compression.init_app(app)
+    passwords.init_app(app)
+    batch.init_app(app)
+    events.init_app(app)
+    replicas.init_app(app)
+    #before profiling, which times the provider's dumps()
+    serializers.init_app(app)
+    profiling.init_app(app)
+
+    app.register_blueprint(api)
+    if enabled(app, "SWAGGER", "0"):
+        app.add_url_rule("/swagger.json", "swagger_spec", swagger_spec)
+    if cli:
+        from flask_migrate import Migrate #alembic, only needed by flask db
+        import catalogue
+        Migrate(app, db)
+        #bulk import/export of planets, characters and favorites: $ flask catalogue import|export <kind> <file>
+        app.cli.add_command(catalogue.cli)
+    return app
+
+#the Swagger 2.0 spec of the routes, built on the first request; flask_swagger only describes routes
+#with YAML in their docstring, so every API route starts from a bare operation named after its endpoint
+def swagger_spec():
+    spec = current_app.extensions.get("swagger_spec")
+    if spec is None:
+        from flask_swagger import swagger
+        paths = {}
+        for rule in current_app.url_map.iter_rules():
+            if rule.endpoint.startswith(api.name + "."):
+                path = re.sub(r"<(?:[^<>]*:)?([^<>]*)>", r"{\1}", rule.rule)
+                parameters = [{"name": name, "in": "path", "required": True, "type": "string"} for name in sorted(rule.arguments)]
+                for method in rule.methods - {"HEAD", "OPTIONS"}:
+                    paths.setdefault(path, {})[method.lower()] = {
+                        "summary": rule.endpoint, "parameters": parameters, "responses": {"200": {"description": "OK"}},
+                    }
+        template = {"info": {"title": "Star Wars API", "version": "1.0"}, "paths": paths}
+        spec = current_app.extensions["swagger_spec"] = swagger(current_app, template=template)
+    return jsonify(spec), 200
 
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
+@api.app_errorhandler(APIException)
 def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
 # generate sitemap with all your endpoints
-@app.route('/')
+@api.route('/')
 def sitemap():
-    return generate_sitemap(app)
+    return generate_sitemap(current_app)
 
 #gets all users
-@app.route('/users', methods=['GET'])
+@api.route('/users', methods=['GET'])
 def get_users():
-    users = User.query.all()
-    return jsonify([user.serialize() for user in users],200)
+    if pagination.requested(pagination.USERS):
+        return pagination.page(pagination.USERS)
+    return jsonify(serializers.users(db.session),200)
 
 #gets specific user
-@app.route('/users/<int:id>', methods=['GET'])
+@api.route('/users/<int:id>', methods=['GET'])
+@conditional(User)
 def get_user(id):
 
-    user = User.query.get(id)
+    user = queries.get_user(id)
     
     return jsonify(user.serialize()), 200
 
 #gets favorite of specific user
-@app.route('/users/<int:id>/favorites', methods=['GET'])
+@api.route('/users/<int:id>/favorites', methods=['GET'])
+@conditional(User)
 def get_user_favorites(id):
 
-    user = User.query.get(id)
-    favorites = user.favorites
-
-    return jsonify([favorite.serialize() for favorite in favorites]), 200
+    return jsonify(serializers.user_favorites(db.session, id)), 200
 
 #gets all characters
-@app.route('/people', methods=["GET"])
+@api.route('/people', methods=["GET"])
+@cache.cached(*CATALOGUE_TABLES, unless=streaming.requested)
 def get_people():
-    characters = Character.query.all()
-    return jsonify([character.serialize() for character in characters]), 200
+    if batch.ids_requested():
+        return jsonify(batch.multi_get(Character, queries.character_graph())), 200
+    if streaming.requested():
+        return streaming.stream(pagination.PEOPLE)
+    if pagination.requested(pagination.PEOPLE):
+        return pagination.page(pagination.PEOPLE)
+    return jsonify(serializers.characters(db.session)), 200
 
 #gets specific character
-@app.route('/people/<int:id>', methods=["GET"])
+@api.route('/people/<int:id>', methods=["GET"])
+@conditional(Character)
+@cache.cached(*CATALOGUE_TABLES)
 def get_person(id):
-    character = Character.query.get(id)
+    character = queries.get_character(id)
     return jsonify(character.serialize()), 200
 
 #gets all planets
-@app.route('/planets', methods=["GET"])
+@api.route('/planets', methods=["GET"])
+@cache.cached(*CATALOGUE_TABLES, unless=streaming.requested)
 def get_planets():
-    planets = Planet.query.all()
-    return jsonify([planet.serialize() for planet in planets]), 200
+    if batch.ids_requested():
+        return jsonify(batch.multi_get(Planet, queries.planet_graph())), 200
+    if streaming.requested():
+        return streaming.stream(pagination.PLANETS)
+    if pagination.requested(pagination.PLANETS):
+        return pagination.page(pagination.PLANETS)
+    return jsonify(serializers.planets(db.session)), 200
 
 #gets specific planet
-@app.route('/planets/<int:id>', methods=["GET"])
+@api.route('/planets/<int:id>', methods=["GET"])
+@conditional(Planet)
+@cache.cached(*CATALOGUE_TABLES)
 def get_planet(id):
-    planet = Planet.query.get(id)
+    planet = queries.get_planet(id)
     return jsonify(planet.serialize()), 200
 
+#several GET requests in one round trip, each answered with its own status, see batch.py
+@api.route("/batch", methods=["POST"])
+def run_batch():
+    items = batch.parse_requests(request.get_json(silent=True))
+    return batch.run(items), 200, {"Content-Type": "application/json"}
+
 #logs a user and returns access token with identity of logged user
-@app.route("/login", methods=["POST"])
+@api.route("/login", methods=["POST"])
 def login():
     #from request object, store email and password in variables, else None.
     email = request.json.get("email", None)
     password = request.json.get("password", None)
 
-    # Query your database for email and password, else None.
-    user = User.query.filter_by(email=email, password=password).first()
+    if not isinstance(email, str) or not isinstance(password, str):
+        return jsonify({"msg": "Bad email or password"}), 401
+
+    #refuse before doing any hashing work
+    if not passwords.limiter.allow(email.lower()):
+        return jsonify({"msg": "Too many login attempts, try again later"}), 429
+
+    # Query your database for the email, then check the password against its hash in the KDF pool
+    user = User.query.filter_by(email=email).first()
+    try:
+        valid = passwords.verify(user.password if user else None, password)
+    except passwords.PoolBusy:
+        return jsonify({"msg": "Too many logins in progress, try again later"}), 503, {"Retry-After": "1"}
 
-    if user is None:
-        # The user was not found on the database
+    if not valid:
+        # The user was not found on the database or the password is wrong
         return jsonify({"msg": "Bad email or password"}), 401 
+
+    #plaintext rows from before hashing, or hashes made with an older cost.
+    #a core UPDATE: the password isn't in any payload, so the user's revision (ETag) and cache entries stay
+    if passwords.needs_rehash(user.password):
+        try:
+            db.session.connection().execute(db.update(User).where(User.id == user.id).values(password=passwords.rehash(password)))
+            db.session.commit()
+        except passwords.PoolBusy:
+            pass #the login itself succeeded, the rehash waits for the next one
     
     # Create a new token with the user id inside
-    access_token = create_access_token(identity=user.email)
+    access_token = create_access_token(identity=str(user.id))
     return jsonify({ "token": access_token, "user_id": user.id }) #
 
-#gets specific logged in user's favorites, knows which one by using the get_jwt_identity function.
-@app.route("/users/favorites", methods=["GET"])
+#gets specific logged in user's favorites, knows which one from current_user (resolved by auth.load_caller).
+@api.route("/users/favorites", methods=["GET"])
 @jwt_required() #will return "msg": "Missing Authorization Header" if it is not present. 
 
 def get_current_user_favorites():
-    # Access the identity of the current user with get_jwt_identity
-    current_user_email = get_jwt_identity()
-    current_user = User.query.filter_by(email=current_user_email).first()
-    return jsonify(current_user.serialize()), 200
+    user = queries.get_user(current_user.id)
+    return jsonify(user.serialize()), 200
 
 #creates new favorite instance with the user from the identity and the id of the planet sent as query parameter
-@app.route("/favorite/planet/<int:planet_id>", methods=["POST", "DELETE"])
+@api.route("/favorite/planet/<int:planet_id>", methods=["POST", "DELETE"])
 @jwt_required()
 
 def favorite_planet_to_current_user(planet_id):
-    current_user_email = get_jwt_identity() #will provide email of currently logged user, accessible through the header's token
-    current_user = User.query.filter_by(email=current_user_email).one_or_none()
-
-    if current_user == None:
-        return jsonify({"msg": "User not found"}), 404
-
-    planet_to_favorite = Planet.query.filter_by(id=planet_id).one_or_none()
+    #current_user comes from the header's token, an unknown user was already answered with 404 by auth.caller_not_found
+    if request.method == "POST":
+        planet_name, changed = favorites.add("planet", current_user.id, planet_id)
+    else: #request.method == "DELETE"
+        planet_name, changed = favorites.remove("planet", current_user.id, planet_id)
 
-    if planet_to_favorite == None:
+    if planet_name is None:
         return jsonify({"msg": "Planet not found"}), 404
-    
-    existing_favorite = Favorite.query.filter_by(user_id=current_user.id, planet_id=planet_to_favorite.id).one_or_none()
 
     if request.method == "POST":
-        if existing_favorite:
-            return jsonify({"msg": f"CANNOT FAVORITE, Planet {planet_to_favorite.name}is already a favorite for user {current_user.email} "}), 400
-    
-        #current_user not None, planet_to_favorite not None AND existing_favorite is None, then:
-        new_favorite_planet = Favorite(user=current_user, planet=planet_to_favorite)
-        db.session.add(new_favorite_planet) # add new favorite object to the Favorite table
+        if not changed:
+            return jsonify({"msg": f"CANNOT FAVORITE, Planet {planet_name}is already a favorite for user {current_user.email} "}), 400
         db.session.commit()  # Similar to the Git commit, what this does is save all the changes you have made 
-        return jsonify({"msg": f"Planet {planet_to_favorite.name}SUCCESSFULLY made a favorite for user {current_user.email}"}), 200
-    
+        return jsonify({"msg": f"Planet {planet_name}SUCCESSFULLY made a favorite for user {current_user.email}"}), 200
+
     else: #request.method == "DELETE"
-        if existing_favorite == None:
-            return jsonify({"msg": f"CANNOT DELETE, Planet {planet_to_favorite.name}is CURRENTLY NOT a favorite for user {current_user.email} "}), 400
-    
-        #current_user not None, planet_to_favorite not None AND existing_favorite is NOT None, then:
-        db.session.delete(existing_favorite) # add new favorite object to the Favorite table
-        db.session.commit()  # Similar to the Git commit, what this does is save all the changes you have made 
-        return jsonify({"msg": f"Planet {planet_to_favorite.name}SUCCESSFULLY DELETED from favorite for user {current_user.email}"}), 200
+        if not changed:
+            return jsonify({"msg": f"CANNOT DELETE, Planet {planet_name}is CURRENTLY NOT a favorite for user {current_user.email} "}), 400
+        db.session.commit()
+        return jsonify({"msg": f"Planet {planet_name}SUCCESSFULLY DELETED from favorite for user {current_user.email}"}), 200
 
     
 #creates new favorite instance with the user from the identity and the id of the character sent as query parameter  
-@app.route("/favorite/people/<int:people_id>", methods=["POST", "DELETE"])
+@api.route("/favorite/people/<int:people_id>", methods=["POST", "DELETE"])
 @jwt_required()
 
 def favorite_character_to_current_user(people_id):
-    #identify user
-    current_user_email = get_jwt_identity()
-    current_user = User.query.filter_by(email=current_user_email).one_or_none()
-
-    if current_user == None:
-        return jsonify({"msg": "User not found"}), 404
-
-    #identify character
-    character_to_favorite = Character.query.filter_by(id=people_id).one_or_none()
+    #the user is current_user, resolved from the token; favorites.add/remove look the character up in the same statement
+    if request.method == "POST":
+        character_name, changed = favorites.add("character", current_user.id, people_id)
+    else: #request.method == "DELETE"
+        character_name, changed = favorites.remove("character", current_user.id, people_id)
 
-    if character_to_favorite == None:
+    if character_name is None:
         return jsonify({"msg": "character not found"}), 404
 
-    #check user already has character as favorite
-    existing_favorite = Favorite.query.filter_by(user_id=current_user.id, character_id=character_to_favorite.id).one_or_none()
-
     if request.method == "POST":
-        if existing_favorite:
-            return jsonify({"msg": f"CANNOT FAVORITE, Character {character_to_favorite.name} is already a favorite for user {current_user.email} "}), 400
-
-        #finally, create new favorite
-        new_favorite_character = Favorite(user=current_user, character=character_to_favorite)
-        db.session.add(new_favorite_character)
+        if not changed:
+            return jsonify({"msg": f"CANNOT FAVORITE, Character {character_name} is already a favorite for user {current_user.email} "}), 400
         db.session.commit()
-        return jsonify({"msg": f"Character {character_to_favorite.name} SUCCESSFULLY made a favorite for user {current_user.email}"}), 200
-    
+        return jsonify({"msg": f"Character {character_name} SUCCESSFULLY made a favorite for user {current_user.email}"}), 200
+
     else: #request.method == "DELETE"
-        if existing_favorite == None:
-            return jsonify({"msg": f"CANNOT DELETE, Character {character_to_favorite.name} is CURRENTLY NOT a favorite for user {current_user.email} "}), 400
-    
-        #current_user not None, planet_to_favorite not None AND existing_favorite is NOT None, then:
-        db.session.delete(existing_favorite) # add new favorite object to the Favorite table
-        db.session.commit()  # Similar to the Git commit, what this does is save all the changes you have made 
-        return jsonify({"msg": f"Character {character_to_favorite.name} SUCCESSFULLY DELETED from favorite for user {current_user.email}"}), 200
+        if not changed:
+            return jsonify({"msg": f"CANNOT DELETE, Character {character_name} is CURRENTLY NOT a favorite for user {current_user.email} "}), 400
+        db.session.commit()
+        return jsonify({"msg": f"Character {character_name} SUCCESSFULLY DELETED from favorite for user {current_user.email}"}), 200
+
+#adds and removes several favorites of the logged in user in one transaction, answering per operation
+@api.route("/users/favorites", methods=["PATCH"])
+@jwt_required()
+
+def batch_favorites_of_current_user():
+    operations = favorites.parse_operations(request.get_json(silent=True))
+    outcomes = favorites.apply_batch(current_user, operations)
+    db.session.commit()
+    results = [
+        {"op": op, "type": "planet" if kind == "planet" else "people", "id": id, "status": status, "msg": msg}
+        for (op, kind, id), (status, msg) in zip(operations, outcomes)
+    ]
+    return jsonify({"results": results}), 200
+
+#Server-Sent Events of the logged in user's favorite changes (events.py). This sync version answers with
+#the events since Last-Event-ID and ends, EventSource reconnects after the retry delay; asgi.py keeps it open
+@api.route("/users/favorites/events", methods=["GET"])
+@jwt_required(locations=["headers", "query_string"]) #EventSource cannot send headers: ?jwt=<token>
+
+def favorite_events_of_current_user():
+    lines = events.opening(current_user.id, events.last_event_id(request.headers, request.args))[0]
+    return "".join(lines), 200, {"Content-Type": "text/event-stream", **events.HEADERS}
+
+#most favorited planets or people, ?limit=N (default 10, at most 100)
+@api.route("/leaderboard/<any(planets, people):collection>", methods=["GET"])
+@cache.cached(*CATALOGUE_TABLES)
+def get_leaderboard(collection):
+    #?limit=abc is a 400, as for the paginated lists, not the default
+    limit = pagination.parse_limit(default=10, maximum=100)
+    kind = "planet" if collection == "planets" else "character"
+    return jsonify(favorites.leaderboard(kind, limit)), 200
+
+#database reachability and connection pool statistics (checkouts, waits, timeouts, reconnects)
+@api.route("/health/db", methods=["GET"])
+def database_health():
+    body, status = database.health(db.engine)
+    if replicas.enabled():
+        body["replicas"] = replicas.replicas.status()
+    if "admin_engine" in current_app.extensions:
+        body["admin_pool"] = database.pool_stats(current_app.extensions["admin_engine"].pool)
+    body["events"] = events.broker.stats()
+    return jsonify(body), status
+
+#per route request histograms (duration, SQL, serialize, JSON, size) in the Prometheus text format
+@api.route("/metrics", methods=["GET"])
+def get_metrics():
+    return profiling.metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+#recomputes Planet/Character.favorite_count from the favorite table: $ flask repair-favorite-counts
+@api.cli.command("repair-favorite-counts")
+def repair_favorite_counts():
+    fixed = favorites.repair_counts()
+    db.session.commit()
+    for table, count in fixed.items():
+        click.echo(f"{table}: {count} rows fixed")
 
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
+    app = create_app()
     app.run(host='0.0.0.0', port=PORT, debug=False)
@@ -0,0 +1,407 @@
+"""
+ASGI entry point, the async serving mode of the API (SERVER_MODE=async, see gunicorn.conf.py).
+
+    uvicorn asgi:app --app-dir src --port 3000
+
+The routes of app.py that do most of the traffic are answered here with an async
+database driver, so a worker keeps serving other requests while one waits on the
+database: GET /people, /planets, /users (and their /<id>), /users/<id>/favorites,
+/users/favorites, POST /login and POST/DELETE /favorite/planet|people/<id>. They reuse
+the query graphs of queries.py, serialize(), the column tuple serializers of
+serializers.py (through run_sync), the response cache, the ETags, the compression
+settings, the JWT settings, passwords.py and favorites.add/remove, and answer with the same bodies and
+status codes as the Flask routes (tests/test_serving.py compares them).
+
+Everything else is passed on to the Flask app, which runs in a thread pool as it
+would under a sync worker: Flask-Admin, the sitemap, PATCH /users/favorites, the
+leaderboards, any request with a query string (pagination, streaming, filters,
+search) and any request for NDJSON (Accept: application/x-ndjson).
+
+GET /users/favorites/events, the Server-Sent Events feed of events.py, stays open
+here: each subscriber is a coroutine waiting on its buffer rather than a thread, and
+the commits of the Flask app's threads wake it up with call_soon_threadsafe.
+
+The async engine points at the same database as the Flask app (SQLALCHEMY_DATABASE_URI)
+through aiosqlite or asyncpg, with the pool settings of database.py.
+"""
+import asyncio
+import re
+from contextlib import asynccontextmanager
+from a2wsgi import WSGIMiddleware
+from jwt.exceptions import PyJWTError
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Match, Mount, Route
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag
+from flask_jwt_extended import create_access_token, decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException, NoAuthorizationError, InvalidHeaderError, WrongTokenError
+from app import create_app, CATALOGUE_TABLES
+from models import db, User, Character, Planet
+import queries
+import cache
+import etags
+import auth
+import favorites
+import passwords
+import serializers
+import compression
+import database
+import events
+import streaming
+
+flask_app = create_app()
+
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+def async_url(url):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f"The async serving mode supports SQLite and Postgres, not {backend}")
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+    if "sslmode" in url.query:
+        #libpq's sslmode is asyncpg's ssl
+        url = url.update_query_dict({"ssl": url.query["sslmode"]}).difference_update_query(["sslmode"])
+    return url
+
+def create_engine():
+    url = async_url(flask_app.config["SQLALCHEMY_DATABASE_URI"])
+    return create_async_engine(url, **database.engine_options(flask_app, url))
+
+#the Flask rule of an endpoint (/people/<int:id>), the route label of the metrics
+RULES = {rule.endpoint: rule.rule for rule in flask_app.url_map.iter_rules()}
+
+engine = create_engine()
+database.track(engine.sync_engine)
+sessions = async_sessionmaker(engine, expire_on_commit=False)
+
+#encoded by the Flask app's JSON provider, so the bodies are byte for byte those of jsonify()
+def respond(obj, status=200, headers=None):
+    body = flask_app.json.response(obj)
+    return Response(body.get_data(), status, headers, media_type=body.mimetype)
+
+def from_flask(response):
+    return Response(response.get_data(), response.status_code, dict(response.headers))
+
+#cache.cached() for the async routes, the entries and the counters are shared with the Flask routes
+async def cached(endpoint, request, build):
+    key = cache.key_for(endpoint, request.url.path)
+    hit, stamp = cache.backend.get(key, CATALOGUE_TABLES)
+    cache.count(RULES[endpoint], hit is not None)
+    if hit is not None:
+        body, status, mimetype = hit
+        response = Response(body, status, {"X-Cache": "HIT"}, media_type=mimetype)
+    else:
+        response = await build()
+        if response.status_code != 200:
+            return response
+        cache.backend.set(key, (response.body, response.status_code, response.media_type), CATALOGUE_TABLES, stamp)
+        response.headers["X-Cache"] = "MISS"
+    #the compressed variant is cached next to the entry, as for the Flask routes
+    encoding = compression.negotiate(request.headers.get("accept-encoding"))
+    if encoding is None or len(response.body) < compression.MIN_SIZE:
+        return response
+    body = compression.cached_variant(key, CATALOGUE_TABLES, stamp, response.body, encoding)
+    headers = {"X-Cache": response.headers["X-Cache"], "Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+    return Response(body, response.status_code, headers, media_type=response.media_type)
+
+#etags.conditional() for the async routes
+async def conditional(session, request, model, build):
+    id = request.path_params["id"]
+    row = (await session.execute(etags.validators_statement(model, id))).one_or_none()
+    etag, last_modified = etags.from_row(model, id, row)
+    if etag is None:
+        return respond({"msg": f"{model.__name__} not found"}, 404)
+    headers = {"ETag": quote_etag(etag, weak=True), "Last-Modified": http_date(last_modified)}
+    if etags.matches(etag, last_modified, parse_etags(request.headers.get("if-none-match")), parse_date(request.headers.get("if-modified-since"))):
+        return Response(status_code=304, headers=headers)
+    response = await build()
+    if response.status_code == 200:
+        response.headers.update(headers)
+    return response
+
+#the token lookup of flask_jwt_extended (headers location), with the same error messages
+def encoded_token(header):
+    name, kind = flask_app.config["JWT_HEADER_NAME"], flask_app.config["JWT_HEADER_TYPE"]
+    header = header.strip().strip(",")
+    if not header:
+        raise NoAuthorizationError(f"Missing {name} Header")
+    values = [value for value in re.split(r",\s*", header) if value and value.split()[0] == kind]
+    if len(values) != 1:
+        raise NoAuthorizationError(f"Missing '{kind}' type in '{name}' header. Expected '{name}: {kind} <JWT>'")
+    parts = values[0].split()
+    if len(parts) != 2:
+        raise InvalidHeaderError(f"Bad {name} header. Expected '{name}: {kind} <JWT>'")
+    return parts[1]
+
+#@jwt_required() for the async routes; errors are answered by the Flask app's JWT error handlers.
+#query_string=True also takes the token from ?jwt=, like locations=["headers", "query_string"].
+#returns (caller, None) or (None, error response)
+async def current_caller(request, session, query_string=False):
+    with flask_app.test_request_context():
+        try:
+            header = request.headers.get(flask_app.config["JWT_HEADER_NAME"], "")
+            token = request.query_params.get(flask_app.config["JWT_QUERY_STRING_NAME"]) if query_string and not header else None
+            claims = decode_token(token or encoded_token(header))
+            if claims["type"] != "access":
+                raise WrongTokenError("Only non-refresh tokens are allowed")
+        except (JWTExtendedException, PyJWTError) as error:
+            return None, from_flask(flask_app.make_response(flask_app.handle_user_exception(error)))
+    identity = str(claims[flask_app.config["JWT_IDENTITY_CLAIM"]])
+    caller, stamp = auth.users.get(identity)
+    if caller is not None:
+        return caller, None
+    user = (await session.execute(auth.user_statement(identity))).scalar_one_or_none()
+    if user is None:
+        return None, respond({"msg": "User not found"}, 404)
+    return auth.remember(identity, user, stamp), None
+
+async def get_users(request):
+    async with sessions() as session:
+        users = await session.run_sync(serializers.users)
+        #the Flask route hands 200 to jsonify() as a second item, so it ends up in the body
+        return respond([users, 200])
+
+async def get_user(request):
+    async with sessions() as session:
+        async def build():
+            user = await session.get(User, request.path_params["id"], options=queries.user_graph())
+            return respond(user.serialize())
+        return await conditional(session, request, User, build)
+
+async def get_user_favorites(request):
+    async with sessions() as session:
+        async def build():
+            return respond(await session.run_sync(serializers.user_favorites, request.path_params["id"]))
+        return await conditional(session, request, User, build)
+
+async def get_people(request):
+    async def build():
+        async with sessions() as session:
+            return respond(await session.run_sync(serializers.characters))
+    return await cached("api.get_people", request, build)
+
+async def get_person(request):
+    async with sessions() as session:
+        async def build():
+            character = await session.get(Character, request.path_params["id"], options=queries.character_graph())
+            return respond(character.serialize())
+        return await conditional(session, request, Character, lambda: cached("api.get_person", request, build))
+
+async def get_planets(request):
+    async def build():
+        async with sessions() as session:
+            return respond(await session.run_sync(serializers.planets))
+    return await cached("api.get_planets", request, build)
+
+async def get_planet(request):
+    async with sessions() as session:
+        async def build():
+            planet = await session.get(Planet, request.path_params["id"], options=queries.planet_graph())
+            return respond(planet.serialize())
+        return await conditional(session, request, Planet, lambda: cached("api.get_planet", request, build))
+
+async def login(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    email = body.get("email", None) if isinstance(body, dict) else None
+    password = body.get("password", None) if isinstance(body, dict) else None
+
+    if not isinstance(email, str) or not isinstance(password, str):
+        return respond({"msg": "Bad email or password"}, 401)
+    if not passwords.limiter.allow(email.lower()):
+        return respond({"msg": "Too many login attempts, try again later"}, 429)
+
+    async with sessions() as session:
+        user = (await session.execute(db.select(User).filter_by(email=email).limit(1))).scalar_one_or_none()
+        try:
+            valid = await passwords.verify_async(user.password if user else None, password)
+        except passwords.PoolBusy:
+            return respond({"msg": "Too many logins in progress, try again later"}, 503, {"Retry-After": "1"})
+        if not valid:
+            return respond({"msg": "Bad email or password"}, 401)
+
+        if passwords.needs_rehash(user.password):
+            try:
+                #a core UPDATE, as in the Flask route
+                connection = await session.connection()
+                await connection.execute(db.update(User).where(User.id == user.id).values(password=await passwords.rehash_async(password)))
+                await session.commit()
+            except passwords.PoolBusy:
+                pass
+
+        with flask_app.app_context():
+            access_token = create_access_token(identity=str(user.id))
+        return respond({"token": access_token, "user_id": user.id})
+
+async def get_current_user_favorites(request):
+    async with sessions() as session:
+        caller, error = await current_caller(request, session)
+        if error is not None:
+            return error
+        user = await session.get(User, caller.id, options=queries.user_graph())
+        return respond(user.serialize())
+
+#the messages of the Flask routes, spacing included
+FAVORITE_MESSAGES = {
+    "planet": {
+        None: "Planet not found",
+        ("POST", False): "CANNOT FAVORITE, Planet {name}is already a favorite for user {email} ",
+        ("POST", True): "Planet {name}SUCCESSFULLY made a favorite for user {email}",
+        ("DELETE", False): "CANNOT DELETE, Planet {name}is CURRENTLY NOT a favorite for user {email} ",
+        ("DELETE", True): "Planet {name}SUCCESSFULLY DELETED from favorite for user {email}",
+    },
+    "character": {
+        None: "character not found",
+        ("POST", False): "CANNOT FAVORITE, Character {name} is already a favorite for user {email} ",
+        ("POST", True): "Character {name} SUCCESSFULLY made a favorite for user {email}",
+        ("DELETE", False): "CANNOT DELETE, Character {name} is CURRENTLY NOT a favorite for user {email} ",
+        ("DELETE", True): "Character {name} SUCCESSFULLY DELETED from favorite for user {email}",
+    },
+}
+
+async def toggle_favorite(request, kind):
+    async with sessions() as session:
+        caller, error = await current_caller(request, session)
+        if error is not None:
+            return error
+        write = favorites.add if request.method == "POST" else favorites.remove
+        #favorites.add/remove are sync, run_sync hands them the session under the AsyncSession
+        name, changed = await session.run_sync(
+            lambda sync_session: write(kind, caller.id, request.path_params["id"], session=sync_session)
+        )
+        messages = FAVORITE_MESSAGES[kind]
+        if name is None:
+            return respond({"msg": messages[None]}, 404)
+        if changed:
+            await session.commit()
+        return respond({"msg": messages[request.method, changed].format(name=name, email=caller.email)}, 200 if changed else 400)
+
+async def favorite_planet(request):
+    return await toggle_favorite(request, "planet")
+
+async def favorite_character(request):
+    return await toggle_favorite(request, "character")
+
+#events.py's feed, kept open: the missed events first, then the new ones as they are committed
+async def favorite_events(request):
+    async with sessions() as session:
+        caller, error = await current_caller(request, session, query_string=True)
+    if error is not None:
+        return error
+    last_id = events.last_event_id(request.headers, request.query_params)
+    loop = asyncio.get_running_loop()
+
+    async def stream():
+        ready = asyncio.Event()
+        subscriber = events.broker.subscribe(caller.id, lambda: loop.call_soon_threadsafe(ready.set))
+        try:
+            lines, sent = events.opening(caller.id, last_id)
+            for line in lines:
+                yield line
+            while True:
+                try:
+                    await asyncio.wait_for(ready.wait(), events.KEEPALIVE)
+                except asyncio.TimeoutError:
+                    #a comment, keeps proxies from closing an idle connection and finds the disconnected clients
+                    yield ": keepalive\n\n"
+                    continue
+                ready.clear()
+                for event in subscriber.drain():
+                    if event[0] not in sent:
+                        yield events.format_event(event)
+                if subscriber.overflowed:
+                    yield events.format_reset()
+                    return
+        finally:
+            events.broker.unsubscribe(subscriber)
+
+    return StreamingResponse(stream(), headers=events.HEADERS, media_type="text/event-stream")
+
+#the async engine's pool, the Flask app's one only serves the routes passed on to it
+async def database_health(request):
+    body, status = await database.health_async(engine)
+    return respond(body, status)
+
+#compression.py for the native routes, whole bodies only (they do not stream);
+#the Flask app's responses come compressed already
+class Compress:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = compression.negotiate(Headers(scope=scope).get("accept-encoding"))
+        held = None
+
+        async def send_compressed(message):
+            nonlocal held
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=message["headers"])
+                mimetype = headers.get("content-type", "").partition(";")[0].strip()
+                if not compression.compressible(mimetype) or "content-encoding" in headers \
+                        or "no-transform" in headers.get("cache-control", "") or message["status"] < 200 or message["status"] in (204, 206, 304):
+                    return await send(message)
+                if "accept-encoding" not in headers.get("vary", "").lower():
+                    headers.add_vary_header("Accept-Encoding")
+                if encoding is None:
+                    return await send(message)
+                held = message
+                return
+            if held is None or message["type"] != "http.response.body":
+                return await send(message)
+            start, held = held, None
+            body = message.get("body", b"")
+            if not message.get("more_body") and len(body) >= compression.MIN_SIZE:
+                body = compression.compress(body, encoding)
+                headers = MutableHeaders(raw=start["headers"])
+                headers["content-encoding"] = encoding
+                headers["content-length"] = str(len(body))
+                message = dict(message, body=body)
+            await send(start)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+class Native(Route):
+    #requests with a query string (pagination, streaming, filters, search) or asking for
+    #NDJSON (the streamed export of streaming.py) are left to the Flask routes
+    def matches(self, scope):
+        if scope.get("query_string") or streaming.accepts_ndjson(Headers(scope=scope).get("accept")):
+            return Match.NONE, {}
+        return super().matches(scope)
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await engine.dispose()
+
+app = Starlette(
+    routes=[
+        Native("/users", get_users, methods=["GET"]),
+        Native("/users/favorites", get_current_user_favorites, methods=["GET"]),
+        Native("/users/{id:int}", get_user, methods=["GET"]),
+        Native("/users/{id:int}/favorites", get_user_favorites, methods=["GET"]),
+        Native("/people", get_people, methods=["GET"]),
+        Native("/people/{id:int}", get_person, methods=["GET"]),
+        Native("/planets", get_planets, methods=["GET"]),
+        Native("/planets/{id:int}", get_planet, methods=["GET"]),
+        Native("/login", login, methods=["POST"]),
+        Native("/favorite/planet/{id:int}", favorite_planet, methods=["POST", "DELETE"]),
+        Native("/favorite/people/{id:int}", favorite_character, methods=["POST", "DELETE"]),
+        Native("/health/db", database_health, methods=["GET"]),
+        #not Native: EventSource sends the token as ?jwt=
+        Route("/users/favorites/events", favorite_events, methods=["GET"]),
+        Mount("/", WSGIMiddleware(flask_app)),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"]), Middleware(Compress)],
+    lifespan=lifespan,
+)
@@ -0,0 +1,74 @@
+"""
+Resolves the caller of @jwt_required() routes.
+
+Tokens carry the user id as identity. The user_lookup_loader keeps a bounded,
+TTL-evicting cache of the users that are currently making requests, so an
+authenticated request usually resolves its caller without touching the database.
+Handlers get a read-only Caller (not an ORM object) through current_user; the
+entry is dropped as soon as a change to that user is committed.
+"""
+import os
+from collections import namedtuple
+from flask import jsonify
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from cache import LRUCache
+from models import db, User
+
+Caller = namedtuple("Caller", ["id", "name", "email", "is_active"])
+
+users = LRUCache()
+
+def init_app(app, jwt):
+    global users
+    users = LRUCache(
+        maxsize=int(app.config.get("USER_CACHE_SIZE", os.getenv("USER_CACHE_SIZE", 10000))),
+        ttl=int(app.config.get("USER_CACHE_TTL", os.getenv("USER_CACHE_TTL", 300))),
+    )
+    jwt.user_lookup_loader(load_caller)
+    jwt.user_lookup_error_loader(caller_not_found)
+
+def load_caller(jwt_header, jwt_data):
+    identity = str(jwt_data["sub"])
+    caller, stamp = users.get(identity)
+    if caller is not None:
+        return caller
+    user = db.session.execute(user_statement(identity)).scalar_one_or_none()
+    if user is None:
+        return None
+    return remember(identity, user, stamp)
+
+def user_statement(identity):
+    #tokens issued before the switch to ids carry the email
+    if identity.isdigit():
+        return db.select(User).filter_by(id=int(identity))
+    return db.select(User).filter_by(email=identity)
+
+#stamp: the one of the users.get() that missed, before user was read
+def remember(identity, user, stamp):
+    caller = Caller(user.id, user.name, user.email, user.is_active)
+    users.set(identity, caller, (f"user:{user.id}",), stamp)
+    return caller
+
+def caller_not_found(jwt_header, jwt_data):
+    return jsonify({"msg": "User not found"}), 404
+
+@event.listens_for(Session, "after_flush")
+def collect_changed_users(session, flush_context):
+    ids = {obj.id for obj in (*session.dirty, *session.deleted) if isinstance(obj, User)}
+    if ids:
+        session.info.setdefault("changed_users", set()).update(ids)
+
+@event.listens_for(Session, "after_commit")
+def forget_changed_users(session):
+    #after_commit/after_rollback also fire for savepoints (favorites.add), only the outermost transaction counts
+    if session.in_nested_transaction():
+        return
+    ids = session.info.pop("changed_users", None)
+    if ids:
+        users.invalidate(*(f"user:{id}" for id in ids))
+
+@event.listens_for(Session, "after_rollback")
+def keep_users(session):
+    if not session.in_nested_transaction():
+        session.info.pop("changed_users", None)
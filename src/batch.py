@@ -0,0 +1,138 @@
+"""
+Multi-get and batch requests, to save clients round trips.
+
+    GET /people?ids=1,2,3
+    GET /planets?ids=4,5
+
+answers {"results": [...], "missing": [...]}: the rows' serialize() payloads in the
+order of ids, read with one IN query (and the graph's selectin loads), and the ids
+that have no row. At most MAX_IDS ids (default 100, BATCH_MAX_IDS).
+
+    POST /batch
+    {"requests": ["/people/1", {"path": "/planets/2", "headers": {"If-None-Match": "W/\\"...\\""}}]}
+
+runs up to MAX_REQUESTS (default 20, BATCH_MAX_REQUESTS) read sub-requests against
+the routes of the app and answers
+
+    {"responses": [{"status": 200, "headers": {"ETag": ...}, "body": {...}}, ...]}
+
+in the same order, each with its own status code. The sub-requests go through the
+whole request cycle (conditional GETs, the response cache, the caller's token, which
+they inherit from the batch request unless they send their own Authorization), but
+they share the batch request's app context, so they share its database session:
+a row one of them loaded is in the identity map for the next ones. Only GET is
+allowed, and no streaming.
+"""
+import os
+import sys
+from flask import current_app, g, request
+from werkzeug.test import EnvironBuilder
+from utils import APIException
+from models import db
+import profiling
+import queries
+
+MAX_IDS = 100
+MAX_REQUESTS = 20
+#headers of a sub-response worth handing back to the client
+HEADERS = ("ETag", "Last-Modified", "Location", "Retry-After", "X-Cache")
+#same compact separators as jsonify()
+SEPARATORS = (",", ":")
+
+def init_app(app):
+    global MAX_IDS, MAX_REQUESTS
+    MAX_IDS = int(app.config.get("BATCH_MAX_IDS", os.getenv("BATCH_MAX_IDS", 100)))
+    MAX_REQUESTS = int(app.config.get("BATCH_MAX_REQUESTS", os.getenv("BATCH_MAX_REQUESTS", 20)))
+
+def ids_requested():
+    return "ids" in request.args
+
+def parse_ids():
+    raw = request.args.get("ids", "")
+    values = [value.strip() for value in raw.split(",") if value.strip()]
+    #isdecimal(), not isdigit(): "²" is a digit int() does not take
+    if not values or not all(value.isdecimal() for value in values):
+        raise APIException("ids must be a comma separated list of integers", status_code=400)
+    #keep the client's order but drop duplicates
+    ids = list(dict.fromkeys(int(value) for value in values))
+    if len(ids) > MAX_IDS:
+        raise APIException(f"At most {MAX_IDS} ids", status_code=400)
+    return ids
+
+def multi_get(model, graph):
+    ids = parse_ids()
+    rows = queries.get_many(model, ids, graph)
+    return {
+        "results": [rows[id].serialize() for id in ids if id in rows],
+        "missing": [id for id in ids if id not in rows],
+    }
+
+#(path, headers) of a sub-request, from a path string or {"method", "path", "headers"}
+def parse_item(item):
+    if isinstance(item, str):
+        item = {"path": item}
+    if not isinstance(item, dict) or not isinstance(item.get("path"), str) or not item["path"].startswith("/"):
+        return None, None, "Each request must be a path or an object with a path starting with /"
+    if str(item.get("method", "GET")).upper() != "GET":
+        return None, None, "Only GET requests can be batched"
+    headers = item.get("headers") or {}
+    if not isinstance(headers, dict):
+        return None, None, "headers must be an object"
+    return item["path"], {str(name): str(value) for name, value in headers.items()}, None
+
+def parse_requests(body):
+    items = body.get("requests") if isinstance(body, dict) else body
+    if not isinstance(items, list):
+        raise APIException("Send {\"requests\": [...]}", status_code=400)
+    if len(items) > MAX_REQUESTS:
+        raise APIException(f"At most {MAX_REQUESTS} requests", status_code=400)
+    return items
+
+def environ(path, headers):
+    if "Authorization" not in headers and "Authorization" in request.headers:
+        headers = {**headers, "Authorization": request.headers["Authorization"]}
+    #no Accept-Encoding: the body is copied into the batch response, which is compressed as a whole
+    builder = EnvironBuilder(path=path, method="GET", base_url=request.host_url, headers=headers)
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+#the batch request's g is set aside while a sub-request runs in the same app context
+#(its profile, the cache entry compression.py looks for), the sub-request's profile is added to it
+def dispatch(path, headers):
+    app = current_app._get_current_object()
+    outer = dict(vars(g))
+    vars(g).clear()
+    try:
+        with app.request_context(environ(path, headers)):
+            if "stream" in request.args or request.accept_mimetypes.best == "application/x-ndjson":
+                return 400, {}, b'{"msg":"Streaming is not available in a batch"}'
+            try:
+                response = app.full_dispatch_request()
+            except Exception:
+                app.log_exception(sys.exc_info())
+                db.session.rollback()
+                return 500, {}, b'{"msg":"Internal server error"}'
+            profile = g.get("profile")
+    finally:
+        vars(g).clear()
+        vars(g).update(outer)
+    if profile is not None and profiling.current() is not None:
+        profiling.current().add(profile)
+    headers = {name: response.headers[name] for name in HEADERS if name in response.headers}
+    return response.status_code, headers, response.get_data() if response.is_json else None
+
+#the JSON bodies are spliced in as they are, not decoded and encoded again
+def run(items):
+    dumps = current_app.json.dumps
+    parts = []
+    for item in items:
+        path, headers, error = parse_item(item)
+        if error is not None:
+            status, headers, body = 400, {}, dumps({"msg": error}, separators=SEPARATORS).encode()
+        else:
+            status, headers, body = dispatch(path, headers)
+        body = body.strip() if body and body.strip() else b"null"
+        parts.append(b'{"body":' + body + b',"headers":' + dumps(headers, separators=SEPARATORS).encode() + b',"status":' + str(status).encode() + b"}")
+    return b'{"responses":[' + b",".join(parts) + b"]}\n"
@@ -0,0 +1,244 @@
+"""
+Read-through response cache for the catalogue endpoints.
+
+Entries are tagged with the tables their payload is built from. Every committed
+change to one of those tables (favorite toggles, Flask-Admin edits, anything that
+goes through db.session) invalidates the matching tags, so a cached response never
+outlives the rows it was built from. Compressed variants of an entry (see
+compression.py) are entries of their own under the same tags. Writes that bypass the ORM unit of work must
+call touch() with the tables they changed.
+
+Two backends are available:
+- LRUCache: in-process, bounded, with a TTL. The default. Each worker has its own.
+- SharedCache: stores entries in a Redis-compatible client (CACHE_URL=redis://...),
+  so every worker sees the same entries and invalidations. Tags are versioned
+  counters, invalidating a tag is a single INCR. FakeRedis stands in for a real
+  server locally.
+
+Lookups of the cached() routes are counted per route (hits and misses) and
+invalidations per tag, on GET /metrics (see profiling.py). Other users of the
+backends (compressed variants, the admin's counts) are not counted.
+
+get() returns the entry and a stamp of the tags as they were at the lookup, set()
+takes that stamp back: a value built while one of its tags was invalidated is never
+stored, whoever committed in between.
+"""
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import g, request, make_response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+import profiling
+import replicas
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict() #key -> (expires_at, tags, value)
+        self.invalidations = {} #tag -> time.time() of its last invalidation
+        self.lock = threading.Lock()
+
+    #entries here are dropped eagerly on invalidation, the stamp is the time of the lookup
+    def get(self, key, tags=()):
+        with self.lock:
+            stamp = time.time()
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                return None, stamp
+            self.entries.move_to_end(key)
+            return entry[2], stamp
+
+    #stamp is None for values that are not read from the tagged rows
+    def set(self, key, value, tags, stamp=None):
+        with self.lock:
+            #one of the tags was invalidated since the lookup, value may predate that write
+            if stamp is not None and max((self.invalidations.get(tag, 0) for tag in tags), default=0) >= stamp:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, frozenset(tags), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *tags):
+        tags = set(tags)
+        with self.lock:
+            stale = [key for key, entry in self.entries.items() if entry[1] & tags]
+            for key in stale:
+                del self.entries[key]
+            self.invalidations.update(dict.fromkeys(tags, time.time()))
+
+    #when one of the tags was last invalidated (a wall clock time), 0 for never
+    def invalidated_at(self, tags):
+        with self.lock:
+            return max((self.invalidations.get(tag, 0) for tag in tags), default=0)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class SharedCache:
+    def __init__(self, client, ttl=60, prefix="swapi:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    #the current version of each tag is part of the entry key, bumping a tag orphans every entry that used it
+    def versions(self, tags):
+        tags = sorted(tags)
+        versions = self.client.mget([self.prefix + "tag:" + tag for tag in tags])
+        return ",".join(f"{tag}={int(version or 0)}" for tag, version in zip(tags, versions))
+
+    def versioned_key(self, key, stamp):
+        return f"{self.prefix}entry:{key}|{stamp}"
+
+    #the stamp is the versions the lookup used
+    def get(self, key, tags):
+        stamp = self.versions(tags)
+        raw = self.client.get(self.versioned_key(key, stamp))
+        return (pickle.loads(raw) if raw is not None else None), stamp
+
+    #stored under the versions of the lookup, already orphaned if a tag was bumped since
+    def set(self, key, value, tags, stamp=None):
+        if stamp is None:
+            stamp = self.versions(tags)
+        self.client.set(self.versioned_key(key, stamp), pickle.dumps(value), ex=self.ttl)
+
+    def invalidate(self, *tags):
+        now = repr(time.time())
+        for tag in tags:
+            self.client.incr(self.prefix + "tag:" + tag)
+            self.client.set(self.prefix + "invalidated:" + tag, now)
+
+    def invalidated_at(self, tags):
+        times = self.client.mget([self.prefix + "invalidated:" + tag for tag in tags])
+        return max((float(value) for value in times if value is not None), default=0)
+
+    def clear(self):
+        for tag in self.client.keys(self.prefix + "tag:*"):
+            self.client.incr(tag)
+
+#minimal in-memory stand-in for the subset of the Redis client SharedCache uses
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires_at = self.data.get(key, (None, None))
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.data[key]
+                return None
+            return value
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + ex if ex else None)
+
+    def incr(self, key):
+        with self.lock:
+            value = int(self.data.get(key, (0, None))[0] or 0) + 1
+            self.data[key] = (str(value).encode(), None)
+            return value
+
+    def keys(self, pattern):
+        prefix = pattern.rstrip("*")
+        with self.lock:
+            return [key for key in self.data if key.startswith(prefix)]
+
+backend = LRUCache()
+
+def init_app(app):
+    global backend
+    ttl = int(app.config.get("CACHE_TTL", os.getenv("CACHE_TTL", 60)))
+    url = app.config.get("CACHE_URL", os.getenv("CACHE_URL"))
+    if url == "fake://":
+        backend = SharedCache(FakeRedis(), ttl=ttl)
+    elif url:
+        import redis #optional dependency, only needed for a shared cache
+        backend = SharedCache(redis.Redis.from_url(url), ttl=ttl)
+    else:
+        backend = LRUCache(maxsize=int(app.config.get("CACHE_MAXSIZE", os.getenv("CACHE_MAXSIZE", 1024))), ttl=ttl)
+    app.extensions["response_cache"] = backend
+
+def invalidate(*tags):
+    backend.invalidate(*tags)
+    for tag in tags:
+        profiling.COUNTERS["invalidations"].inc((tag,))
+
+#a lookup of a cached() route, route being its rule (/people/<int:id>)
+def count(route, hit):
+    profiling.COUNTERS["cache"].inc((route, "hit" if hit else "miss"))
+
+#route + normalized query string, so ?a=1&b=2 and ?b=2&a=1 share an entry
+def request_key():
+    return key_for(request.endpoint, request.path, request.args.items(multi=True))
+
+def key_for(endpoint, path, args=()):
+    return f"{endpoint}:{path}?{urlencode(sorted(args))}"
+
+#caches successful responses of a GET route, tagged with the tables the payload is built from
+def cached(*tags, unless=None):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET" or (unless is not None and unless()):
+                return view(*args, **kwargs)
+            key = request_key()
+            hit, stamp = backend.get(key, tags)
+            count(request.url_rule.rule, hit is not None)
+            if hit is not None:
+                body, status, mimetype = hit
+                response = make_response(body, status)
+                response.mimetype = mimetype
+                response.headers["X-Cache"] = "HIT"
+                #compression.py caches the compressed body next to the entry
+                g.cache_entry = (key, tags, stamp)
+                return response
+            if replicas.enabled() and not replicas.caught_up(backend.invalidated_at(tags)):
+                #shared by every caller, so only filled from a replica that has the write that invalidated the entry
+                replicas.use_primary()
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                backend.set(key, (response.get_data(), response.status_code, response.mimetype), tags, stamp)
+                g.cache_entry = (key, tags, stamp)
+            response.headers["X-Cache"] = "MISS"
+            return response
+        return wrapper
+    return decorator
+
+#records tables changed outside of the ORM unit of work (core insert/update/delete), invalidated on commit
+def touch(session, *tables):
+    session.info.setdefault("cache_tags", set()).update(tables)
+
+@event.listens_for(Session, "after_flush")
+def collect_changed_tables(session, flush_context):
+    tables = {obj.__table__.name for obj in (*session.new, *session.dirty, *session.deleted) if hasattr(obj, "__table__")}
+    if tables:
+        touch(session, *tables)
+
+@event.listens_for(Session, "after_commit")
+def invalidate_changed_tables(session):
+    #also fired when a savepoint is released, before the transaction commits
+    if session.in_nested_transaction():
+        return
+    tags = session.info.pop("cache_tags", None)
+    if tags:
+        invalidate(*tags)
+
+@event.listens_for(Session, "after_rollback")
+def forget_changed_tables(session):
+    #and when one rolls back, the rest of the transaction can still commit
+    if not session.in_nested_transaction():
+        session.info.pop("cache_tags", None)
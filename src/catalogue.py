@@ -0,0 +1,309 @@
+"""
+Bulk import and export of the catalogue: planets, characters and favorites.
+
+    flask catalogue export planets planets.csv
+    flask catalogue export characters - --format ndjson > characters.ndjson
+    flask catalogue import characters characters.csv
+    flask catalogue import favorites favorites.ndjson --batch-size 2000
+
+Files are CSV (with a header row) or NDJSON, told apart by their extension or by
+--format; "-" is stdin/stdout. Both directions stream: export reads the table with
+yield_per and import parses and writes --batch-size rows at a time, so memory stays
+flat whatever the size of the file. Progress goes to stderr.
+
+Columns:
+- planets: name, terrain, description, location, key_event
+- characters: name, gender, faction, race, homeworld (a planet name, may be empty)
+- favorites: user (an email), planet or character (a name, exactly one of the two)
+
+Planets and characters are upserted on their unique name with one multi-row INSERT
+... ON CONFLICT per batch: new names are inserted, existing rows updated when a
+value differs and left alone (same revision, same ETag) when none does. Favorites
+that already exist are skipped. Rows that are incomplete or name a planet,
+character or user that does not exist are rejected and reported with their line
+number, the rest of the file still goes in. Each batch is committed on its own, so
+an interrupted import can simply be run again.
+
+Revisions, favorite_count and the response cache tags are kept right the way
+favorites.py keeps them for the API writes (an in-process cache of a running server
+expires on its own TTL, a shared one is invalidated). The upserts need ON CONFLICT,
+so imports run on Postgres and SQLite.
+"""
+import csv
+import json
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import nullcontext
+import click
+from flask.cli import AppGroup
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, User, Planet, Character, Favorite, favorite_dependents, count_statement, utcnow
+import cache
+import favorites
+
+BATCH_SIZE = 5000
+#rejected rows printed before only counting the rest
+REPORTED_REJECTIONS = 20
+
+FIELDS = {
+    "planets": ("name", "terrain", "description", "location", "key_event"),
+    "characters": ("name", "gender", "faction", "race", "homeworld"),
+    "favorites": ("user", "planet", "character"),
+}
+OPTIONAL = {"homeworld", "planet", "character"}
+#length limits of the columns a field is stored in
+LIMITS = {
+    "planets": Planet.__table__.c,
+    "characters": Character.__table__.c,
+}
+
+cli = AppGroup("catalogue", help="Bulk import and export of planets, characters and favorites.")
+
+class Rejected(Exception):
+    pass
+
+def file_format(path, given):
+    if given:
+        return given
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        return "csv"
+    if extension in (".ndjson", ".jsonl"):
+        return "ndjson"
+    raise click.UsageError(f"Cannot tell the format of {path}, pass --format csv or --format ndjson")
+
+#yields (line number, row); a line that is not a JSON object gives None, rejected by clean()
+def read_ndjson(file):
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row
+
+def read_csv(file):
+    reader = csv.DictReader(file)
+    for row in reader:
+        yield reader.line_num, row
+
+def chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+#stripped values of the kind's fields, empty ones as None
+def clean(kind, row):
+    if not isinstance(row, dict):
+        raise Rejected("not a JSON object")
+    values = {}
+    for field in FIELDS[kind]:
+        value = row.get(field)
+        value = "" if value is None else str(value).strip()
+        if not value and field not in OPTIONAL:
+            raise Rejected(f"{field} is missing")
+        column = LIMITS[kind].get(field) if kind in LIMITS else None
+        if column is not None and len(value) > column.type.length:
+            raise Rejected(f"{field} is longer than {column.type.length} characters")
+        values[field] = value or None
+    if kind == "favorites" and (values["planet"] is None) == (values["character"] is None):
+        raise Rejected("a favorite names either a planet or a character")
+    return values
+
+def insert_statement(session, table):
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        return pg_insert(table)
+    if dialect == "sqlite":
+        return sqlite_insert(table)
+    raise click.ClickException(f"Imports need INSERT ... ON CONFLICT, which {dialect} does not have")
+
+#inserts new names, updates the rows where a value differs; returns the ids written
+def upsert(session, model, rows, now):
+    table = model.__table__
+    statement = insert_statement(session, table)
+    columns = [name for name in rows[0] if name != "name"]
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.name],
+        set_={**{name: statement.excluded[name] for name in columns}, "revision": table.c.revision + 1, "updated_at": now},
+        #an unchanged row keeps its revision, so its ETag and cached responses stay valid
+        where=db.or_(*(table.c[name].is_distinct_from(statement.excluded[name]) for name in columns)),
+    ).returning(table.c.id)
+    return session.execute(statement, [dict(row, revision=1, updated_at=now) for row in rows]).scalars().all()
+
+#ids by name, for the names that exist
+def lookup(session, column, names):
+    if not names:
+        return {}
+    model = column.class_
+    return dict(session.execute(db.select(column, model.id).where(column.in_(names))).all())
+
+#each import_* takes a list of (line number, cleaned values) and returns (rows written, [(line number, reason)])
+def import_planets(session, rows, now):
+    #a name repeated in one batch: the last row wins (one statement cannot update a row twice)
+    latest = {values["name"]: values for number, values in rows}
+    written = upsert(session, Planet, list(latest.values()), now)
+    if written:
+        cache.touch(session, "planet")
+    return len(written), []
+
+def import_characters(session, rows, now):
+    homeworlds = lookup(session, Planet.name, {values["homeworld"] for number, values in rows if values["homeworld"]})
+    latest, rejected = {}, []
+    for number, values in rows:
+        homeworld = values.pop("homeworld")
+        if homeworld is not None and homeworld not in homeworlds:
+            rejected.append((number, f"unknown homeworld {homeworld}"))
+            continue
+        latest[values["name"]] = dict(values, homeworld_id=homeworlds.get(homeworld))
+    if not latest:
+        return 0, rejected
+    #a character is listed with its homeworld's residents: the planets it leaves and joins change too
+    previous = dict(session.execute(
+        db.select(Character.id, Character.homeworld_id).where(Character.name.in_(latest), Character.homeworld_id.is_not(None))
+    ).all())
+    written = upsert(session, Character, list(latest.values()), now)
+    if written:
+        left = {previous[id] for id in written if id in previous}
+        joined = db.select(Character.homeworld_id).where(Character.id.in_(written))
+        session.execute(favorites.bump_statement(Planet, db.or_(Planet.id.in_(left), Planet.id.in_(joined)), now))
+        cache.touch(session, "character", "planet")
+    return len(written), rejected
+
+def import_favorites(session, rows, now):
+    users = lookup(session, User.email, {values["user"] for number, values in rows})
+    planets = lookup(session, Planet.name, {values["planet"] for number, values in rows if values["planet"]})
+    characters = lookup(session, Character.name, {values["character"] for number, values in rows if values["character"]})
+    wanted, rejected = {}, []
+    for number, values in rows:
+        if values["user"] not in users:
+            rejected.append((number, f"unknown user {values['user']}"))
+        elif values["planet"] is not None and values["planet"] not in planets:
+            rejected.append((number, f"unknown planet {values['planet']}"))
+        elif values["character"] is not None and values["character"] not in characters:
+            rejected.append((number, f"unknown character {values['character']}"))
+        else:
+            key = (users[values["user"]], planets.get(values["planet"]), characters.get(values["character"]))
+            wanted[key] = {"user_id": key[0], "planet_id": key[1], "character_id": key[2], "revision": 1, "updated_at": now}
+    if not wanted:
+        return 0, rejected
+    table = Favorite.__table__
+    statement = insert_statement(session, table).on_conflict_do_nothing().returning(table.c.user_id, table.c.planet_id, table.c.character_id)
+    inserted = session.execute(statement, list(wanted.values())).all()
+    if inserted:
+        for model, column in ((Planet, 1), (Character, 2)):
+            added = Counter(row[column] for row in inserted if row[column] is not None)
+            #one UPDATE per distinct increment
+            by_delta = {}
+            for id, delta in added.items():
+                by_delta.setdefault(delta, []).append(id)
+            for delta, ids in by_delta.items():
+                session.execute(count_statement(model, ids, delta))
+        user_ids, planet_ids, character_ids = ({row[index] for row in inserted} - {None} for index in range(3))
+        for model, condition in favorite_dependents(user_ids, planet_ids, character_ids):
+            session.execute(favorites.bump_statement(model, condition, now))
+        favorites.touch(session)
+    return len(inserted), rejected
+
+IMPORTS = {
+    "planets": import_planets,
+    "characters": import_characters,
+    "favorites": import_favorites,
+}
+
+def export_statement(kind):
+    if kind == "planets":
+        return db.select(Planet.name, Planet.terrain, Planet.description, Planet.location, Planet.key_event).order_by(Planet.id)
+    if kind == "characters":
+        return (
+            db.select(Character.name, Character.gender, Character.faction, Character.race, Planet.name.label("homeworld"))
+            .outerjoin(Planet, Character.homeworld_id == Planet.id)
+            .order_by(Character.id)
+        )
+    return (
+        db.select(User.email.label("user"), Planet.name.label("planet"), Character.name.label("character"))
+        .select_from(Favorite)
+        .join(User, Favorite.user_id == User.id)
+        .outerjoin(Planet, Favorite.planet_id == Planet.id)
+        .outerjoin(Character, Favorite.character_id == Character.id)
+        .order_by(Favorite.id)
+    )
+
+def progress(kind, count, started, extra=""):
+    elapsed = time.perf_counter() - started
+    click.echo(f"{kind}: {count} rows{extra} in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f} rows/s)", err=True)
+
+def open_file(path, mode):
+    if path == "-":
+        return nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    #utf-8-sig drops the byte order mark spreadsheets put in front of CSV files
+    return open(path, mode, newline="", encoding="utf-8-sig" if mode == "r" else "utf-8")
+
+def report(rejections, already):
+    for index, (number, reason) in enumerate(rejections):
+        if already + index < REPORTED_REJECTIONS:
+            click.echo(f"line {number}: {reason}", err=True)
+        elif already + index == REPORTED_REJECTIONS:
+            click.echo("more rejected lines are only counted", err=True)
+    return len(rejections)
+
+@cli.command("import")
+@click.argument("kind", type=click.Choice(list(FIELDS)))
+@click.argument("path", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--format", "format_", type=click.Choice(["csv", "ndjson"]), help="defaults to the file extension")
+@click.option("--batch-size", type=click.IntRange(min=1), default=BATCH_SIZE, show_default=True)
+def import_command(kind, path, format_, batch_size):
+    """Upsert planets, characters or favorites from a CSV or NDJSON file."""
+    format_ = file_format(path, format_)
+    session = db.session
+    insert_statement(session, Planet.__table__) #fails early on a database without ON CONFLICT
+    started = time.perf_counter()
+    read = written = rejected = 0
+    with open_file(path, "r") as file:
+        rows = read_csv(file) if format_ == "csv" else read_ndjson(file)
+        for chunk in chunks(rows, batch_size):
+            valid, invalid = [], []
+            for number, row in chunk:
+                try:
+                    valid.append((number, clean(kind, row)))
+                except Rejected as error:
+                    invalid.append((number, str(error)))
+            count, unresolved = IMPORTS[kind](session, valid, utcnow()) if valid else (0, [])
+            session.commit()
+            rejected += report(sorted(invalid + unresolved), rejected)
+            read += len(chunk)
+            written += count
+            progress(kind, read, started, f" read, {written} written, {rejected} rejected")
+
+@cli.command("export")
+@click.argument("kind", type=click.Choice(list(FIELDS)))
+@click.argument("path", type=click.Path(dir_okay=False, writable=True, allow_dash=True))
+@click.option("--format", "format_", type=click.Choice(["csv", "ndjson"]), help="defaults to the file extension")
+@click.option("--batch-size", type=click.IntRange(min=1), default=BATCH_SIZE, show_default=True)
+def export_command(kind, path, format_, batch_size):
+    """Write planets, characters or favorites to a CSV or NDJSON file, in a format import reads back."""
+    format_ = file_format(path, format_)
+    started = time.perf_counter()
+    count = 0
+    result = db.session.execute(export_statement(kind).execution_options(yield_per=batch_size))
+    with open_file(path, "w") as file:
+        if format_ == "csv":
+            writer = csv.writer(file)
+            writer.writerow(FIELDS[kind])
+        for batch in result.partitions():
+            if format_ == "csv":
+                writer.writerows(batch)
+            else:
+                file.write("".join(json.dumps(dict(row._mapping)) + "\n" for row in batch))
+            count += len(batch)
+            progress(kind, count, started, " written")
+    db.session.rollback()
@@ -0,0 +1,122 @@
+"""
+Negotiated gzip/brotli compression of the responses.
+
+JSON, NDJSON and text responses of at least COMPRESSION_MIN_SIZE bytes (default
+1024) are compressed with the best encoding the client accepts: br when the brotli
+package is installed, then gzip. Smaller bodies are sent as they are, compressing
+them costs more than it saves. COMPRESSION=0 turns it all off.
+
+- Streamed responses (?stream=true, NDJSON) are compressed chunk by chunk, each
+  chunk flushed as it is produced, so the client still gets rows as they are read.
+- Responses of cached routes (cache.py) are compressed once per cache entry: the
+  compressed variant is cached next to the entry, under the same tags, so it is
+  invalidated with it.
+- Every compressible response says Vary: Accept-Encoding. The ETags (etags.py) are
+  weak, so they stay valid across encodings.
+
+Levels: COMPRESSION_GZIP_LEVEL (default 6) and COMPRESSION_BROTLI_QUALITY (default 5,
+brotli's higher qualities are meant for static files).
+"""
+import os
+import zlib
+from flask import g, request
+from werkzeug.http import parse_accept_header
+import cache
+
+try:
+    import brotli #optional dependency, gzip only without it
+except ImportError:
+    brotli = None
+
+ENABLED = True
+MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+#in order of preference
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+MIMETYPES = ("application/json", "application/x-ndjson")
+
+def init_app(app):
+    global ENABLED, MIN_SIZE, GZIP_LEVEL, BROTLI_QUALITY
+    ENABLED = str(app.config.get("COMPRESSION", os.getenv("COMPRESSION", "1"))).lower() in ("1", "true", "yes", "on")
+    MIN_SIZE = int(app.config.get("COMPRESSION_MIN_SIZE", os.getenv("COMPRESSION_MIN_SIZE", 1024)))
+    GZIP_LEVEL = int(app.config.get("COMPRESSION_GZIP_LEVEL", os.getenv("COMPRESSION_GZIP_LEVEL", 6)))
+    BROTLI_QUALITY = int(app.config.get("COMPRESSION_BROTLI_QUALITY", os.getenv("COMPRESSION_BROTLI_QUALITY", 5)))
+    if ENABLED:
+        app.after_request(compress_response)
+
+def compressible(mimetype):
+    return mimetype in MIMETYPES or (mimetype or "").startswith("text/")
+
+#the encoding to answer an Accept-Encoding header with, None for identity
+def negotiate(accept_encoding):
+    if not ENABLED or not accept_encoding:
+        return None
+    accepted = parse_accept_header(accept_encoding)
+    best, quality = None, 0
+    for encoding in ENCODINGS:
+        #quality() falls back to the "*" entry
+        if accepted.quality(encoding) > quality:
+            best, quality = encoding, accepted.quality(encoding)
+    return best
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    compressor = gzip_compressor()
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_compressor():
+    #wbits 31: gzip container
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+#compresses an iterable of chunks, flushing after each so nothing is held back
+def compress_stream(chunks, encoding):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        flush, finish = compressor.flush, compressor.finish
+        process = compressor.process
+    else:
+        compressor = gzip_compressor()
+        flush, finish = (lambda: compressor.flush(zlib.Z_SYNC_FLUSH)), compressor.flush
+        process = compressor.compress
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = process(chunk) + flush()
+        if data:
+            yield data
+    yield finish()
+
+#the compressed variant of a cached body, compressed once and cached under the entry's key and tags,
+#with the stamp of the entry's lookup: body is only as fresh as that lookup
+def cached_variant(key, tags, stamp, body, encoding):
+    variant_key = f"{key}|{encoding}"
+    data = cache.backend.get(variant_key, tags)[0]
+    if data is None:
+        data = compress(body, encoding)
+        cache.backend.set(variant_key, data, tags, stamp)
+    return data
+
+def compress_response(response):
+    if not compressible(response.mimetype) or "Content-Encoding" in response.headers or response.direct_passthrough:
+        return response
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.cache_control.no_transform:
+        return response
+    encoding = negotiate(request.headers.get("Accept-Encoding"))
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+    else:
+        body = response.get_data()
+        if len(body) < MIN_SIZE:
+            return response
+        #set by cache.cached() when body is the cached entry's
+        entry = g.get("cache_entry")
+        response.set_data(cached_variant(*entry, body, encoding) if entry else compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -0,0 +1,198 @@
+"""
+Engine and connection pool settings.
+
+Every engine (the Flask app's and the one of asgi.py) gets its pool from
+engine_options(), sized per worker process:
+
+    DB_POOL_SIZE           connections kept open (5)
+    DB_MAX_OVERFLOW        extra connections opened under load, closed when returned (10)
+    DB_POOL_TIMEOUT        seconds a request waits for a free connection before failing (30)
+    DB_POOL_RECYCLE        seconds after which a connection is replaced, -1 to never (1800)
+    DB_POOL_PRE_PING       check a connection before handing it out, so connections
+                           killed by a database restart are replaced instead of failing
+                           the request (on)
+    DB_STATEMENT_TIMEOUT   milliseconds a statement may run before the database cancels
+                           it, Postgres and MySQL only (0, no limit)
+
+A worker can hold up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections, so keep
+workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) under the database's connection limit.
+
+SQLite engines get SQLAlchemy's recipe for working transactions: the driver's own
+BEGIN handling is turned off and SQLAlchemy emits BEGIN itself. pysqlite (and
+aiosqlite) only begin before an INSERT/UPDATE/DELETE, so the SAVEPOINT of
+favorites.add() would open the transaction and its RELEASE commit the favorite
+on its own, whatever happens to the request's transaction afterwards.
+
+The pools count their checkouts, checkout waits, timeouts, new connections and
+invalidations; health() reports them with the pool state on GET /health/db.
+"""
+import os
+import threading
+import time
+import weakref
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+#every engine of this process, disposed after a fork (see after_fork())
+engines = weakref.WeakSet()
+
+class Counters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {"checkouts": 0, "connects": 0, "invalidated": 0, "timeouts": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.values[name] += amount
+
+    def waited(self, ms):
+        with self.lock:
+            self.values["wait_ms_total"] += ms
+            self.values["wait_ms_max"] = max(self.values["wait_ms_max"], ms)
+
+    def snapshot(self):
+        with self.lock:
+            values = dict(self.values)
+        values["wait_ms_total"] = round(values["wait_ms_total"], 2)
+        values["wait_ms_max"] = round(values["wait_ms_max"], 2)
+        return values
+
+#counts with the public pool events (see track()) and times Pool.connect(), the public entry point
+#of every checkout, which waits while the pool is exhausted and raises once DB_POOL_TIMEOUT has passed.
+#the time also covers opening a new connection and the pre-ping, when the checkout needs them
+class Instrumented:
+    def __init__(self, *args, max_overflow=10, **kwargs):
+        super().__init__(*args, max_overflow=max_overflow, **kwargs)
+        self.max_overflow = max_overflow
+        self.counters = Counters()
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeout:
+            self.counters.add("timeouts")
+            raise
+        self.counters.waited((time.perf_counter() - start) * 1000)
+        return connection
+
+    #the counters outlive a dispose, e.g. the one after a database restart; so do the listeners of track()
+    def recreate(self):
+        pool = super().recreate()
+        pool.counters = self.counters
+        return pool
+
+    def stats(self):
+        return {
+            "size": self.size(),
+            "max_overflow": self.max_overflow,
+            "checked_out": self.checkedout(),
+            "checked_in": self.checkedin(),
+            "overflow": max(self.overflow(), 0),
+            **self.counters.snapshot(),
+        }
+
+class InstrumentedQueuePool(Instrumented, QueuePool):
+    pass
+
+class InstrumentedAsyncQueuePool(Instrumented, AsyncAdaptedQueuePool):
+    pass
+
+def setting(app, name, default):
+    return app.config.get(name, os.getenv(name, default))
+
+def engine_options(app, url):
+    url = make_url(url)
+    backend, driver = url.get_backend_name(), url.get_driver_name()
+    if backend == "sqlite" and url.database in (None, "", ":memory:"):
+        #an in memory database lives in its one connection, there is no pool to size
+        return {}
+    options = {
+        "poolclass": InstrumentedAsyncQueuePool if driver in ("asyncpg", "aiosqlite") else InstrumentedQueuePool,
+        "pool_size": int(setting(app, "DB_POOL_SIZE", 5)),
+        "max_overflow": int(setting(app, "DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(setting(app, "DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(setting(app, "DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": str(setting(app, "DB_POOL_PRE_PING", "1")).lower() in ("1", "true", "yes", "on"),
+    }
+    timeout = int(setting(app, "DB_STATEMENT_TIMEOUT", 0))
+    if timeout and backend == "postgresql":
+        if driver == "asyncpg":
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(timeout)}}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={timeout}"}
+    elif timeout and backend == "mysql" and driver == "mysqldb":
+        #MySQL only limits SELECTs
+        options["connect_args"] = {"init_command": f"SET SESSION max_execution_time={timeout}"}
+    return options
+
+def sqlite_transactions(engine):
+    event.listen(engine, "connect", lambda dbapi_connection, record: setattr(dbapi_connection, "isolation_level", None))
+    event.listen(engine, "begin", lambda connection: connection.exec_driver_sql("BEGIN"))
+
+#pool events listened to on the engine are kept by the pools engine.dispose() makes, as are the counters
+def count_pool_events(engine):
+    counters = engine.pool.counters
+    event.listen(engine, "checkout", lambda *args: counters.add("checkouts"))
+    event.listen(engine, "connect", lambda *args: counters.add("connects"))
+    event.listen(engine, "invalidate", lambda *args: counters.add("invalidated"))
+
+#every engine of the process goes through here: see after_fork(), count_pool_events() and sqlite_transactions()
+def track(engine):
+    if engine in engines:
+        return
+    engines.add(engine)
+    if isinstance(engine.pool, Instrumented):
+        count_pool_events(engine)
+    if engine.dialect.name == "sqlite":
+        sqlite_transactions(engine)
+
+#call before db.init_app(app), and register(app) after it
+def init_app(app):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        **engine_options(app, app.config["SQLALCHEMY_DATABASE_URI"]),
+        **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}),
+    }
+
+def register(app):
+    with app.app_context():
+        for engine in app.extensions["sqlalchemy"].engines.values():
+            track(engine)
+
+#a forked worker must not use the connections its parent opened (gunicorn --preload): the pools
+#are replaced without closing those connections, which still belong to the parent
+def after_fork():
+    for engine in list(engines):
+        engine.dispose(close=False)
+
+def pool_stats(pool):
+    if isinstance(pool, Instrumented):
+        return {"class": type(pool).__name__, **pool.stats()}
+    return {"class": type(pool).__name__, "status": pool.status()}
+
+#{"status": "ok" | "unavailable", "latency_ms" | "error", "pool": {...}} and 200 or 503
+def report(pool, start, error=None):
+    if error is not None:
+        return {"status": "unavailable", "error": type(error).__name__, "pool": pool_stats(pool)}, 503
+    latency = round((time.perf_counter() - start) * 1000, 2)
+    return {"status": "ok", "latency_ms": latency, "pool": pool_stats(pool)}, 200
+
+def health(engine):
+    start = time.perf_counter()
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+    except Exception as error:
+        return report(engine.pool, start, error)
+    return report(engine.pool, start)
+
+async def health_async(engine):
+    start = time.perf_counter()
+    try:
+        async with engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+    except Exception as error:
+        return report(engine.pool, start, error)
+    return report(engine.pool, start)
@@ -0,0 +1,64 @@
+"""
+Conditional GET for the detail routes.
+
+The ETag and Last-Modified of a row come from its revision/updated_at columns
+(maintained in models.py), which are read with one narrow query. If-None-Match and
+If-Modified-Since are checked against them before the view runs, so a client that
+already has the current payload gets a 304 without the relationship graph ever
+being loaded or serialized.
+
+The ETags are weak: they stand for the row's revision, not for the bytes, which
+differ between the identity, gzip and br encodings of the same payload.
+"""
+from datetime import timezone
+from functools import wraps
+from flask import request, jsonify, make_response
+from models import db
+
+#bump when the serialize() shapes change, so ETags handed out before stop matching
+FORMAT = 1
+
+def validators_statement(model, id):
+    return db.select(model.revision, model.updated_at).where(model.id == id)
+
+#(etag, last_modified) from the row read by validators_statement(), (None, None) when there is no row
+def from_row(model, id, row):
+    if row is None:
+        return None, None
+    etag = f"{model.__tablename__}-{id}-{row.revision}-v{FORMAT}"
+    return etag, row.updated_at.replace(tzinfo=timezone.utc)
+
+def validators(model, id):
+    return from_row(model, id, db.session.execute(validators_statement(model, id)).one_or_none())
+
+#if_none_match / if_modified_since are the parsed headers (werkzeug ETags / datetime), as on a flask request
+def matches(etag, last_modified, if_none_match, if_modified_since):
+    #If-None-Match wins over If-Modified-Since when both are sent (RFC 9110 13.2.2)
+    if if_none_match:
+        #weak comparison (RFC 9110 13.1.2), the same ETag is sent with every Content-Encoding
+        return if_none_match.contains_weak(etag)
+    if if_modified_since:
+        return last_modified.replace(microsecond=0) <= if_modified_since
+    return False
+
+def not_modified(etag, last_modified):
+    return matches(etag, last_modified, request.if_none_match, request.if_modified_since)
+
+#the row is identified by the route's id argument
+def conditional(model, arg="id"):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag, last_modified = validators(model, kwargs[arg])
+            if etag is None:
+                return jsonify({"msg": f"{model.__name__} not found"}), 404
+            if not_modified(etag, last_modified):
+                response = make_response("", 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            if response.status_code in (200, 304):
+                response.set_etag(etag, weak=True)
+                response.last_modified = last_modified
+            return response
+        return wrapper
+    return decorator
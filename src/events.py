@@ -0,0 +1,331 @@
+"""
+Server-Sent Events feed of the caller's favorite changes.
+
+    GET /users/favorites/events     (Authorization: Bearer <token>, or ?jwt=<token> for EventSource)
+
+    id: 1729251234567890123
+    event: favorite
+    data: {"id":3,"name":"Tatooine","op":"add","type":"planet"}
+
+Every committed add or remove (POST/DELETE /favorite/planet|people/<id>, PATCH
+/users/favorites) is published once the transaction commits, to the subscribers of
+that user only. A client that reconnects with Last-Event-ID (EventSource does it on
+its own, ?last_event_id= works too) first gets the events it missed, from a replay
+log of the last EVENTS_REPLAY events (default 1000), in the order they arrived.
+The client gets an "event: reset" instead, and should reload GET /users/favorites,
+whenever the log cannot prove it holds everything after that id: the log no longer
+reaches back that far, the worker started after it, or (without a shared backend)
+the id comes from another worker. So does a client that fell more than
+EVENTS_BUFFER events (default 100) behind.
+
+Backends (EVENTS_URL), they carry events between the workers:
+- unset: in-process only, a worker's subscribers see the changes made by that
+  worker. Only complete with one worker, gunicorn.conf.py warns about more
+- fake://: in-process too, but through a listener thread and JSON payloads like
+  the Postgres backend, to try that path locally
+- postgresql://...: NOTIFY on commit, every worker LISTENs (psycopg2) and keeps its
+  own replay log. Postgres delivers the notifications in commit order, so every log
+  has the same order and a Last-Event-ID resumes on any worker. The listener is
+  started on first use in each worker process, so it is safe with gunicorn --preload
+
+A change whose events cannot be published (the NOTIFY connection is down) is
+committed all the same: the error is logged on the "events" logger and its events
+are dropped.
+
+Serving: asgi.py keeps the connection open with a coroutine per subscriber
+(SERVER_MODE=async). The Flask route never holds a sync worker: it answers with the
+events since Last-Event-ID and ends the response, and EventSource reconnects after
+EVENTS_RETRY_MS (default 3000). With several sync workers that needs a shared
+backend, each reconnect can land on another worker.
+"""
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+from collections import deque
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+REPLAY = 1000
+BUFFER = 100
+RETRY_MS = 3000
+KEEPALIVE = 15
+CHANNEL = "favorite_events"
+
+log = logging.getLogger("events")
+
+#ids: microseconds since the epoch, then 3 digits of the publishing process so two workers never share one.
+#they only order the events of one process, the log keeps the order the events arrived in
+ORIGIN = os.getpid() % 1000
+last_id = 0
+id_lock = threading.Lock()
+
+def next_id():
+    global last_id
+    with id_lock:
+        last_id = max(last_id + 1000, time.time_ns() // 1000 * 1000)
+        return last_id + ORIGIN
+
+#(id, user_id, payload), payload being the dict sent as data
+def make_event(user_id, op, kind, target_id, name):
+    payload = {"op": op, "type": "planet" if kind == "planet" else "people", "id": target_id, "name": name}
+    return (next_id(), user_id, payload)
+
+class Subscriber:
+    #wakeup is called from whichever thread publishes, asgi.py hands it loop.call_soon_threadsafe
+    def __init__(self, user_id, wakeup, size):
+        self.user_id = user_id
+        self.wakeup = wakeup
+        self.size = size
+        self.pending = deque()
+        self.overflowed = False
+        self.lock = threading.Lock()
+
+    def push(self, event):
+        with self.lock:
+            if self.overflowed:
+                return
+            if len(self.pending) >= self.size:
+                #a slow client is cut off and told to reload, rather than buffered without bound
+                self.overflowed = True
+                self.pending.clear()
+            else:
+                self.pending.append(event)
+        self.wakeup()
+
+    def drain(self):
+        with self.lock:
+            events = list(self.pending)
+            self.pending.clear()
+        return events
+
+class Broker:
+    #shared: the backend delivers every worker's events, not only this process's
+    def __init__(self, replay=REPLAY, buffer=BUFFER, shared=False):
+        self.log = deque(maxlen=replay) #in arrival order
+        #nothing from before the broker started is known: it counts as evicted
+        self.evicted = next_id() #highest id that fell off the log
+        self.buffer = buffer
+        self.shared = shared
+        self.subscribers = {} #user_id -> set of Subscriber
+        self.lock = threading.Lock()
+
+    def deliver(self, event):
+        with self.lock:
+            if len(self.log) == self.log.maxlen:
+                self.evicted = max(self.evicted, self.log[0][0])
+            self.log.append(event)
+            subscribers = list(self.subscribers.get(event[1], ()))
+        for subscriber in subscribers:
+            subscriber.push(event)
+
+    #the id a client that saw everything so far resumes from
+    def position(self):
+        with self.lock:
+            return self.log[-1][0] if self.log else self.evicted
+
+    #the user's events after last_id, None unless the log is known to hold all of them
+    def since(self, user_id, last_id):
+        with self.lock:
+            log = list(self.log)
+            evicted = self.evicted
+        #an event of the log: the ones that arrived after it
+        for index, event in enumerate(log):
+            if event[0] == last_id:
+                return [later for later in log[index + 1:] if later[1] == user_id]
+        #a position handed out before anything arrived, or an event gone from the log
+        if last_id < evicted:
+            return None
+        #an id of another worker, whose events this one never sees
+        if not self.shared and last_id % 1000 != ORIGIN:
+            return None
+        return [event for event in log if event[1] == user_id and event[0] > last_id]
+
+    #the stream subscribes before it reads the log with since(), so no event falls between
+    #the two; the ones it gets both ways are skipped by id
+    def subscribe(self, user_id, wakeup):
+        subscriber = Subscriber(user_id, wakeup, self.buffer)
+        with self.lock:
+            self.subscribers.setdefault(user_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.user_id, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self.subscribers.pop(subscriber.user_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {"subscribers": sum(len(subscribers) for subscribers in self.subscribers.values()), "replay": len(self.log)}
+
+def encode(event):
+    return json.dumps([event[0], event[1], event[2]], separators=(",", ":"))
+
+def decode(payload):
+    id, user_id, data = json.loads(payload)
+    return (id, user_id, data)
+
+class LocalBackend:
+    def __init__(self, broker):
+        self.broker = broker
+
+    def publish(self, events):
+        for event in events:
+            self.broker.deliver(event)
+
+#delivers from a listener thread, through the same JSON payloads as PostgresBackend
+class FakeBackend:
+    def __init__(self, broker):
+        self.broker = broker
+        self.channel = queue.Queue()
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def listen(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name="events-fake", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.broker.deliver(decode(self.channel.get()))
+
+    def publish(self, events):
+        self.listen()
+        for event in events:
+            self.channel.put(encode(event))
+
+class PostgresBackend:
+    def __init__(self, broker, url):
+        self.broker = broker
+        self.url = url
+        self.connection = None #for NOTIFY, autocommit
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        import psycopg2 #optional dependency, only needed for EVENTS_URL=postgresql://...
+        connection = psycopg2.connect(self.url)
+        connection.autocommit = True
+        return connection
+
+    #one listener thread per worker process, (re)started after a fork
+    def listen(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            if self.pid != os.getpid():
+                self.connection = None #the parent's, it must not be used here
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name="events-listen", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                connection = self.connect()
+                connection.cursor().execute(f"LISTEN {CHANNEL}")
+                while True:
+                    if select.select([connection], [], [], KEEPALIVE) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self.broker.deliver(decode(connection.notifies.pop(0).payload))
+            except Exception:
+                #database restart or network error: listen again; events in between are lost, the ids tell the clients
+                time.sleep(1)
+
+    def publish(self, events):
+        self.listen()
+        with self.lock:
+            try:
+                if self.connection is None or self.connection.closed:
+                    self.connection = self.connect()
+                cursor = self.connection.cursor()
+                for event in events:
+                    cursor.execute("SELECT pg_notify(%s, %s)", (CHANNEL, encode(event)))
+            except Exception:
+                self.connection = None
+                raise
+
+broker = Broker()
+backend = LocalBackend(broker)
+
+def init_app(app):
+    global broker, backend, RETRY_MS, KEEPALIVE
+    replay = int(app.config.get("EVENTS_REPLAY", os.getenv("EVENTS_REPLAY", 1000)))
+    buffer = int(app.config.get("EVENTS_BUFFER", os.getenv("EVENTS_BUFFER", 100)))
+    RETRY_MS = int(app.config.get("EVENTS_RETRY_MS", os.getenv("EVENTS_RETRY_MS", 3000)))
+    KEEPALIVE = float(app.config.get("EVENTS_KEEPALIVE", os.getenv("EVENTS_KEEPALIVE", 15)))
+    url = app.config.get("EVENTS_URL", os.getenv("EVENTS_URL", ""))
+    broker = Broker(replay, buffer, shared=bool(url))
+    if url == "fake://":
+        backend = FakeBackend(broker)
+    elif url.startswith(("postgres://", "postgresql://")):
+        backend = PostgresBackend(broker, url.replace("postgres://", "postgresql://"))
+    else:
+        backend = LocalBackend(broker)
+
+#favorite changes of the session's transaction, published when it commits
+def record(session, user_id, op, kind, target_id, name):
+    session.info.setdefault("events", []).append(make_event(user_id, op, kind, target_id, name))
+
+#the transaction is committed already: a failure here must not turn the request into an error
+@event.listens_for(Session, "after_commit")
+def publish_committed(session):
+    #a savepoint's release (favorites.add) isn't the commit
+    if session.in_nested_transaction():
+        return
+    events = session.info.pop("events", None)
+    if not events:
+        return
+    try:
+        backend.publish(events)
+    except Exception:
+        log.exception("could not publish %d favorite events, dropped", len(events))
+
+@event.listens_for(Session, "after_rollback")
+def forget_rolled_back(session):
+    #nor is a savepoint's rollback (a duplicate favorite), the rest of the transaction can still commit
+    if not session.in_nested_transaction():
+        session.info.pop("events", None)
+
+def last_event_id(headers, args):
+    raw = headers.get("Last-Event-ID") or args.get("last_event_id")
+    try:
+        return int(raw) if raw else None
+    except ValueError:
+        return None
+
+def format_event(event):
+    return f"id: {event[0]}\nevent: favorite\ndata: {json.dumps(event[2], sort_keys=True, separators=(',', ':'))}\n\n"
+
+def format_reset():
+    return f"id: {broker.position()}\nevent: reset\ndata: {{}}\n\n"
+
+#what a (re)connecting client gets first: the retry delay, then the events it missed or a reset,
+#and the ids of the events sent. A first connection only gets an id without data, which
+#EventSource keeps as its Last-Event-ID: the position its reconnects resume from
+def opening(user_id, last_id):
+    lines = [f"retry: {RETRY_MS}\n\n"]
+    if last_id is None:
+        lines.append(f"id: {broker.position()}\n\n")
+        return lines, set()
+    missed = broker.since(user_id, last_id)
+    if missed is None:
+        lines.append(format_reset())
+        return lines, set()
+    lines.extend(format_event(event) for event in missed)
+    return lines, {event[0] for event in missed}
+
+HEADERS = {"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"}
@@ -0,0 +1,295 @@
+"""
+Favorite writes as single statements.
+
+The unique indexes on favorite (user_id, planet_id) / (user_id, character_id) make
+the database the judge of "already a favorite", so there is no check-then-write
+race between concurrent clicks. On Postgres one statement looks the target up,
+inserts (ON CONFLICT DO NOTHING) or deletes (RETURNING), and bumps the revisions of
+the rows whose payload shows the favorite. Other databases (SQLite, MySQL) run the
+same steps as separate statements inside the request's transaction; SQLite inserts
+with ON CONFLICT DO NOTHING too, MySQL inside a savepoint.
+
+Both add() and remove() return (name, changed):
+- name is None when the target does not exist (404)
+- changed is False when it already was / was not a favorite (400)
+
+apply_batch() does the same for a list of operations in a fixed number of
+statements: one lookup per target type, one for the current favorites, one bulk
+insert, one bulk delete, one favorite_count update per type and direction and one
+revision bump per dependent table. The counts, bumps and events follow the rows the
+insert and delete actually wrote (RETURNING), not the plan: a concurrent request may
+have added or removed some of them in between.
+
+Every change written is also recorded for the favorites event feed (events.py),
+which publishes it once the transaction commits.
+"""
+from sqlalchemy import exists, func, literal, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from models import db, Favorite, Planet, Character, favorite_dependents, count_statement, utcnow
+from utils import APIException
+import cache
+import events
+
+#dialects with INSERT ... ON CONFLICT DO NOTHING, the others insert inside a savepoint
+INSERTS = {"postgresql": pg_insert, "sqlite": sqlite_insert}
+
+#kind -> (target model, favorite column pointing at it)
+KINDS = {
+    "planet": (Planet, Favorite.planet_id),
+    "character": (Character, Favorite.character_id),
+}
+
+def dependents(kind, user_id, target_ids):
+    if kind == "planet":
+        return favorite_dependents([user_id], planet_ids=target_ids)
+    return favorite_dependents([user_id], character_ids=target_ids)
+
+def bump_statement(model, condition, now, **values):
+    return db.update(model).where(condition).values(revision=model.revision + 1, updated_at=now, **values)
+
+#revision bumps for the rows that show the favorite; the target's also moves its favorite_count by delta
+#(one UPDATE per row, Postgres does not allow two updates of the same row in one statement)
+def bump_statements(kind, user_id, target_id, now, delta, changed=None):
+    target = KINDS[kind][0]
+    statements = []
+    for model, condition in dependents(kind, user_id, [target_id]):
+        if changed is not None:
+            condition = db.and_(condition, changed)
+        values = {"favorite_count": model.favorite_count + delta} if model is target else {}
+        statements.append(bump_statement(model, condition, now, **values))
+    return statements
+
+#tables whose cached responses change with a favorite (see cache.py)
+def touch(session=None):
+    cache.touch(session or db.session(), "favorite", "user", "planet", "character")
+
+#session defaults to the flask request's; asgi.py passes the sync side of its AsyncSession
+def add(kind, user_id, target_id, session=None):
+    session = session or db.session()
+    if session.get_bind().dialect.name == "postgresql":
+        return write_postgresql(session, kind, user_id, target_id, adding=True)
+    model, column = KINDS[kind]
+    name = session.execute(db.select(model.name).where(model.id == target_id)).scalar_one_or_none()
+    if name is None:
+        return None, False
+    now = utcnow()
+    values = {Favorite.user_id: user_id, column: target_id, Favorite.revision: 1, Favorite.updated_at: now}
+    if not insert_favorite(session, values):
+        return name, False
+    bump(session, kind, user_id, target_id, now, 1)
+    events.record(session, user_id, "add", kind, target_id, name)
+    return name, True
+
+def remove(kind, user_id, target_id, session=None):
+    session = session or db.session()
+    if session.get_bind().dialect.name == "postgresql":
+        return write_postgresql(session, kind, user_id, target_id, adding=False)
+    model, column = KINDS[kind]
+    name = session.execute(db.select(model.name).where(model.id == target_id)).scalar_one_or_none()
+    if name is None:
+        return None, False
+    now = utcnow()
+    deleted = session.execute(db.delete(Favorite).where(Favorite.user_id == user_id, column == target_id)).rowcount
+    if not deleted:
+        return name, False
+    bump(session, kind, user_id, target_id, now, -1)
+    events.record(session, user_id, "remove", kind, target_id, name)
+    return name, True
+
+#False when the favorite already exists
+def insert_favorite(session, values):
+    insert = INSERTS.get(session.get_bind().dialect.name)
+    if insert is not None:
+        statement = insert(Favorite).values(values).on_conflict_do_nothing().returning(Favorite.id)
+        return session.execute(statement).first() is not None
+    try:
+        #savepoint, so a duplicate only rolls back the insert and not the request's transaction
+        with session.begin_nested():
+            session.execute(db.insert(Favorite).values(values))
+    except IntegrityError:
+        return False
+    return True
+
+def bump(session, kind, user_id, target_id, now, delta):
+    for statement in bump_statements(kind, user_id, target_id, now, delta):
+        session.execute(statement)
+    touch(session)
+
+#WITH target AS (SELECT id, name ...), written AS (INSERT ... ON CONFLICT DO NOTHING | DELETE ... RETURNING id),
+#bump_n AS (UPDATE ... WHERE EXISTS (SELECT FROM written)) SELECT target.name, (SELECT count(*) FROM written) FROM target
+def write_postgresql(session, kind, user_id, target_id, adding):
+    model, column = KINDS[kind]
+    now = utcnow()
+    target = db.select(model.id, model.name).where(model.id == target_id).cte("target")
+    if adding:
+        written = pg_insert(Favorite).from_select(
+            [Favorite.user_id, column, Favorite.revision, Favorite.updated_at],
+            db.select(literal(user_id), target.c.id, literal(1), literal(now)),
+        ).on_conflict_do_nothing()
+    else:
+        written = db.delete(Favorite).where(Favorite.user_id == user_id, column.in_(db.select(target.c.id)))
+    written = written.returning(Favorite.id).cte("written")
+
+    changed = exists(db.select(written.c.id))
+    bumps = [
+        statement.cte(f"bump_{index}")
+        for index, statement in enumerate(bump_statements(kind, user_id, target_id, now, 1 if adding else -1, changed))
+    ]
+    count = db.select(func.count()).select_from(written).scalar_subquery()
+    row = session.execute(db.select(target.c.name, count).add_cte(*bumps)).one_or_none()
+    if row is None:
+        return None, False
+    if row[1]:
+        touch(session)
+        events.record(session, user_id, "add" if adding else "remove", kind, target_id, row[0])
+    return row[0], bool(row[1])
+
+#type names accepted in a batch: the URL spelling and the model spelling
+TYPES = {"planet": "planet", "planets": "planet", "people": "character", "character": "character"}
+MAX_BATCH = 500
+
+#validates {"operations": [{"op": "add" | "remove", "type": "planet" | "people", "id": 1}, ...]}
+def parse_operations(body):
+    operations = body.get("operations") if isinstance(body, dict) else None
+    if not isinstance(operations, list) or not operations:
+        raise APIException("operations must be a non empty list", status_code=400)
+    if len(operations) > MAX_BATCH:
+        raise APIException(f"At most {MAX_BATCH} operations per batch", status_code=400)
+    parsed = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get("op") not in ("add", "remove") \
+                or operation.get("type") not in TYPES or type(operation.get("id")) is not int:
+            raise APIException("Invalid operation", status_code=400, payload={"index": index, "operation": operation})
+        parsed.append((operation["op"], TYPES[operation["type"]], operation["id"]))
+    return parsed
+
+def written_keys(rows):
+    return {("planet", planet_id) if planet_id is not None else ("character", character_id) for planet_id, character_id in rows}
+
+#inserts the favorite rows that don't exist yet, returns the (kind, id) of those it inserted
+def insert_ignoring_duplicates(rows):
+    insert = INSERTS.get(db.session.get_bind().dialect.name)
+    table = Favorite.__table__
+    if insert is not None:
+        statement = insert(table).values(rows).on_conflict_do_nothing().returning(table.c.planet_id, table.c.character_id)
+        return written_keys(db.session.execute(statement))
+    #no ON CONFLICT: savepoints, as in insert_favorite(), so a duplicate only rolls back its own insert
+    try:
+        with db.session.begin_nested():
+            db.session.execute(db.insert(table), rows)
+        return written_keys((row["planet_id"], row["character_id"]) for row in rows)
+    except IntegrityError:
+        pass
+    inserted = []
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(db.insert(table).values(row))
+            inserted.append((row["planet_id"], row["character_id"]))
+        except IntegrityError:
+            pass
+    return written_keys(inserted)
+
+#deletes the user's favorites of the (kind, id) pairs, returns those it deleted
+def delete_favorites(user_id, keys):
+    condition = db.and_(Favorite.user_id == user_id, or_(*(
+        column.in_([id for kind, id in keys if kind == column_kind])
+        for column_kind, (model, column) in KINDS.items()
+    )))
+    columns = (Favorite.planet_id, Favorite.character_id)
+    if db.session.get_bind().dialect.delete_returning:
+        return written_keys(db.session.execute(db.delete(Favorite).where(condition).returning(*columns)))
+    #no RETURNING: the rows are locked first, so none of them goes away before the delete
+    deleted = written_keys(db.session.execute(db.select(*columns).where(condition).with_for_update()))
+    db.session.execute(db.delete(Favorite).where(condition))
+    return deleted
+
+def message(op, kind, name, status, email):
+    label = "Planet" if kind == "planet" else "Character"
+    if status == 404:
+        return f"{label} not found"
+    if op == "add":
+        if status == 400:
+            return f"CANNOT FAVORITE, {label} {name} is already a favorite for user {email}"
+        return f"{label} {name} SUCCESSFULLY made a favorite for user {email}"
+    if status == 400:
+        return f"CANNOT DELETE, {label} {name} is CURRENTLY NOT a favorite for user {email}"
+    return f"{label} {name} SUCCESSFULLY DELETED from favorite for user {email}"
+
+#applies the operations in order against the user's favorites and returns one (status, msg) per operation.
+#an operation sees the effect of the ones before it, only the net change is written.
+def apply_batch(user, operations):
+    names = {}
+    for kind, (model, column) in KINDS.items():
+        ids = {id for op, op_kind, id in operations if op_kind == kind}
+        names[kind] = dict(db.session.execute(db.select(model.id, model.name).where(model.id.in_(ids))).all()) if ids else {}
+
+    current = set()
+    wanted = [column.in_(names[kind]) for kind, (model, column) in KINDS.items() if names[kind]]
+    if wanted:
+        rows = db.session.execute(
+            db.select(Favorite.planet_id, Favorite.character_id).where(Favorite.user_id == user.id, or_(*wanted))
+        )
+        current = {("planet", planet_id) if planet_id is not None else ("character", character_id) for planet_id, character_id in rows}
+
+    state = set(current)
+    results = []
+    for op, kind, id in operations:
+        name = names[kind].get(id)
+        if name is None:
+            status = 404
+        elif op == "add":
+            status = 400 if (kind, id) in state else 200
+            state.add((kind, id))
+        else:
+            status = 400 if (kind, id) not in state else 200
+            state.discard((kind, id))
+        results.append((status, message(op, kind, name, status, user.email)))
+
+    added, removed = state - current, current - state
+    now = utcnow()
+    if added:
+        added = insert_ignoring_duplicates([
+            {"user_id": user.id, "planet_id": id if kind == "planet" else None,
+             "character_id": id if kind == "character" else None, "revision": 1, "updated_at": now}
+            for kind, id in sorted(added)
+        ])
+    if removed:
+        removed = delete_favorites(user.id, removed)
+    for kind, (model, column) in KINDS.items():
+        for ids, delta in (([id for k, id in added if k == kind], 1), ([id for k, id in removed if k == kind], -1)):
+            if ids:
+                db.session.execute(count_statement(model, ids, delta))
+    changed = added | removed
+    if changed:
+        planet_ids = [id for kind, id in changed if kind == "planet"]
+        character_ids = [id for kind, id in changed if kind == "character"]
+        for model, condition in favorite_dependents([user.id], planet_ids, character_ids):
+            db.session.execute(bump_statement(model, condition, now))
+        touch()
+        for op, kinds_ids in (("add", added), ("remove", removed)):
+            for kind, id in sorted(kinds_ids):
+                events.record(db.session(), user.id, op, kind, id, names[kind][id])
+    return results
+
+#recomputes favorite_count from the favorite table, for rows that drifted (e.g. after manual SQL); returns rows fixed per table
+def repair_counts():
+    fixed = {}
+    now = utcnow()
+    for kind, (model, column) in KINDS.items():
+        actual = db.select(func.count(Favorite.id)).where(column == model.id).scalar_subquery()
+        fixed[model.__tablename__] = db.session.execute(
+            bump_statement(model, model.favorite_count != actual, now, favorite_count=actual)
+        ).rowcount
+    touch()
+    return fixed
+
+#most favorited planets or characters, read straight off the favorite_count index
+def leaderboard(kind, limit):
+    model = KINDS[kind][0]
+    rows = db.session.execute(
+        db.select(model.id, model.name, model.favorite_count).order_by(model.favorite_count.desc(), model.id).limit(limit)
+    )
+    return [{"id": id, "name": name, "favorite_count": count} for id, name, count in rows]
@@ -1,20 +1,37 @@
+from collections import Counter
+from datetime import datetime, timezone
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+import passwords
+import profiling
+from replicas import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
-class User(db.Model):
+#naive UTC, what the DateTime columns store
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+#cheap version marker for conditional GETs: bumped (see before_flush below) every time the row
+#or anything shown in its serialize() payload changes, so ETags never need the payload itself
+class Versioned:
+    revision = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+class User(Versioned, db.Model):
     __tablename__ = "user"
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(120), nullable=False)
+    name = db.Column(db.String(120), nullable=False, index=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password = db.Column(db.String(80), unique=False, nullable=False)
+    password = db.Column(db.String(256), unique=False, nullable=False) #a hash, see passwords.py
     is_active = db.Column(db.Boolean(), unique=False, nullable=False)
 
     #if we receive post with new character to be created, need this
     def __init__(self, name,email,password,is_active):
         self.name = name
         self.email = email
-        self.password = password
+        self.password = passwords.hash_password(password)
         self.is_active = is_active
 
     #if we would like to print the character
@@ -22,6 +39,7 @@ class User(db.Model):
         return f'<User {self.name}>'
     
     #to send as response need to serialize to jsonify later on
+    @profiling.timed_serialize
     def serialize(self):
         return{
             "id": self.id,
@@ -31,14 +49,20 @@ class User(db.Model):
             "favorites": [favorite.serialize() for favorite in self.favorites] if self.favorites else None
         }
     
-class Planet(db.Model):
+class Planet(Versioned, db.Model):
     __tablename__="planet"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True, nullable=False)
-    terrain = db.Column(db.String(120), nullable=False)
+    terrain = db.Column(db.String(120), nullable=False, index=True)
     description = db.Column(db.String(250), nullable = False)
     location = db.Column(db.String(250), nullable = False)
     key_event = db.Column(db.String(250), nullable = False)
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default="0") #maintained by the favorite write paths, see count_statement
+
+    #serves the leaderboard without scanning favorite
+    __table_args__ = (
+        db.Index("ix_planet_favorite_count", favorite_count.desc(), id),
+    )
 
     def __init__(self,name,terrain,description,location,key_event):
         self.name = name
@@ -50,6 +74,7 @@ class Planet(db.Model):
     def __repr__(self):
         return f'<Planet {self.name}>'
     
+    @profiling.timed_serialize
     def serialize(self):
         return{
             "id": self.id,
@@ -58,20 +83,26 @@ class Planet(db.Model):
             "description":self.description,
             "location": self.location,
             "key_event": self.key_event,
+            "favorite_count": self.favorite_count,
             "residents": [resident.serialize() for resident in self.residents],
             "favorites": [favorite.serialize() for favorite in self.favorites] if self.favorites else None
         }
 
-class Character(db.Model):
+class Character(Versioned, db.Model):
     __tablename__ = "character"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True,nullable=False)
-    gender = db.Column(db.String(120), nullable=False)
-    faction = db.Column(db.String(120), nullable=False)
-    race = db.Column(db.String(120), nullable=False)
+    gender = db.Column(db.String(120), nullable=False, index=True)
+    faction = db.Column(db.String(120), nullable=False, index=True)
+    race = db.Column(db.String(120), nullable=False, index=True)
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default="0") #maintained by the favorite write paths, see count_statement
 
-    homeworld_id = db.Column(db.Integer, db.ForeignKey('planet.id'))
-    homeworld = db.relationship(Planet, backref="residents") #helps with a bi directional relationship in which we don't have to specify another and can access the residents of each planet, on the planet object.
+    homeworld_id = db.Column(db.Integer, db.ForeignKey('planet.id'), index=True)
+    homeworld = db.relationship(Planet, backref=db.backref("residents", order_by="Character.id")) #helps with a bi directional relationship in which we don't have to specify another and can access the residents of each planet, on the planet object.
+
+    __table_args__ = (
+        db.Index("ix_character_favorite_count", favorite_count.desc(), id),
+    )
 
     def __init__(self,name,gender,faction,race):
         self.name = name
@@ -82,6 +113,7 @@ class Character(db.Model):
     def __repr__(self):
         return f'<Character {self.name}>'
     
+    @profiling.timed_serialize
     def serialize(self):
         return{
             "id": self.id,
@@ -90,26 +122,40 @@ class Character(db.Model):
             "gender": self.gender,
             "race":self.race,
             "homeworld": self.homeworld.name if self.homeworld else None,
+            "favorite_count": self.favorite_count,
             "favorites": [favorite.serialize() for favorite in self.favorites] if self.favorites else None
         }
 
-class Favorite(db.Model):
+#the one-to-many backrefs are ordered by id, so serialize() lists residents and favorites in a stable order
+class Favorite(Versioned, db.Model):
     __tablename__ = "favorite"
     id = db.Column(db.Integer, primary_key=True)
 
-    user_id = db.Column(db.Integer,db.ForeignKey('user.id'))
-    user = db.relationship(User, backref="favorites") #helps with a bi directional relationship in which we don't have to specify another and can access the residents of each planet, on the planet object.
+    user_id = db.Column(db.Integer,db.ForeignKey('user.id'), index=True)
+    user = db.relationship(User, backref=db.backref("favorites", order_by="Favorite.id")) #helps with a bi directional relationship in which we don't have to specify another and can access the residents of each planet, on the planet object.
+
 
+    planet_id = db.Column(db.Integer,db.ForeignKey('planet.id'),nullable=True, index=True)
+    planet = db.relationship(Planet, backref=db.backref("favorites", order_by="Favorite.id")) #helps with a bi directional relationship in which we don't have to specify another and can access the residents of each planet, on the planet object.
 
-    planet_id = db.Column(db.Integer,db.ForeignKey('planet.id'),nullable=True)
-    planet = db.relationship(Planet, backref="favorites") #helps with a bi directional relationship in which we don't have to specify another and can access the residents of each planet, on the planet object.
 
+    character_id = db.Column(db.Integer,db.ForeignKey('character.id'),nullable=True, index=True)
+    character = db.relationship(Character, backref=db.backref("favorites", order_by="Favorite.id")) #helps with a bi directional relationship in which we don't have to specify another and can access the residents of each planet, on the planet object.
 
-    character_id = db.Column(db.Integer,db.ForeignKey('character.id'),nullable=True)
-    character = db.relationship(Character, backref="favorites") #helps with a bi directional relationship in which we don't have to specify another and can access the residents of each planet, on the planet object.
+    #a user can favorite a given planet or character only once; partial, since the other column is NULL on every row
+    __table_args__ = (
+        db.Index("uq_favorite_user_planet", "user_id", "planet_id", unique=True,
+                 postgresql_where=db.text("planet_id IS NOT NULL"), sqlite_where=db.text("planet_id IS NOT NULL")),
+        db.Index("uq_favorite_user_character", "user_id", "character_id", unique=True,
+                 postgresql_where=db.text("character_id IS NOT NULL"), sqlite_where=db.text("character_id IS NOT NULL")),
+    )
 
-    def __init__(self, user, planet=None, character=None):
-        self.user = user
+    #user_id is enough when the caller does not have the User row at hand (see auth.py)
+    def __init__(self, user=None, planet=None, character=None, user_id=None):
+        if user is not None:
+            self.user = user
+        else:
+            self.user_id = user_id
         self.planet = planet
         self.character = character
 
@@ -120,6 +166,7 @@ class Favorite(db.Model):
     def __repr__(self):
         return f'<Favorite {self.id}>'
     
+    @profiling.timed_serialize
     def serialize(self):
         return{
             "id": self.id,
@@ -128,3 +175,114 @@ class Favorite(db.Model):
             "character": self.character.name if self.character else None
         }
 
+
+
+def bump(obj):
+    obj.revision = type(obj).revision + 1
+    obj.updated_at = utcnow()
+
+#bumps every row matching condition with a single UPDATE
+def bump_where(session, model, condition):
+    session.connection().execute(
+        db.update(model).where(condition).values(revision=model.revision + 1, updated_at=utcnow())
+    )
+
+#rows whose payload shows a favorite: its user, its planet or character, and that character's homeworld (planets list their residents' favorites)
+def favorite_dependents(user_ids=(), planet_ids=(), character_ids=()):
+    user_ids, planet_ids, character_ids = ([id for id in ids if id is not None] for ids in (user_ids, planet_ids, character_ids))
+    dependents = []
+    if user_ids:
+        dependents.append((User, User.id.in_(user_ids)))
+    if planet_ids:
+        dependents.append((Planet, Planet.id.in_(planet_ids)))
+    if character_ids:
+        dependents.append((Character, Character.id.in_(character_ids)))
+        dependents.append((Planet, Planet.id.in_(db.select(Character.homeworld_id).where(Character.id.in_(character_ids)))))
+    return dependents
+
+#a name shows up in other rows' payloads too: homeworld of residents and the user/planet/character of favorites
+def propagate_rename(session, obj):
+    if isinstance(obj, Planet):
+        bump_where(session, Character, Character.homeworld_id == obj.id)
+        bump_where(session, User, User.id.in_(db.select(Favorite.user_id).where(Favorite.planet_id == obj.id)))
+    elif isinstance(obj, Character):
+        bump_where(session, User, User.id.in_(db.select(Favorite.user_id).where(Favorite.character_id == obj.id)))
+    elif isinstance(obj, User):
+        characters = db.select(Favorite.character_id).where(Favorite.user_id == obj.id)
+        #the favorited planets, and the homeworlds of the favorited characters as in favorite_dependents
+        bump_where(session, Planet, db.or_(
+            Planet.id.in_(db.select(Favorite.planet_id).where(Favorite.user_id == obj.id)),
+            Planet.id.in_(db.select(Character.homeworld_id).where(Character.id.in_(characters))),
+        ))
+        bump_where(session, Character, Character.id.in_(characters))
+
+FAVORITE_TARGETS = ("user", "planet", "character")
+
+#user/planet/character ids a favorite will have once flushed, relationships win over the FK columns
+def flushed_targets(favorite):
+    loaded = inspect(favorite).dict
+    ids = {}
+    for name in FAVORITE_TARGETS:
+        if name in loaded:
+            ids[name] = loaded[name].id if loaded[name] is not None else None
+        else:
+            ids[name] = loaded.get(name + "_id")
+    return ids
+
+#user/planet/character ids a favorite has in the database
+def persisted_targets(favorite):
+    state = inspect(favorite)
+    return {name: state.committed_state.get(name + "_id", state.dict.get(name + "_id")) for name in FAVORITE_TARGETS}
+
+#keeps Planet/Character.favorite_count in step with the favorite table
+def count_statement(model, ids, delta):
+    return db.update(model).where(model.id.in_(ids)).values(favorite_count=model.favorite_count + delta)
+
+@event.listens_for(Session, "before_flush")
+def maintain_revisions(session, flush_context, instances):
+    touched = set()
+    unloaded = [] #(model, condition) for rows to bump without loading them
+    counts = Counter() #(model, id) -> change of favorite_count
+    with session.no_autoflush:
+        for obj in (*session.new, *session.dirty, *session.deleted):
+            if not isinstance(obj, Versioned):
+                continue
+            if obj in session.dirty and session.is_modified(obj):
+                touched.add(obj)
+            loaded = inspect(obj).dict
+            if isinstance(obj, Favorite):
+                old_ids = {} if obj in session.new else persisted_targets(obj)
+                new_ids = {} if obj in session.deleted else flushed_targets(obj)
+                unloaded.extend(favorite_dependents(
+                    *([old_ids.get(name), new_ids.get(name)] for name in ("user", "planet", "character"))
+                ))
+                for name, model in (("planet", Planet), ("character", Character)):
+                    if old_ids.get(name) != new_ids.get(name):
+                        counts[(model, old_ids.get(name))] -= 1
+                        counts[(model, new_ids.get(name))] += 1
+                    #a target inserted in this same flush has no id yet, count it on the object
+                    target = loaded.get(name)
+                    if obj in session.new and target is not None and target in session.new:
+                        target.favorite_count = (target.favorite_count or 0) + 1
+            elif isinstance(obj, Character):
+                #the old and the new homeworld both list (or listed) this character as a resident,
+                #until the flush homeworld_id still holds the old one
+                if loaded.get("homeworld") is not None:
+                    touched.add(loaded["homeworld"])
+                if obj.homeworld_id is not None:
+                    unloaded.append((Planet, Planet.id == obj.homeworld_id))
+
+        for obj in touched:
+            #new rows start at revision 1 and deleted rows need no version
+            if not inspect(obj).persistent or obj in session.deleted:
+                continue
+            bump(obj)
+            if obj in session.dirty and "name" in inspect(obj).attrs and inspect(obj).attrs.name.history.has_changes():
+                propagate_rename(session, obj)
+
+        for model, condition in unloaded:
+            bump_where(session, model, condition)
+
+        for (model, id), delta in counts.items():
+            if id is not None and delta:
+                session.connection().execute(count_statement(model, [id], delta))
@@ -0,0 +1,219 @@
+"""
+Keyset (cursor) pagination, field projection, relationship expansion, filters,
+search and sorting shared by the collection endpoints.
+
+    GET /people?limit=20&after=<cursor>&fields=id,name&expand=favorites
+    GET /people?faction=Jedi&homeworld=Tatooine&q=sky&sort=-favorite_count
+
+A client that sends none of these parameters keeps getting the legacy response
+(the whole table, fully nested). As soon as one of them is present the response
+becomes {"results": [...], "next": <cursor or null>} and nested relationships
+are only built when they are named in expand=.
+
+Filters are exact matches, name= is a prefix search and q= a substring search
+(see search.py). sort= takes one sortable field, with a leading "-" for
+descending order; ties are broken by id so the cursor stays stable.
+"""
+import base64
+import binascii
+import json
+from flask import request, jsonify
+from sqlalchemy.orm import load_only, joinedload, selectinload
+from utils import APIException
+from models import db, User, Character, Planet
+from queries import favorites_of
+import search
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+PARAMS = ("limit", "after", "fields", "expand", "sort", "name", "q")
+
+def serialize_favorites(favorites):
+    return [favorite.serialize() for favorite in favorites] if favorites else None
+
+class Collection:
+    #columns: plain columns that can be requested in fields=
+    #computed: name -> (loader option, getter) for values that are not plain columns
+    #expand: name -> (loader option, getter) for nested relationships
+    #filters: query string parameter -> function building the WHERE condition from its value
+    #sortable: columns accepted by sort=
+    def __init__(self, model, columns, computed=None, expand=None, filters=None, sortable=("id",)):
+        self.model = model
+        self.columns = columns
+        self.computed = computed or {}
+        self.expand = expand or {}
+        self.filters = filters or {}
+        self.sortable = sortable
+
+    def fields(self):
+        return list(self.columns) + list(self.computed)
+
+    def statement(self, fields, expand, sort="id"):
+        #the sort column is always loaded, the next cursor is built from it
+        columns = [getattr(self.model, name) for name in dict.fromkeys([*fields, sort]) if name in self.columns]
+        options = [load_only(*columns)] if columns else [load_only(self.model.id)]
+        options += [self.computed[name][0] for name in fields if name in self.computed]
+        options += [self.expand[name][0] for name in expand]
+        return db.select(self.model).options(*options)
+
+    def serialize(self, obj, fields, expand):
+        row = {}
+        for name in fields:
+            row[name] = self.computed[name][1](obj) if name in self.computed else getattr(obj, name)
+        for name in expand:
+            row[name] = self.expand[name][1](obj)
+        return row
+
+def homeworld_filter(value):
+    #isdecimal(), not isdigit(): "²" is a digit int() does not take
+    if value.isdecimal():
+        return Character.homeworld_id == int(value)
+    return Character.homeworld_id.in_(db.select(Planet.id).where(Planet.name == value))
+
+PEOPLE = Collection(
+    Character,
+    columns=("id", "name", "faction", "gender", "race", "favorite_count"),
+    computed={
+        "homeworld": (
+            joinedload(Character.homeworld).load_only(Planet.name),
+            lambda character: character.homeworld.name if character.homeworld else None,
+        ),
+    },
+    expand={
+        "favorites": (favorites_of(Character.favorites), lambda character: serialize_favorites(character.favorites)),
+    },
+    filters={
+        "faction": lambda value: Character.faction == value,
+        "race": lambda value: Character.race == value,
+        "gender": lambda value: Character.gender == value,
+        "homeworld": homeworld_filter, #id or name
+    },
+    sortable=("id", "name", "faction", "race", "favorite_count"),
+)
+
+PLANETS = Collection(
+    Planet,
+    columns=("id", "name", "terrain", "description", "location", "key_event", "favorite_count"),
+    expand={
+        #residents are serialized in full, like Planet.serialize() does
+        "residents": (
+            selectinload(Planet.residents).options(favorites_of(Character.favorites)),
+            lambda planet: [resident.serialize() for resident in planet.residents],
+        ),
+        "favorites": (favorites_of(Planet.favorites), lambda planet: serialize_favorites(planet.favorites)),
+    },
+    filters={
+        "terrain": lambda value: Planet.terrain == value,
+    },
+    sortable=("id", "name", "terrain", "favorite_count"),
+)
+
+USERS = Collection(
+    User,
+    columns=("id", "name", "email", "is_active"),
+    expand={
+        "favorites": (favorites_of(User.favorites), lambda user: serialize_favorites(user.favorites)),
+    },
+    sortable=("id", "name", "email"),
+)
+
+def requested(collection):
+    return any(name in request.args for name in (*PARAMS, *collection.filters))
+
+#a plain id when sorting by id, [sort value, id] otherwise
+def encode_cursor(id, value=None, sort="id"):
+    raw = str(id) if sort == "id" else json.dumps([value, id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+#returns (sort value, id); the sort value has the type of the sort column, or is None if it is nullable
+def decode_cursor(cursor, collection, sort="id"):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        decoded = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise APIException("Invalid cursor", status_code=400)
+    if sort == "id" and type(decoded) is int:
+        return None, decoded
+    if sort != "id" and isinstance(decoded, list) and len(decoded) == 2 and type(decoded[1]) is int:
+        column = getattr(collection.model, sort)
+        if type(decoded[0]) is column.type.python_type or (decoded[0] is None and column.nullable):
+            return decoded[0], decoded[1]
+    raise APIException("Invalid cursor for this sort", status_code=400)
+
+def parse_list(name, allowed):
+    raw = request.args.get(name, "")
+    values = [value.strip() for value in raw.split(",") if value.strip()]
+    unknown = [value for value in values if value not in allowed]
+    if unknown:
+        raise APIException(f"Unknown {name}: {', '.join(unknown)}", status_code=400, payload={"allowed": list(allowed)})
+    #keep the client's order but drop duplicates
+    return list(dict.fromkeys(values))
+
+#?limit=, also used by the leaderboards
+def parse_limit(default=DEFAULT_LIMIT, maximum=MAX_LIMIT):
+    try:
+        limit = int(request.args.get("limit", default))
+    except ValueError:
+        raise APIException("limit must be an integer", status_code=400)
+    if limit < 1:
+        raise APIException("limit must be positive", status_code=400)
+    return min(limit, maximum)
+
+#returns (column name, descending)
+def parse_sort(collection):
+    raw = request.args.get("sort", "id").strip()
+    name = raw.lstrip("-")
+    if name not in collection.sortable:
+        raise APIException(f"Cannot sort by {name}", status_code=400, payload={"allowed": list(collection.sortable)})
+    return name, raw.startswith("-")
+
+def conditions(collection):
+    model = collection.model
+    where = [build(request.args[name]) for name, build in collection.filters.items() if name in request.args]
+    if request.args.get("name"):
+        where.append(search.starts_with(model, request.args["name"]))
+    if request.args.get("q"):
+        where.append(search.contains(model, request.args["q"]))
+    return where
+
+#rows strictly after the cursor in (sort, id) order
+def keyset(collection, sort, descending, cursor):
+    model = collection.model
+    value, id = decode_cursor(cursor, collection, sort)
+    if sort == "id":
+        return model.id < id if descending else model.id > id
+    column = getattr(model, sort)
+    beyond = column < value if descending else column > value
+    return db.or_(beyond, db.and_(column == value, model.id > id))
+
+#parses the shared query string: returns (statement, fields, expand, sort) with filters, keyset condition and order applied.
+#expand defaults to nothing, or to every relationship with expand_all (the legacy shape).
+def parse(collection, expand_all=False):
+    fields = parse_list("fields", collection.fields()) or collection.fields()
+    if expand_all and "expand" not in request.args:
+        expand = list(collection.expand)
+    else:
+        expand = parse_list("expand", collection.expand)
+    sort, descending = parse_sort(collection)
+    statement = collection.statement(fields, expand, sort).where(*conditions(collection))
+    after = request.args.get("after")
+    if after:
+        statement = statement.where(keyset(collection, sort, descending, after))
+    if sort != "id":
+        column = getattr(collection.model, sort)
+        statement = statement.order_by(column.desc() if descending else column)
+    #ties are broken by ascending id, unless the sort is -id itself
+    last = collection.model.id.desc() if sort == "id" and descending else collection.model.id
+    return statement.order_by(last), fields, expand, sort
+
+#one page of a collection, fetching one extra row to know whether there is a next page
+def page(collection):
+    statement, fields, expand, sort = parse(collection)
+    limit = parse_limit()
+    rows = db.session.execute(statement.limit(limit + 1)).unique().scalars().all()
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last.id, getattr(last, sort), sort)
+    results = [collection.serialize(obj, fields, expand) for obj in rows[:limit]]
+    return jsonify({"results": results, "next": next_cursor}), 200
@@ -0,0 +1,133 @@
+"""
+Password hashing for login().
+
+Hashes are werkzeug's "method$salt$hash" strings; PASSWORD_HASH_METHOD sets the KDF
+and its cost (default "scrypt:32768:8:1", e.g. "pbkdf2:sha256:600000" for a cheaper
+one). The KDF runs in a bounded thread pool: hashlib releases the GIL while it
+works, so other request threads stay responsive, and at most PASSWORD_HASH_WORKERS
+hashes run at once.
+
+verify() and rehash() block the calling thread until the hash is done, so a Flask
+request thread is held for the duration of one KDF. They don't queue: with every
+worker busy they raise PoolBusy right away and the login is refused with 503, rather
+than holding a request thread while it waits for a worker. An async caller awaits
+verify_async()/rehash_async() without holding a thread, so those queue, up to
+PASSWORD_HASH_QUEUE more hashes; past that they raise PoolBusy too.
+
+Rows still holding a plaintext password (from before hashing) or a hash made with
+an older cost are rehashed on the next successful login.
+
+A per-email token bucket (LOGIN_RATE_LIMIT attempts per LOGIN_RATE_WINDOW seconds)
+answers 429 before any hashing is done, so a login storm on one account can't
+burn the pool.
+"""
+import asyncio
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+DEFAULT_METHOD = "scrypt:32768:8:1"
+METHOD_PREFIXES = ("scrypt:", "pbkdf2:")
+
+class PoolBusy(Exception):
+    pass
+
+class HashPool:
+    def __init__(self, workers=None, queue=None, method=DEFAULT_METHOD):
+        self.workers = workers or os.cpu_count() or 2
+        self.method = method
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="kdf")
+        #running + waiting
+        self.limit = self.workers + (queue if queue is not None else self.workers * 4)
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    #queue=False only takes a free worker
+    def submit(self, function, *args, queue=True):
+        with self.lock:
+            if self.pending >= (self.limit if queue else self.workers):
+                raise PoolBusy()
+            self.pending += 1
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(self.done)
+        return future
+
+    def done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+class RateLimiter:
+    def __init__(self, attempts=10, window=60, max_keys=100000):
+        self.rate = attempts / window
+        self.capacity = attempts
+        self.max_keys = max_keys
+        self.buckets = OrderedDict() #key -> (tokens, last refill)
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+            #the least recently seen keys go first, a forgotten key simply starts with a full bucket
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return allowed
+
+pool = HashPool()
+limiter = RateLimiter()
+
+def init_app(app):
+    global pool, limiter
+    config = lambda name, default: app.config.get(name, os.getenv(name, default))
+    workers = int(config("PASSWORD_HASH_WORKERS", 0)) or None
+    queue = config("PASSWORD_HASH_QUEUE", None)
+    pool = HashPool(workers, int(queue) if queue is not None else None, config("PASSWORD_HASH_METHOD", DEFAULT_METHOD))
+    limiter = RateLimiter(int(config("LOGIN_RATE_LIMIT", 10)), float(config("LOGIN_RATE_WINDOW", 60)))
+
+def is_hashed(stored):
+    return stored.startswith(METHOD_PREFIXES) and stored.count("$") == 2
+
+def hash_password(password):
+    return generate_password_hash(password, method=pool.method)
+
+def check(stored, password):
+    if stored is None:
+        #unknown email: spend the same work as a real check so response times don't reveal which emails exist
+        check_password_hash(dummy_hash(), password)
+        return False
+    if not is_hashed(stored):
+        return hmac.compare_digest(stored.encode(), password.encode())
+    return check_password_hash(stored, password)
+
+#unknown emails are checked against this, made with the current method on first use
+DUMMY = None
+
+def dummy_hash():
+    global DUMMY
+    if DUMMY is None or not DUMMY.startswith(pool.method + "$"):
+        DUMMY = generate_password_hash("dummy password", method=pool.method)
+    return DUMMY
+
+#PASSWORD_HASH_METHOD must be spelled in full (with its cost parameters), it is compared with the stored prefix
+def needs_rehash(stored):
+    return not stored.startswith(pool.method + "$")
+
+#blocking check in the KDF pool, raises PoolBusy when no worker is free
+def verify(stored, password):
+    return pool.submit(check, stored, password, queue=False).result()
+
+async def verify_async(stored, password):
+    return await asyncio.wrap_future(pool.submit(check, stored, password))
+
+def rehash(password):
+    return pool.submit(hash_password, password, queue=False).result()
+
+async def rehash_async(password):
+    return await asyncio.wrap_future(pool.submit(hash_password, password))
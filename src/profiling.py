@@ -0,0 +1,254 @@
+"""
+Per request profile: SQL, serialize() and JSON encoding time.
+
+Every request handled by the Flask app records
+- the number of queries and the time spent in them (SQLAlchemy engine events),
+  including the lazy loads run while serializing
+- the time spent in the models' serialize() (outermost call only, nested
+  serialize() calls and their lazy loads are part of it)
+- the time spent encoding JSON
+- the response size
+
+and answers with a Server-Timing header (SERVER_TIMING=0 leaves it out):
+
+    Server-Timing: db;dur=3.1;desc="4 queries", serialize;dur=1.2;desc="0 lazy loads", json;dur=0.4, total;dur=6.0
+
+A streamed response (streaming.py, the Server-Sent Events feed) runs its queries and
+encodes its JSON while the body is sent, after the headers are: its Server-Timing
+header only covers the time until then and says so with a "streamed" entry, and its
+histograms are recorded once the body is closed, with the bytes actually sent.
+
+The same values feed per route histograms served in the Prometheus text format on
+GET /metrics, next to the counters of the response cache (hits and misses per
+route, invalidations per tag, see cache.py). They are per process: scrape every
+worker, or run one.
+
+Queries slower than SLOW_QUERY_MS (default 200, 0 to turn off) are logged on the
+"slow_queries" logger with their route.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, has_request_context, request, request_started
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+slow_queries = logging.getLogger("slow_queries")
+SLOW_QUERY_MS = 200
+
+class Profile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.serialize = 0.0
+        self.lazy_loads = 0
+        self.json = 0.0
+        self.serializing = False
+
+    #counts another request's profile in this one (batch.py's sub-requests)
+    def add(self, other):
+        self.queries += other.queries
+        self.db += other.db
+        self.serialize += other.serialize
+        self.lazy_loads += other.lazy_loads
+        self.json += other.json
+
+def current():
+    return g.get("profile") if has_request_context() else None
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels=("route", "method")):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        self.series = {} #label values -> [count per bucket..., count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, values, amount):
+        with self.lock:
+            series = self.series.setdefault(values, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    series[index] += 1
+            series[-2] += 1
+            series[-1] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {values: list(counts) for values, counts in self.series.items()}
+        for values, counts in sorted(series.items()):
+            labels = ",".join(f'{label}="{value}"' for label, value in zip(self.labels, values))
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {counts[-2]}')
+            lines.append(f"{self.name}_count{{{labels}}} {counts[-2]}")
+            lines.append(f"{self.name}_sum{{{labels}}} {round(counts[-1], 6)}")
+        return lines
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {} #label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, values, amount=1):
+        with self.lock:
+            self.series[values] = self.series.get(values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            series = dict(self.series)
+        for values, count in sorted(series.items()):
+            labels = ",".join(f'{label}="{value}"' for label, value in zip(self.labels, values))
+            lines.append(f"{self.name}{{{labels}}} {count}")
+        return lines
+
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+HISTOGRAMS = {
+    "total": Histogram("http_request_duration_seconds", "Time to build the response.", SECONDS),
+    "db": Histogram("http_request_db_seconds", "Time spent running SQL per request.", SECONDS),
+    "queries": Histogram("http_request_queries", "SQL statements run per request.", (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)),
+    "serialize": Histogram("http_request_serialize_seconds", "Time spent in serialize() per request.", SECONDS),
+    "json": Histogram("http_request_json_seconds", "Time spent encoding JSON per request.", SECONDS),
+    "size": Histogram("http_response_size_bytes", "Response body size.", (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)),
+}
+
+COUNTERS = {
+    "cache": Counter("http_response_cache_lookups_total", "Response cache lookups of the cached routes.", ("route", "result")),
+    "invalidations": Counter("http_response_cache_invalidations_total", "Cache tags invalidated by committed writes.", ("tag",)),
+}
+
+def init_app(app):
+    global SLOW_QUERY_MS
+    SLOW_QUERY_MS = float(app.config.get("SLOW_QUERY_MS", os.getenv("SLOW_QUERY_MS", 200)))
+    header = str(app.config.get("SERVER_TIMING", os.getenv("SERVER_TIMING", "1"))).lower() in ("1", "true", "yes", "on")
+    request_started.connect(start_profile, app, weak=False)
+    #registered first, so it runs after every other after_request function
+    app.after_request_funcs.setdefault(None, []).insert(0, lambda response: finish_profile(response, header))
+    timed_json(app.json)
+
+def start_profile(sender, **extra):
+    g.profile = Profile()
+
+def finish_profile(response, header):
+    profile = current()
+    if profile is None:
+        return response
+    total = time.perf_counter() - profile.start
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    values = (route, request.method)
+    if response.is_streamed:
+        sent = [0]
+        response.response = counted(response.response, sent)
+        response.call_on_close(lambda: record(values, profile, time.perf_counter() - profile.start, sent[0]))
+    else:
+        record(values, profile, total, response.calculate_content_length() or 0)
+    if header:
+        timings = [
+            f'db;dur={profile.db * 1000:.2f};desc="{profile.queries} queries"',
+            f'serialize;dur={profile.serialize * 1000:.2f};desc="{profile.lazy_loads} lazy loads"',
+            f"json;dur={profile.json * 1000:.2f}",
+            f"total;dur={total * 1000:.2f}",
+        ]
+        if response.is_streamed:
+            timings.append('streamed;desc="until the headers, the body is on /metrics"')
+        response.headers["Server-Timing"] = ", ".join(timings)
+    return response
+
+def record(values, profile, total, size):
+    HISTOGRAMS["total"].observe(values, total)
+    HISTOGRAMS["db"].observe(values, profile.db)
+    HISTOGRAMS["queries"].observe(values, profile.queries)
+    HISTOGRAMS["serialize"].observe(values, profile.serialize)
+    HISTOGRAMS["json"].observe(values, profile.json)
+    HISTOGRAMS["size"].observe(values, size)
+
+#a streamed body, counting the bytes sent
+def counted(chunks, sent):
+    for chunk in chunks:
+        sent[0] += len(chunk.encode() if isinstance(chunk, str) else chunk)
+        yield chunk
+
+#wraps the JSON provider's dumps(), which jsonify() and the streaming responses go through
+def timed_json(provider):
+    dumps = provider.dumps
+    @wraps(dumps)
+    def timed(obj, **kwargs):
+        profile = current()
+        if profile is None:
+            return dumps(obj, **kwargs)
+        start = time.perf_counter()
+        try:
+            return dumps(obj, **kwargs)
+        finally:
+            profile.json += time.perf_counter() - start
+    provider.dumps = timed
+
+#decorates the models' serialize()
+def timed_serialize(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profile = current()
+        if profile is None or profile.serializing:
+            return method(self, *args, **kwargs)
+        profile.serializing = True
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            profile.serializing = False
+            profile.serialize += time.perf_counter() - start
+    return wrapper
+
+#times a block as serialize(), for payloads built without the models' serialize() (see serializers.py)
+@contextmanager
+def serializing():
+    profile = current()
+    if profile is None or profile.serializing:
+        yield
+        return
+    profile.serializing = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.serializing = False
+        profile.serialize += time.perf_counter() - start
+
+@event.listens_for(Engine, "before_cursor_execute")
+def query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def query_finished(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    profile = current()
+    if profile is not None:
+        profile.queries += 1
+        profile.db += elapsed
+        if profile.serializing:
+            profile.lazy_loads += 1
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        route = request.path if has_request_context() else "-"
+        slow_queries.warning("%.1f ms %s %s", elapsed * 1000, route, " ".join(statement.split())[:2000])
+
+#a failed statement never reaches after_cursor_execute
+@event.listens_for(Engine, "handle_error")
+def query_failed(context):
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+def metrics():
+    lines = []
+    for metric in (*HISTOGRAMS.values(), *COUNTERS.values()):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
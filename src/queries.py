@@ -0,0 +1,59 @@
+"""
+Query layer for the endpoints: every query here loads exactly the relationship
+graph that the matching serialize() walks, so a response is built in a fixed
+number of SELECTs no matter how many rows it contains.
+"""
+from sqlalchemy.orm import joinedload, selectinload
+from models import db, User, Character, Planet, Favorite
+
+#Favorite.serialize() reads user.name, planet.name and character.name, all many-to-one, so they ride along in the same query as the favorite
+def favorite_names():
+    return (
+        joinedload(Favorite.user),
+        joinedload(Favorite.planet),
+        joinedload(Favorite.character),
+    )
+
+#loads a one-to-many "favorites" backref in one extra query (favorites + their names)
+def favorites_of(relationship):
+    return selectinload(relationship).options(*favorite_names())
+
+#Character.serialize() needs homeworld and favorites
+def character_graph():
+    return (
+        joinedload(Character.homeworld),
+        favorites_of(Character.favorites),
+    )
+
+#Planet.serialize() needs residents (each one serialized as a character) and favorites.
+#resident.homeworld is the planet itself, already in the identity map, so it costs no query.
+def planet_graph():
+    return (
+        selectinload(Planet.residents).options(favorites_of(Character.favorites)),
+        favorites_of(Planet.favorites),
+    )
+
+#User.serialize() only needs favorites
+def user_graph():
+    return (
+        favorites_of(User.favorites),
+    )
+
+#a SELECT rather than session.get(): get() hands back a row already in the identity map (e.g. the homeworld
+#of a character a batch sub-request loaded) without its graph, the SELECT eager loads what it is missing
+def get_one(model, id, graph):
+    return db.session.execute(db.select(model).options(*graph).where(model.id == id)).scalar_one_or_none()
+
+def get_character(id):
+    return get_one(Character, id, character_graph())
+
+def get_planet(id):
+    return get_one(Planet, id, planet_graph())
+
+def get_user(id):
+    return get_one(User, id, user_graph())
+
+#rows with the given ids and their graph in one IN query (plus the graph's selectin loads), by id
+def get_many(model, ids, graph):
+    rows = db.session.execute(db.select(model).options(*graph).where(model.id.in_(ids))).scalars().all()
+    return {row.id: row for row in rows}
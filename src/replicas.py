@@ -0,0 +1,171 @@
+"""
+Read replicas for GET requests.
+
+    DATABASE_REPLICA_URLS=postgresql://replica-1/db,postgresql://replica-2/db
+
+GET/HEAD requests run their queries on the replicas, taken round-robin, one per
+request. Everything else, and anything that writes, runs on the primary
+(SQLALCHEMY_DATABASE_URI). A replica that fails its health check (SELECT 1, at most
+every REPLICA_CHECK_INTERVAL seconds) is skipped until it passes again. With every
+replica down, reads go to the primary.
+
+Replicas lag behind the primary, so reads go to the primary anyway when:
+- the caller made a successful write in the last REPLICA_STICKY_SECONDS, so they
+  see their own favorite changes (read-your-writes)
+- the page is a Flask-Admin one
+- a cached route misses and the replica may not have the last write to the
+  entry's tables yet. The response cache is shared by every caller, so it is only
+  filled from a replica whose lag is at most REPLICA_CACHE_MAX_LAG seconds (1 by
+  default) when that write is older than that. The lag is measured by the health
+  check on Postgres; a replica whose lag can't be measured never fills the cache
+
+Without DATABASE_REPLICA_URLS everything runs on the primary as before. The async
+serving mode (asgi.py) reads the primary.
+"""
+import itertools
+import os
+import threading
+import time
+from flask import current_app, g, request
+from flask_jwt_extended import decode_token
+from sqlalchemy import create_engine, text
+from flask_sqlalchemy.session import Session
+import cache
+import database
+
+#seconds the replica is behind the primary. 0 when it has replayed everything it received
+#(an idle primary sends nothing, so the age of the last replayed transaction alone would grow)
+LAG_QUERIES = {
+    "postgresql": "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                  "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END",
+}
+
+class Replicas:
+    def __init__(self, engines, check_interval=5, max_lag=1):
+        self.engines = engines
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.turn = itertools.count()
+        self.checks = {} #engine -> (healthy, lag, checked at)
+        self.lock = threading.Lock()
+
+    def healthy(self, engine):
+        healthy, lag, checked_at = self.checks.get(engine, (None, None, 0))
+        now = time.monotonic()
+        if now - checked_at < self.check_interval:
+            return healthy
+        query = LAG_QUERIES.get(engine.url.get_backend_name())
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+                lag = float(connection.execute(text(query)).scalar()) if query else None
+            healthy = True
+        except Exception:
+            healthy, lag = False, None
+        with self.lock:
+            self.checks[engine] = (healthy, lag, now)
+        return healthy
+
+    #as of the last health check, None when it can't be measured
+    def lag(self, engine):
+        return self.checks.get(engine, (None, None))[1]
+
+    #next healthy replica, None when they are all down
+    def choose(self):
+        for _ in range(len(self.engines)):
+            engine = self.engines[next(self.turn) % len(self.engines)]
+            if self.healthy(engine):
+                return engine
+        return None
+
+    def status(self):
+        return [
+            {"url": engine.url.render_as_string(hide_password=True), "healthy": self.checks.get(engine, (None,))[0],
+             "lag": self.lag(engine), "pool": database.pool_stats(engine.pool)}
+            for engine in self.engines
+        ]
+
+replicas = Replicas([])
+#callers that wrote recently and read from the primary, set up by init_app()
+writers = None
+
+class RoutingSession(Session):
+    #session.info["replica"] is set for GET requests by route_request(), the chosen replica is kept for the rest of the request
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if not self.info.get("replica") or bind is not None or engine is not self._db.engine:
+            return engine
+        if self._flushing or getattr(clause, "is_dml", False):
+            return engine
+        return chosen(self.info) or engine
+
+def chosen(info):
+    if "replica_engine" not in info:
+        info["replica_engine"] = replicas.choose()
+    return info["replica_engine"]
+
+def init_app(app):
+    global replicas, writers
+    urls = app.config.get("DATABASE_REPLICA_URLS", os.getenv("DATABASE_REPLICA_URLS", ""))
+    urls = [url.strip().replace("postgres://", "postgresql://") for url in urls.split(",") if url.strip()]
+    if not urls:
+        return
+    engines = [create_engine(url, **database.engine_options(app, url)) for url in urls]
+    for engine in engines:
+        database.track(engine)
+    replicas = Replicas(
+        engines,
+        float(app.config.get("REPLICA_CHECK_INTERVAL", os.getenv("REPLICA_CHECK_INTERVAL", 5))),
+        float(app.config.get("REPLICA_CACHE_MAX_LAG", os.getenv("REPLICA_CACHE_MAX_LAG", 1))),
+    )
+    sticky = int(app.config.get("REPLICA_STICKY_SECONDS", os.getenv("REPLICA_STICKY_SECONDS", 10)))
+    #a write must be seen by every worker, so the marker goes to the shared cache when there is one
+    if isinstance(cache.backend, cache.SharedCache):
+        writers = cache.SharedCache(cache.backend.client, ttl=sticky, prefix=cache.backend.prefix + "writer:")
+    else:
+        writers = cache.LRUCache(maxsize=100000, ttl=sticky)
+    app.before_request(route_request)
+    app.after_request(remember_writer)
+
+def enabled():
+    return bool(replicas.engines)
+
+#the token's identity without the user lookup of @jwt_required(), None for anonymous or invalid tokens
+def caller_identity():
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        return None
+    try:
+        return str(decode_token(header[len("Bearer "):].strip())["sub"])
+    except Exception:
+        return None
+
+def route_request():
+    g.caller_identity = caller_identity()
+    #Flask-Admin shows the rows it just saved
+    if request.method not in ("GET", "HEAD") or request.path.startswith("/admin"):
+        return
+    if g.caller_identity is not None and writers.get(g.caller_identity, ("writes",))[0] is not None:
+        return
+    current_app.extensions["sqlalchemy"].session.info["replica"] = True
+
+def remember_writer(response):
+    if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400 and g.get("caller_identity"):
+        writers.set(g.caller_identity, True, ("writes",))
+    return response
+
+#whether the request's reads see every write committed before `since` (a wall clock time):
+#it reads the primary, or a replica at most max_lag behind with `since` older than that
+def caught_up(since):
+    session = current_app.extensions["sqlalchemy"].session
+    if not session.info.get("replica"):
+        return True
+    engine = chosen(session.info)
+    if engine is None:
+        return True
+    lag = replicas.lag(engine)
+    return lag is not None and lag <= replicas.max_lag and time.time() - since > replicas.max_lag
+
+#the rest of the request reads from the primary
+def use_primary():
+    current_app.extensions["sqlalchemy"].session.info.pop("replica", None)
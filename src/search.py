@@ -0,0 +1,47 @@
+"""
+Name search for the collections, case insensitive.
+
+    ?name=sky  prefix match      ("Skywalker")
+    ?q=walk    substring match   ("Luke Skywalker")
+
+On Postgres both are ILIKE patterns served by the pg_trgm GIN index on name. On
+SQLite they go through the <table>_fts FTS5 tables (trigram tokenizer) when the
+migrations created them; with fewer than 3 characters, or when the FTS table is
+missing (e.g. a database made with db.create_all()), they fall back to LIKE.
+"""
+from sqlalchemy import inspect, text
+from models import db
+
+#engine url -> set of tables that have an FTS index
+fts_tables = {}
+
+def escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def has_fts(model):
+    engine = db.session.get_bind()
+    if engine.dialect.name != "sqlite":
+        return False
+    key = str(engine.url)
+    if key not in fts_tables:
+        names = set(inspect(engine).get_table_names())
+        fts_tables[key] = {name[:-len("_fts")] for name in names if name.endswith("_fts")}
+    return model.__tablename__ in fts_tables[key]
+
+#ids whose name contains value, read from the FTS5 trigram index
+def fts_ids(model, value):
+    table = model.__tablename__ + "_fts"
+    phrase = '"' + value.replace('"', '""') + '"'
+    return text(f"SELECT rowid FROM {table} WHERE {table} MATCH :phrase").bindparams(phrase=phrase).columns(db.column("rowid", db.Integer))
+
+def contains(model, value):
+    if len(value) >= 3 and has_fts(model):
+        return model.id.in_(fts_ids(model, value))
+    return model.name.ilike("%" + escape_like(value) + "%", escape="\\")
+
+def starts_with(model, value):
+    pattern = model.name.ilike(escape_like(value) + "%", escape="\\")
+    if len(value) >= 3 and has_fts(model):
+        #the index narrows the rows down to those containing value, LIKE keeps the ones starting with it
+        return db.and_(model.id.in_(fts_ids(model, value)), pattern)
+    return pattern
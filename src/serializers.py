@@ -0,0 +1,161 @@
+"""
+JSON encoding and column tuple serializers for the list endpoints.
+
+JSON provider: with orjson installed, app.json encodes with it (JSON_PROVIDER=orjson,
+the default), otherwise, or with JSON_PROVIDER=stdlib, Flask's stdlib provider is
+kept. The bytes are the stdlib's either way: sorted keys, compact separators, dates
+as HTTP dates. Whatever orjson would write differently goes to the stdlib instead:
+non-ASCII text (the stdlib escapes it), non-string keys, integers beyond 64 bits
+and any call other than the compact one jsonify() makes (e.g. indented output in
+debug mode).
+
+Serializers: the full collection endpoints build their payloads straight from
+column tuples, one SELECT for the rows and one per nested list, without ORM
+instances or the identity map. The dicts are the ones the models' serialize()
+builds for the same rows (tests/test_serializers.py compares the bytes), with rows
+and nested lists in id order. They take a sync session, so asgi.py can hand them to
+run_sync().
+"""
+import os
+from flask.json.provider import DefaultJSONProvider
+from models import db, User, Character, Planet, Favorite
+import profiling
+
+try:
+    import orjson #optional dependency, the stdlib provider is used without it
+except ImportError:
+    orjson = None
+
+#the arguments response() passes to dumps() outside of debug mode
+COMPACT = {"separators": (",", ":")}
+
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        if kwargs != COMPACT:
+            return super().dumps(obj, **kwargs)
+        #dates and dataclasses go through default(), like with the stdlib
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            data = orjson.dumps(obj, default=self.default, option=option)
+        except orjson.JSONEncodeError:
+            return super().dumps(obj, **kwargs)
+        if self.ensure_ascii and not data.isascii():
+            return super().dumps(obj, **kwargs)
+        return data.decode()
+
+def init_app(app):
+    name = app.config.get("JSON_PROVIDER", os.getenv("JSON_PROVIDER", "orjson"))
+    if name not in ("orjson", "stdlib"):
+        raise ValueError(f"Unknown JSON_PROVIDER {name}, use orjson or stdlib")
+    if name == "orjson" and orjson is not None:
+        app.json = OrjsonProvider(app)
+
+#favorite rows: (id, user_id, planet_id, character_id, user name, planet name, character name)
+USER_ID, PLANET_ID, CHARACTER_ID = 1, 2, 3
+
+def favorite_rows(session, condition=None):
+    statement = (
+        db.select(Favorite.id, Favorite.user_id, Favorite.planet_id, Favorite.character_id, User.name, Planet.name, Character.name)
+        .select_from(Favorite)
+        .outerjoin(User, Favorite.user_id == User.id)
+        .outerjoin(Planet, Favorite.planet_id == Planet.id)
+        .outerjoin(Character, Favorite.character_id == Character.id)
+        .order_by(Favorite.id)
+    )
+    if condition is not None:
+        statement = statement.where(condition)
+    return session.execute(statement).all()
+
+#Favorite.serialize()
+def favorite(row):
+    return {"id": row[0], "user": row[4], "planet": row[5], "character": row[6]}
+
+#serialized favorites by user, planet or character id; serialize() gives None rather than an empty list
+def favorites_by(rows, index):
+    grouped = {}
+    for row, payload in rows:
+        if row[index] is not None:
+            grouped.setdefault(row[index], []).append(payload)
+    return grouped
+
+#(row, payload) pairs, a favorite shows up in several groups but is serialized once
+def with_payloads(rows):
+    return [(row, favorite(row)) for row in rows]
+
+#character rows: (id, name, faction, gender, race, homeworld name, favorite_count, homeworld_id)
+def character_rows(session, condition=None):
+    statement = (
+        db.select(Character.id, Character.name, Character.faction, Character.gender, Character.race,
+                  Planet.name, Character.favorite_count, Character.homeworld_id)
+        .outerjoin(Planet, Character.homeworld_id == Planet.id)
+        .order_by(Character.id)
+    )
+    if condition is not None:
+        statement = statement.where(condition)
+    return session.execute(statement).all()
+
+#Character.serialize()
+def character(row, favorites):
+    return {
+        "id": row[0],
+        "name": row[1],
+        "faction": row[2],
+        "gender": row[3],
+        "race": row[4],
+        "homeworld": row[5],
+        "favorite_count": row[6],
+        "favorites": favorites.get(row[0]),
+    }
+
+def characters(session):
+    favorites = favorite_rows(session, Favorite.character_id.is_not(None))
+    rows = character_rows(session)
+    with profiling.serializing():
+        by_character = favorites_by(with_payloads(favorites), CHARACTER_ID)
+        return [character(row, by_character) for row in rows]
+
+def planets(session):
+    favorites = favorite_rows(session)
+    residents = character_rows(session, Character.homeworld_id.is_not(None))
+    rows = session.execute(
+        db.select(Planet.id, Planet.name, Planet.terrain, Planet.description, Planet.location, Planet.key_event, Planet.favorite_count)
+        .order_by(Planet.id)
+    ).all()
+    with profiling.serializing():
+        favorites = with_payloads(favorites)
+        by_planet = favorites_by(favorites, PLANET_ID)
+        by_character = favorites_by(favorites, CHARACTER_ID)
+        by_homeworld = {}
+        for row in residents:
+            by_homeworld.setdefault(row[7], []).append(character(row, by_character))
+        return [{
+            "id": id,
+            "name": name,
+            "terrain": terrain,
+            "description": description,
+            "location": location,
+            "key_event": key_event,
+            "favorite_count": favorite_count,
+            "residents": by_homeworld.get(id, []),
+            "favorites": by_planet.get(id),
+        } for id, name, terrain, description, location, key_event, favorite_count in rows]
+
+def users(session):
+    favorites = favorite_rows(session, Favorite.user_id.is_not(None))
+    rows = session.execute(db.select(User.id, User.name, User.email, User.is_active).order_by(User.id)).all()
+    with profiling.serializing():
+        by_user = favorites_by(with_payloads(favorites), USER_ID)
+        return [{
+            "id": id,
+            "name": name,
+            "email": email,
+            "is_active": is_active,
+            "favorites": by_user.get(id),
+        } for id, name, email, is_active in rows]
+
+def user_favorites(session, user_id):
+    rows = favorite_rows(session, Favorite.user_id == user_id)
+    with profiling.serializing():
+        return [favorite(row) for row in rows]
@@ -0,0 +1,66 @@
+"""
+Streaming mode for full dumps of a collection.
+
+    GET /people?stream=true                           -> chunked JSON array
+    GET /people  (Accept: application/x-ndjson)       -> one JSON object per line
+
+Rows are read with yield_per (a server side cursor on Postgres) and written as soon
+as each batch is serialized; the batch is then expunged from the session, so memory
+stays flat whatever the size of the table. fields=, expand=, after=, sort=, the
+filters and the search parameters work as in pagination.py; by default every
+field and relationship is included, which is the same shape serialize() produces.
+"""
+from flask import Response, current_app, request, stream_with_context
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from models import db
+import pagination
+
+NDJSON = "application/x-ndjson"
+BATCH_SIZE = 500
+
+#takes the raw Accept header, asgi.py asks it before there is a Flask request
+def accepts_ndjson(accept):
+    return parse_accept_header(accept, MIMEAccept).best == NDJSON
+
+def wants_ndjson():
+    return accepts_ndjson(request.headers.get("Accept"))
+
+def requested():
+    return request.args.get("stream", "").lower() in ("1", "true", "yes") or wants_ndjson()
+
+#parses the query string up front, so bad parameters still answer 400 before anything is sent
+def parse(collection):
+    statement, fields, expand, sort = pagination.parse(collection, expand_all=True)
+    return statement, fields, expand
+
+#yields lists of encoded rows, one list per database batch
+def batches(collection, statement, fields, expand):
+    dumps = current_app.json.dumps
+    #same compact separators as jsonify()
+    separators = (",", ":")
+    result = db.session.execute(statement.execution_options(yield_per=BATCH_SIZE))
+    for batch in result.scalars().partitions():
+        yield [dumps(collection.serialize(obj, fields, expand), separators=separators) for obj in batch]
+        #nothing else in a streaming request needs these objects, drop them from the identity map.
+        #not expunge_all(): that replaces the identity map the running result still loads into
+        for obj in batch:
+            db.session.expunge(obj)
+
+def ndjson(encoded):
+    for batch in encoded:
+        yield "".join(line + "\n" for line in batch)
+
+def json_array(encoded):
+    separator = ""
+    yield "["
+    for batch in encoded:
+        yield separator + ",".join(batch)
+        separator = ","
+    yield "]\n"
+
+def stream(collection):
+    encoded = batches(collection, *parse(collection))
+    if wants_ndjson():
+        return Response(stream_with_context(ndjson(encoded)), mimetype=NDJSON)
+    return Response(stream_with_context(json_array(encoded)), mimetype="application/json")
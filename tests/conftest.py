@@ -0,0 +1,52 @@
+"""
+Fixtures shared by the tests: apps built by create_app() on throwaway SQLite
+databases, seeded by benchmarks/seed.py.
+
+    pipenv run pytest
+"""
+import os
+import sys
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+#src last, so it comes first: benchmarks/serializers.py must not shadow src/serializers.py
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from seed import seed
+from app import create_app
+
+#the cheapest KDF werkzeug accepts, the tests log in a lot
+FAST_HASH = "pbkdf2:sha256:1000"
+
+@pytest.fixture
+def make_app(tmp_path):
+    count = 0
+    def make(planets=5, characters=20, users=5, favorites=40, **config):
+        nonlocal count
+        count += 1
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/test-{count}.db",
+            "PASSWORD_HASH_METHOD": FAST_HASH,
+            "SERVER_TIMING": "0",
+            **config,
+        })
+        seed(app, planets, characters, users, favorites, log=lambda message: None)
+        return app
+    return make
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+def login(client, user_id=1):
+    response = client.post("/login", json={"email": f"user{user_id}@example.com", "password": "password"})
+    return {"Authorization": "Bearer " + response.get_json()["token"]}
+
+@pytest.fixture
+def auth_headers(client):
+    return login(client)
@@ -0,0 +1,25 @@
+def test_multi_get_keeps_the_order_and_reports_missing_ids(client):
+    body = client.get("/people?ids=3,1,999,3").get_json()
+    assert [row["id"] for row in body["results"]] == [3, 1]
+    assert body["missing"] == [999]
+    assert body["results"][0] == client.get("/people/3").get_json()
+
+def test_multi_get_rejects_bad_ids(client):
+    assert client.get("/planets?ids=a").status_code == 400
+    #a digit int() does not parse
+    assert client.get("/planets?ids=1,²").status_code == 400
+    assert client.get("/people?ids=" + ",".join(map(str, range(1, 200)))).status_code == 400
+
+def test_batch_answers_each_request(client, auth_headers):
+    etag = client.get("/planets/2").headers["ETag"]
+    body = client.post("/batch", headers=auth_headers, json={"requests": [
+        "/people/1",
+        {"path": "/planets/2", "headers": {"If-None-Match": etag}},
+        "/people/99999",
+        "/users/favorites",
+        {"path": "/people/1", "method": "DELETE"},
+    ]}).get_json()
+    statuses = [response["status"] for response in body["responses"]]
+    assert statuses == [200, 304, 404, 200, 400]
+    assert body["responses"][0]["body"] == client.get("/people/1").get_json()
+    assert body["responses"][3]["body"]["email"] == "user1@example.com"
@@ -0,0 +1,87 @@
+import pytest
+import cache
+import profiling
+from models import db, Planet
+
+@pytest.fixture
+def app(make_app):
+    return make_app(favorites=0, CACHE_URL="fake://")
+
+def lookups(route, result):
+    return profiling.COUNTERS["cache"].series.get((route, result), 0)
+
+def store(backend, key, value, tags):
+    backend.set(key, value, tags, backend.get(key, tags)[1])
+
+def test_shared_backend_invalidates_only_the_changed_tags():
+    backend = cache.SharedCache(cache.FakeRedis())
+    store(backend, "planets", b"p", ("planet",))
+    store(backend, "people", b"c", ("character", "planet"))
+    store(backend, "users", b"u", ("user",))
+    backend.invalidate("character")
+    assert backend.get("planets", ("planet",))[0] == b"p"
+    assert backend.get("people", ("character", "planet"))[0] is None
+    assert backend.get("users", ("user",))[0] == b"u"
+
+@pytest.mark.parametrize("backend", [cache.LRUCache(), cache.SharedCache(cache.FakeRedis())], ids=["local", "shared"])
+def test_values_built_across_an_invalidation_are_not_stored(backend):
+    stamp = backend.get("planets", ("planet",))[1]
+    backend.invalidate("planet")
+    backend.set("planets", b"stale", ("planet",), stamp)
+    assert backend.get("planets", ("planet",))[0] is None
+    store(backend, "planets", b"p", ("planet",))
+    assert backend.get("planets", ("planet",))[0] == b"p"
+
+#the view has read the planet, a rename commits before its body is stored
+@pytest.mark.parametrize("url", [None, "fake://"], ids=["local cache", "shared cache"])
+def test_a_write_between_the_miss_and_the_store_is_not_lost(make_app, monkeypatch, url):
+    app = make_app(favorites=0, **({"CACHE_URL": url} if url else {}))
+    client = app.test_client()
+    store = cache.backend.set
+    def rename_then_store(*args):
+        #ends the request's read transaction, SQLite would keep the writer waiting on it
+        db.session.rollback()
+        with app.app_context():
+            db.session.get(Planet, 1).name = "renamed"
+            db.session.commit()
+        monkeypatch.setattr(cache.backend, "set", store)
+        store(*args)
+    monkeypatch.setattr(cache.backend, "set", rename_then_store)
+    #built before the rename
+    assert client.get("/planets/1").get_json()["name"] != "renamed"
+    response = client.get("/planets/1")
+    assert (response.headers["X-Cache"], response.get_json()["name"]) == ("MISS", "renamed")
+    assert client.get("/planets/1").headers["X-Cache"] == "HIT"
+
+def test_committed_writes_invalidate_the_catalogue(app, client, auth_headers):
+    assert isinstance(cache.backend, cache.SharedCache)
+    assert client.get("/planets/1").headers["X-Cache"] == "MISS"
+    assert client.get("/planets/1").headers["X-Cache"] == "HIT"
+
+    #a write that changes nothing commits nothing
+    client.delete("/favorite/planet/1", headers=auth_headers)
+    assert client.get("/planets/1").headers["X-Cache"] == "HIT"
+
+    #a rolled back one neither
+    with app.test_request_context():
+        import favorites
+        favorites.add("planet", 1, 1)
+        db.session.rollback()
+    assert client.get("/planets/1").headers["X-Cache"] == "HIT"
+
+    assert client.post("/favorite/planet/1", headers=auth_headers).status_code == 200
+    response = client.get("/planets/1")
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.get_json()["favorites"][0]["user"] == "user 1"
+
+def test_hits_and_misses_are_counted_per_route(client):
+    route = "/people/<int:id>"
+    hits, misses = lookups(route, "hit"), lookups(route, "miss")
+    client.get("/people/1")
+    client.get("/people/1")
+    client.get("/people/2", headers={"Accept-Encoding": "gzip"})
+    client.get("/people/2", headers={"Accept-Encoding": "gzip"})
+    #the compressed variants are cache entries too, but not lookups of the route
+    assert (lookups(route, "hit") - hits, lookups(route, "miss") - misses) == (2, 2)
+    metrics = client.get("/metrics").get_data(as_text=True)
+    assert f'http_response_cache_lookups_total{{route="{route}",result="hit"}}' in metrics
@@ -0,0 +1,36 @@
+import pytest
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+import database
+
+@pytest.fixture
+def app(make_app):
+    return make_app(DB_POOL_SIZE="1", DB_MAX_OVERFLOW="0", DB_POOL_TIMEOUT="0.05")
+
+def stats(engine):
+    return database.pool_stats(engine.pool)
+
+def test_pool_counters(app):
+    with app.app_context():
+        engine = app.extensions["sqlalchemy"].engine
+    engine.dispose()
+    before = stats(engine)
+    assert (before["class"], before["size"], before["max_overflow"]) == ("InstrumentedQueuePool", 1, 0)
+
+    with engine.connect() as held:
+        assert stats(engine)["checked_out"] == 1
+        with pytest.raises(PoolTimeout):
+            engine.connect()
+        held.invalidate()
+    after = stats(engine)
+    assert after["checkouts"] - before["checkouts"] == 1
+    assert after["connects"] - before["connects"] == 1
+    assert after["timeouts"] - before["timeouts"] == 1
+    assert after["invalidated"] - before["invalidated"] == 1
+    assert after["wait_ms_total"] >= before["wait_ms_total"]
+
+    #a dispose replaces the pool, the counters and the listeners carry over
+    engine.dispose()
+    with engine.connect():
+        pass
+    assert stats(engine)["connects"] - after["connects"] == 1
+    assert stats(engine)["checkouts"] - after["checkouts"] == 1
@@ -0,0 +1,29 @@
+import pytest
+import favorites
+from models import db, User, Character
+
+@pytest.fixture
+def app(make_app):
+    return make_app(favorites=0)
+
+def etag(client, path):
+    response = client.get(path)
+    assert response.status_code == 200
+    return response.headers["ETag"]
+
+def test_user_rename_changes_the_homeworld_of_a_favorited_character(app, client):
+    with app.test_request_context():
+        character = db.session.get(Character, 1)
+        homeworld = character.homeworld_id
+        assert favorites.add("character", 1, character.id)[1]
+        db.session.commit()
+    before = {path: etag(client, path) for path in (f"/planets/{homeworld}", "/people/1", "/users/1")}
+    #the planet lists its residents' favorites, with the user's name
+    residents = {resident["id"]: resident for resident in client.get(f"/planets/{homeworld}").get_json()["residents"]}
+    assert residents[1]["favorites"][0]["user"] == "user 1"
+
+    with app.app_context():
+        db.session.get(User, 1).name = "renamed"
+        db.session.commit()
+    assert all(etag(client, path) != old for path, old in before.items())
+    assert client.get(f"/planets/{homeworld}", headers={"If-None-Match": before[f"/planets/{homeworld}"]}).status_code == 200
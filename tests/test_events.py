@@ -0,0 +1,129 @@
+import time
+import pytest
+import events
+from conftest import login
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+def feed(client, headers, last_id=None):
+    if last_id is not None:
+        headers = {**headers, "Last-Event-ID": str(last_id)}
+    response = client.get("/users/favorites/events", headers=headers)
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+def parse(body):
+    messages = []
+    for block in body.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        if fields:
+            messages.append(fields)
+    return messages
+
+#no seeded favorites, so every add below is a change
+@pytest.fixture
+def app(make_app):
+    return make_app(favorites=0)
+
+@pytest.fixture
+def fake_app(make_app):
+    return make_app(favorites=0, EVENTS_URL="fake://", EVENTS_REPLAY="5", EVENTS_BUFFER="2")
+
+def test_resume_from_last_event_id(fake_app):
+    client = fake_app.test_client()
+    headers = login(client)
+    position = int(parse(feed(client, headers))[-1]["id"])
+    assert isinstance(events.backend, events.FakeBackend)
+
+    client.post("/favorite/planet/1", headers=headers)
+    client.delete("/favorite/planet/1", headers=headers)
+    client.post("/favorite/people/3", headers=headers)
+    client.post("/favorite/planet/2", headers=login(client, 2)) #another user's
+    wait_for(lambda: len(events.broker.log) == 4)
+
+    missed = [message for message in parse(feed(client, headers, position)) if message.get("event") == "favorite"]
+    assert [message["data"] for message in missed] == [
+        '{"id":1,"name":"%s","op":"add","type":"planet"}' % events.broker.log[0][2]["name"],
+        '{"id":1,"name":"%s","op":"remove","type":"planet"}' % events.broker.log[0][2]["name"],
+        '{"id":3,"name":"%s","op":"add","type":"people"}' % events.broker.log[2][2]["name"],
+    ]
+    #from the middle of the log, only what came after
+    later = [message["id"] for message in parse(feed(client, headers, missed[1]["id"])) if message.get("event") == "favorite"]
+    assert later == [missed[2]["id"]]
+
+def test_reset_when_the_log_does_not_reach_back(fake_app):
+    client = fake_app.test_client()
+    headers = login(client)
+    position = int(parse(feed(client, headers))[-1]["id"])
+    for planet_id in range(1, 6):
+        client.post(f"/favorite/planet/{planet_id}", headers=headers)
+    client.post("/favorite/people/1", headers=headers)
+    wait_for(lambda: events.broker.log[-1][2]["type"] == "people")
+    assert [message.get("event") for message in parse(feed(client, headers, position))] == [None, "reset"]
+
+def test_slow_subscriber_overflows(fake_app):
+    client = fake_app.test_client()
+    headers = login(client)
+    subscriber = events.broker.subscribe(1, lambda: None)
+    for planet_id in (1, 2):
+        client.post(f"/favorite/planet/{planet_id}", headers=headers)
+    wait_for(lambda: len(subscriber.pending) == 2)
+    assert not subscriber.overflowed
+    client.post("/favorite/planet/3", headers=headers)
+    wait_for(lambda: subscriber.overflowed)
+    assert subscriber.drain() == []
+    events.broker.unsubscribe(subscriber)
+    assert events.broker.stats()["subscribers"] == 0
+
+def test_unknown_ids_reset_without_a_shared_backend(client, auth_headers):
+    position = int(parse(feed(client, auth_headers))[-1]["id"])
+    assert parse(feed(client, auth_headers, position))[-1] == {"retry": str(events.RETRY_MS)}
+    #another worker's id: its events never reached this one
+    foreign = position - position % 1000 + (events.ORIGIN + 1) % 1000
+    assert parse(feed(client, auth_headers, foreign))[-1]["event"] == "reset"
+    #from before the worker started
+    assert parse(feed(client, auth_headers, 1))[-1]["event"] == "reset"
+
+def test_rolled_back_changes_are_not_published(app):
+    import favorites
+    from models import db
+    with app.test_request_context():
+        assert favorites.add("planet", 1, 1)[1]
+        db.session.rollback()
+    assert len(events.broker.log) == 0
+
+def test_publish_failure_keeps_the_write(client, auth_headers, monkeypatch):
+    def fail(batch):
+        raise ConnectionError("NOTIFY connection lost")
+    monkeypatch.setattr(events.backend, "publish", fail)
+    assert client.post("/favorite/planet/1", headers=auth_headers).status_code == 200
+    assert client.post("/favorite/planet/1", headers=auth_headers).status_code == 400
+
+def test_duplicate_add_keeps_the_events_before_it(app, monkeypatch):
+    import favorites
+    from models import db
+    #the savepoint path of the databases without ON CONFLICT
+    monkeypatch.delitem(favorites.INSERTS, "sqlite")
+    with app.test_request_context():
+        assert favorites.add("planet", 1, 1)[1]
+        #its savepoint rolls back, not the transaction
+        assert not favorites.add("planet", 1, 1)[1]
+        db.session.commit()
+    wait_for(lambda: len(events.broker.log) == 1)
+
+def test_nothing_is_published_before_the_commit(app, monkeypatch):
+    import favorites
+    from models import db
+    monkeypatch.delitem(favorites.INSERTS, "sqlite")
+    with app.test_request_context():
+        assert favorites.add("planet", 1, 1)[1]
+        #releases a savepoint
+        assert favorites.add("planet", 1, 2)[1]
+        db.session.rollback()
+    time.sleep(0.1)
+    assert len(events.broker.log) == 0
@@ -0,0 +1,73 @@
+import pytest
+from sqlalchemy import event
+import favorites
+from models import db, Favorite, Planet, Character, User
+
+@pytest.fixture
+def app(make_app):
+    return make_app(favorites=0)
+
+def test_rolled_back_add_leaves_nothing_behind(app):
+    with app.test_request_context():
+        assert favorites.add("planet", 1, 1) == (db.session.get(Planet, 1).name, True)
+        db.session.rollback()
+        assert db.session.execute(db.select(db.func.count(Favorite.id))).scalar() == 0
+        assert db.session.get(Planet, 1).favorite_count == 0
+
+@pytest.mark.parametrize("on_conflict", [True, False], ids=["on conflict", "savepoint"])
+def test_duplicate_add_keeps_the_transaction(app, monkeypatch, on_conflict):
+    if not on_conflict:
+        monkeypatch.delitem(favorites.INSERTS, "sqlite")
+    statements = []
+    with app.app_context():
+        engine = db.engine
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        with app.test_request_context():
+            assert favorites.add("planet", 1, 1)[1]
+            assert not favorites.add("planet", 1, 1)[1]
+            assert favorites.add("character", 1, 2)[1]
+            db.session.commit()
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    assert any(statement.startswith("SAVEPOINT") for statement in statements) != on_conflict
+    with app.app_context():
+        assert db.session.execute(db.select(db.func.count(Favorite.id))).scalar() == 2
+        assert db.session.get(Planet, 1).favorite_count == 1
+
+def counts(model, ids):
+    return [count for id, count in db.session.execute(db.select(model.id, model.favorite_count).where(model.id.in_(ids)).order_by(model.id))]
+
+#another request writes the same favorite between the batch's read of the current favorites and its own write
+def test_batch_counts_only_what_it_wrote(app, monkeypatch):
+    insert, delete = favorites.insert_ignoring_duplicates, favorites.delete_favorites
+    def racing_insert(rows):
+        favorites.add("planet", 1, 1)
+        return insert(rows)
+    def racing_delete(user_id, keys):
+        favorites.remove("character", 1, 3)
+        return delete(user_id, keys)
+    with app.test_request_context():
+        favorites.add("character", 1, 3)
+        favorites.add("character", 1, 4)
+        db.session.commit()
+        monkeypatch.setattr(favorites, "insert_ignoring_duplicates", racing_insert)
+        monkeypatch.setattr(favorites, "delete_favorites", racing_delete)
+        operations = [("add", "planet", 1), ("add", "planet", 2), ("remove", "character", 3), ("remove", "character", 4)]
+        favorites.apply_batch(db.session.get(User, 1), operations)
+        #one event per change, the racing writes' included
+        changes = sorted((payload["op"], payload["type"], payload["id"]) for _, _, payload in db.session.info["events"])
+        assert changes == [("add", "planet", 1), ("add", "planet", 2), ("remove", "people", 3), ("remove", "people", 4)]
+        assert counts(Planet, [1, 2]) == [1, 1]
+        assert counts(Character, [3, 4]) == [0, 0]
+
+def test_repair_favorite_counts(app):
+    with app.app_context():
+        db.session.execute(db.update(Planet).where(Planet.id == 1).values(favorite_count=7))
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=["repair-favorite-counts"])
+    assert result.exit_code == 0
+    assert result.output.splitlines() == ["planet: 1 rows fixed", "character: 0 rows fixed"]
+    with app.app_context():
+        assert db.session.get(Planet, 1).favorite_count == 0
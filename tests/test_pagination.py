@@ -0,0 +1,50 @@
+import pytest
+import pagination
+
+def pages(client, path):
+    ids, cursor = [], None
+    while True:
+        body = client.get(path + (f"&after={cursor}" if cursor else "")).get_json()
+        ids.extend(row["id"] for row in body["results"])
+        cursor = body["next"]
+        if cursor is None:
+            return ids
+
+@pytest.mark.parametrize("collection", ["people", "planets"])
+def test_sort_by_id_pages_both_ways(client, collection):
+    everything = [row["id"] for row in client.get(f"/{collection}").get_json()]
+    assert pages(client, f"/{collection}?limit=3&fields=id&sort=id") == sorted(everything)
+    assert pages(client, f"/{collection}?limit=3&fields=id&sort=-id") == sorted(everything, reverse=True)
+
+def test_descending_sort_breaks_ties_by_id(client):
+    rows = client.get("/people").get_json()
+    expected = [row["id"] for row in sorted(rows, key=lambda row: (-row["favorite_count"], row["id"]))]
+    assert pages(client, "/people?limit=4&fields=id&sort=-favorite_count") == expected
+
+def test_homeworld_filter_takes_an_id_or_a_name(client):
+    planet = client.get("/planets/1").get_json()
+    by_id = client.get("/people?homeworld=1&fields=id&limit=100").get_json()["results"]
+    by_name = client.get(f"/people?homeworld={planet['name']}&fields=id&limit=100").get_json()["results"]
+    assert by_id and by_id == by_name
+    #a digit int() does not parse is a name
+    response = client.get("/people?homeworld=²")
+    assert response.status_code == 200
+    assert response.get_json()["results"] == []
+
+def test_bad_parameters_answer_400(client):
+    assert client.get("/people?limit=abc").status_code == 400
+    assert client.get("/people?sort=password").status_code == 400
+    assert client.get("/people?sort=-id&after=notacursor").status_code == 400
+
+@pytest.mark.parametrize("sort,value", [("favorite_count", "abc"), ("favorite_count", True), ("name", 5), ("name", None)])
+def test_cursors_with_a_value_of_another_type_answer_400(client, sort, value):
+    cursor = pagination.encode_cursor(5, value, sort)
+    response = client.get(f"/people?sort={sort}&after={cursor}")
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "Invalid cursor for this sort"
+
+def test_leaderboard_limit(client):
+    assert len(client.get("/leaderboard/planets").get_json()) == 5
+    assert len(client.get("/leaderboard/people?limit=3").get_json()) == 3
+    for limit in ("abc", "0", "²"):
+        assert client.get(f"/leaderboard/people?limit={limit}").status_code == 400
@@ -0,0 +1,42 @@
+import threading
+import pytest
+import passwords
+from models import db, User
+
+@pytest.fixture
+def app(make_app):
+    return make_app(PASSWORD_HASH_WORKERS="1", PASSWORD_HASH_QUEUE="1")
+
+def stored_password(app, user_id):
+    with app.app_context():
+        return db.session.execute(db.select(User.password).where(User.id == user_id)).scalar_one()
+
+def test_rehash_keeps_the_etag_and_the_cache(app, client):
+    #a row from before hashing
+    with app.app_context():
+        db.session.execute(db.update(User).where(User.id == 1).values(password="password"))
+        db.session.commit()
+    etag = client.get("/users/1").headers["ETag"]
+    assert client.get("/people").headers["X-Cache"] == "MISS"
+
+    assert client.post("/login", json={"email": "user1@example.com", "password": "password"}).status_code == 200
+    assert passwords.is_hashed(stored_password(app, 1))
+    assert client.get("/users/1").headers["ETag"] == etag
+    assert client.get("/people").headers["X-Cache"] == "HIT"
+
+def test_sync_logins_do_not_queue_behind_a_busy_pool(client):
+    release = threading.Event()
+    busy = passwords.pool.submit(release.wait)
+    try:
+        response = client.post("/login", json={"email": "user1@example.com", "password": "password"})
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        #an async caller waits without holding a thread, it takes the queue
+        queued = passwords.pool.submit(passwords.check, None, "password")
+        with pytest.raises(passwords.PoolBusy):
+            passwords.pool.submit(passwords.check, None, "password")
+    finally:
+        release.set()
+    busy.result()
+    assert queued.result() is False
+    assert client.post("/login", json={"email": "user1@example.com", "password": "password"}).status_code == 200
@@ -0,0 +1,40 @@
+import pytest
+from sqlalchemy import event
+import profiling
+
+@pytest.fixture
+def app(make_app):
+    return make_app(SERVER_TIMING="1")
+
+def observed(name, values):
+    counts = profiling.HISTOGRAMS[name].series.get(values, [0, 0])
+    return counts[-2], counts[-1]
+
+def test_streamed_responses_are_recorded_once_closed(app, client):
+    values = ("/people", "GET")
+    before = {name: observed(name, values) for name in ("queries", "size")}
+    statements = []
+    with app.app_context():
+        engine = app.extensions["sqlalchemy"].engine
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        response = client.get("/people?stream=true", buffered=False)
+        assert response.is_streamed
+        assert "streamed;" in response.headers["Server-Timing"]
+        #nothing is recorded while the body is still streaming
+        assert observed("queries", values) == before["queries"]
+        body = response.get_data()
+        response.close()
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    assert len(response.get_json()) == 20
+    assert observed("queries", values) == (before["queries"][0] + 1, before["queries"][1] + len(statements))
+    assert observed("size", values) == (before["size"][0] + 1, before["size"][1] + len(body))
+
+def test_whole_responses_are_recorded_before_they_are_sent(client):
+    values = ("/people/<int:id>", "GET")
+    count = observed("size", values)[0]
+    response = client.get("/people/1")
+    assert "streamed" not in response.headers["Server-Timing"]
+    assert observed("size", values)[0] == count + 1
@@ -0,0 +1,43 @@
+from sqlalchemy import event
+from conftest import login
+
+#every route that builds a nested payload, the nested rows must come from a fixed number of queries
+PATHS = (
+    "/people",
+    "/people/2",
+    "/planets",
+    "/planets/2",
+    "/users",
+    "/users/2",
+    "/users/2/favorites",
+    "/users/favorites",
+    "/people?limit=100&expand=favorites",
+    "/planets?limit=100&expand=residents,favorites",
+    "/users?limit=100&expand=favorites",
+    "/people?ids=1,2,3,4",
+    "/planets?ids=1,2,3,4",
+)
+
+def query_counts(app):
+    client = app.test_client()
+    headers = login(client, 2)
+    statements = []
+    with app.app_context():
+        engine = app.extensions["sqlalchemy"].engine
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        counts = {}
+        for path in PATHS:
+            statements.clear()
+            response = client.get(path, headers=headers)
+            assert response.status_code == 200, path
+            counts[path] = len(statements)
+        return counts
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+
+def test_query_count_does_not_grow_with_the_rows(make_app):
+    small = query_counts(make_app(planets=5, characters=20, users=5, favorites=40))
+    large = query_counts(make_app(planets=40, characters=200, users=20, favorites=800))
+    assert small == large
@@ -0,0 +1,54 @@
+import shutil
+import sqlite3
+import time
+import pytest
+import replicas
+from conftest import login
+
+MAX_LAG = 0.2
+
+#two SQLite files stand in for the primary and a replica; the replica is a copy with
+#planet 1 renamed, so the responses tell which of the two they were read from
+@pytest.fixture(params=[None, "fake://"], ids=["local cache", "shared cache"])
+def app(request, make_app, tmp_path):
+    config = {"CACHE_URL": request.param} if request.param else {}
+    app = make_app(favorites=0, DATABASE_REPLICA_URLS=f"sqlite:///{tmp_path}/replica.db",
+                   REPLICA_CHECK_INTERVAL="0", REPLICA_CACHE_MAX_LAG=str(MAX_LAG), **config)
+    shutil.copy(f"{tmp_path}/test-1.db", f"{tmp_path}/replica.db")
+    with sqlite3.connect(f"{tmp_path}/replica.db") as connection:
+        connection.execute("UPDATE planet SET name = 'replica' WHERE id = 1")
+    #past the seed's writes
+    time.sleep(MAX_LAG)
+    return app
+
+def lag(monkeypatch, seconds):
+    monkeypatch.setitem(replicas.LAG_QUERIES, "sqlite", f"SELECT {seconds}")
+
+def read(client):
+    response = client.get("/planets/1")
+    assert response.status_code == 200
+    return response.headers["X-Cache"], response.get_json()["name"] == "replica"
+
+def test_misses_fill_the_cache_from_a_caught_up_replica(client, monkeypatch):
+    lag(monkeypatch, 0)
+    assert read(client) == ("MISS", True)
+    assert read(client) == ("HIT", True)
+    assert replicas.replicas.status()[0]["lag"] == 0
+
+def test_misses_read_the_primary_right_after_a_write(app, client, monkeypatch):
+    lag(monkeypatch, 0)
+    assert client.post("/favorite/planet/1", headers=login(client)).status_code == 200
+    #the replica may not have the favorite yet
+    assert read(client) == ("MISS", False)
+    assert read(client) == ("HIT", False)
+    time.sleep(MAX_LAG)
+    app.extensions["response_cache"].clear()
+    assert read(client) == ("MISS", True)
+
+def test_misses_read_the_primary_when_the_replica_lags(app, client, monkeypatch):
+    lag(monkeypatch, MAX_LAG * 10)
+    assert read(client) == ("MISS", False)
+    assert read(client) == ("HIT", False)
+
+def test_misses_read_the_primary_when_the_lag_is_unknown(client):
+    assert read(client) == ("MISS", False)
@@ -0,0 +1,58 @@
+import datetime
+import decimal
+import uuid
+import pytest
+from flask.json.provider import DefaultJSONProvider
+from models import db, User, Character, Planet
+import queries
+import serializers
+
+COLLECTIONS = {
+    "people": (Character, queries.character_graph, serializers.characters),
+    "planets": (Planet, queries.planet_graph, serializers.planets),
+    "users": (User, queries.user_graph, serializers.users),
+}
+
+@pytest.fixture
+def app(make_app):
+    return make_app(planets=10, characters=60, users=10, favorites=200)
+
+def providers(app):
+    encoders = {"stdlib": DefaultJSONProvider(app)}
+    if serializers.orjson is not None:
+        encoders["orjson"] = serializers.OrjsonProvider(app)
+    return encoders
+
+def orm(model, graph):
+    db.session.remove()
+    rows = db.session.execute(db.select(model).options(*graph()).order_by(model.id)).scalars().all()
+    return [row.serialize() for row in rows]
+
+@pytest.mark.parametrize("name", COLLECTIONS)
+def test_column_tuples_encode_to_the_bytes_of_serialize(app, name):
+    model, graph, build = COLLECTIONS[name]
+    with app.app_context():
+        payloads = {"serialize()": orm(model, graph), "column tuples": build(db.session)}
+        bodies = {
+            (builder, provider): encoder.dumps(payload, **serializers.COMPACT)
+            for builder, payload in payloads.items()
+            for provider, encoder in providers(app).items()
+        }
+    assert len(set(bodies.values())) == 1, sorted(bodies)
+
+def test_user_favorites_match_serialize(app):
+    with app.app_context():
+        for user in db.session.execute(db.select(User).options(*queries.user_graph())).scalars():
+            assert serializers.user_favorites(db.session, user.id) == [favorite.serialize() for favorite in user.favorites]
+
+AWKWARD = [
+    {"name": "Padmé", "b": 1, "a": [True, None, 2 ** 70]},
+    {"when": datetime.datetime(2024, 5, 4, 12, 0), "day": datetime.date(2024, 5, 4)},
+    {"price": decimal.Decimal("1.50"), "id": uuid.UUID(int=1), "nested": {"z": {"y": [1.5, -0.0]}}},
+    {2: "non string keys", 1: "\U0001f680"},
+]
+
+@pytest.mark.parametrize("value", AWKWARD)
+def test_providers_agree_on_awkward_values(app, value):
+    encoded = {name: provider.dumps(value, **serializers.COMPACT) for name, provider in providers(app).items()}
+    assert len(set(encoded.values())) == 1, encoded
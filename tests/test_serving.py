@@ -0,0 +1,74 @@
+import json
+import sys
+from starlette.testclient import TestClient
+from conftest import FAST_HASH
+from seed import seed
+import cache
+
+SIZE = dict(planets=5, characters=20, users=5, favorites=40)
+
+#reads, logins, errors and favorite toggles; the tokens differ (issue time) and are left out
+STEPS = [
+    ("GET", "/people", None, None), ("GET", "/people/1", None, None), ("GET", "/people/99999", None, None),
+    ("GET", "/planets", None, None), ("GET", "/planets/1", None, None), ("GET", "/users", None, None),
+    ("GET", "/users/2", None, None), ("GET", "/users/2/favorites", None, None), ("GET", "/users/99999/favorites", None, None),
+    ("POST", "/login", {"email": "user1@example.com", "password": "wrong"}, None),
+    ("POST", "/login", {"email": "nobody@example.com", "password": "password"}, None),
+    ("POST", "/login", {"email": 1}, None),
+    ("GET", "/users/favorites", None, None), ("GET", "/users/favorites", None, "not a token"),
+    ("GET", "/users/favorites", None, "<token>"),
+    #whatever was seeded, the second DELETE and the first POST change nothing and something
+    ("DELETE", "/favorite/planet/3", None, "<token>"), ("DELETE", "/favorite/planet/3", None, "<token>"),
+    ("POST", "/favorite/planet/3", None, "<token>"), ("POST", "/favorite/planet/3", None, "<token>"),
+    ("POST", "/favorite/planet/99999", None, "<token>"), ("GET", "/planets/3", None, None),
+    ("DELETE", "/favorite/people/4", None, "<token>"), ("DELETE", "/favorite/people/4", None, "<token>"),
+    ("POST", "/favorite/people/4", None, "<token>"), ("POST", "/favorite/people/4", None, "<token>"),
+    ("DELETE", "/favorite/people/99999", None, "<token>"), ("GET", "/people/4", None, None),
+    ("GET", "/users/favorites", None, "<token>"), ("GET", "/people?limit=2", None, None),
+]
+
+#the same reads with an Accept header: NDJSON is the streamed export of the Flask routes
+NEGOTIATED = [
+    ("/people", "application/x-ndjson"), ("/planets", "application/x-ndjson"),
+    ("/people", "application/x-ndjson;q=0.5, application/json"), ("/planets", "application/json"),
+]
+
+#call(method, path, body, headers) -> (status, content type, body bytes)
+def transcript(call):
+    status, _, body = call("POST", "/login", {"email": "user1@example.com", "password": "password"}, {})
+    assert status == 200
+    token = json.loads(body)["token"]
+    answers = []
+    for method, path, body, bearer in STEPS:
+        headers = {"Authorization": "Bearer " + (token if bearer == "<token>" else bearer)} if bearer else {}
+        answers.append((method, path, *call(method, path, body, headers)))
+    for path, accept in NEGOTIATED:
+        answers.append(("GET", path, accept, *call("GET", path, None, {"Accept": accept})))
+    return answers
+
+def test_async_mode_answers_like_the_flask_routes(make_app, tmp_path, monkeypatch):
+    sync_app = make_app(**SIZE)
+    #asgi.py builds its Flask app from the environment when it is imported
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path}/async.db")
+    monkeypatch.setenv("PASSWORD_HASH_METHOD", FAST_HASH)
+    monkeypatch.setenv("SERVER_TIMING", "0")
+    monkeypatch.delitem(sys.modules, "asgi", raising=False)
+    import asgi
+    #the same random seed, the same rows
+    seed(asgi.flask_app, **SIZE, log=lambda message: None)
+
+    flask_client = sync_app.test_client()
+    def sync_call(method, path, body, headers):
+        response = flask_client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.content_type, response.get_data()
+    sync = transcript(sync_call)
+
+    #both apps share the module level response cache, the async routes must build their own bodies
+    cache.backend.clear()
+    with TestClient(asgi.app) as async_client:
+        def async_call(method, path, body, headers):
+            response = async_client.request(method, path, json=body, headers=headers)
+            return response.status_code, response.headers.get("content-type"), response.content
+        async_ = transcript(async_call)
+
+    assert sync == async_